@@ -1,10 +1,35 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import base64
+import hashlib
 import os
+import sys
 import re
 import json
+import io
+import gzip
+import mmap
+import struct
+import zlib
+import csv
+import time
+import shutil
+import subprocess
+import zipfile
+import sqlite3
+import threading
+import queue
+import atexit
+import bisect
+import array
+import itertools
+import weakref
+import uuid
+from collections import Counter, OrderedDict
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Page configuration
 st.set_page_config(
@@ -123,18 +148,180 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Clinic address configurations
-CLINIC_ADDRESSES = {
-    "Vittal Rao Nagar, Madhapur": {
-        "display_name": "Vittal Rao Nagar, Madhapur",
-        "full_address": "Plot No. 1-89/A/3/15, beside Siddarth Fitness gym,\nnear Gowra Tulips, Vittal Rao Nagar, Madhapur,\nGafoornagar, Hyderabad, Telangana 500081",
-        "short_address": "Plot No. 1-89/A/3/15, beside Siddarth Fitness gym, near Gowra Tulips, Vittal Rao Nagar, Madhapur, Gafoornagar, Hyderabad 500081"
-    },
-    "Sri Ramnagar, Kondapur": {
-        "display_name": "Sri Ramnagar, Kondapur",
-        "full_address": "Street Number 5, beside Charminar Biriyani Shop,\nKondapur, Sri Ramnagar - Block C,\nHyderabad, Telangana 500084",
-        "short_address": "Street Number 5, beside Charminar Biriyani Shop, Kondapur, Sri Ramnagar - Block C, Hyderabad 500084"
-    }
+# Clinic, pricing and policy catalog (YAML or TOML), reloaded when the file changes
+CATALOG_PATH = os.environ.get("PAL_CATALOG_PATH", "clinic_catalog.yaml")
+CLINIC_FIELDS = ('display_name', 'full_address', 'short_address')
+
+# Branding bundles kept in memory (one per clinic / practitioner pair)
+BRANDING_CACHE_SIZE = 32
+DEFAULT_PRIMARY_COLOR = "#0a2a43"
+DEFAULT_ACCENT_COLOR = "#30b392"
+
+# Upload limits for invoice PDFs (invoices are one or two pages long)
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_PDF_PAGES = 20
+MAX_EXTRACT_PAGES = 3
+MAX_EXTRACT_CHARS = 50000
+
+# Local invoice store
+DATA_DIR = os.environ.get("PAL_DATA_DIR", "pal_data")
+INVOICE_DB_PATH = os.path.join(DATA_DIR, "invoices.db")
+DATE_FIELDS = ('invoice_date', 'session_start_date', 'session_end_date')
+
+# Background job queue (SQLite-backed, run by local worker processes)
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.db")
+JOB_KINDS = {
+    'render': "Render invoices (ZIP)",
+    'export': "Export invoices (CSV)",
+    'import': "Import invoice PDF archive",
+    'archive': "Archive invoices (compressed)",
+    'print': "Print batch (PDF)",
+    'calendar': "Import calendar (ICS) as drafts"
+}
+JOB_WORKER_COUNT = 2
+JOB_WORKER_NICENESS = 10
+JOB_WORKER_IDLE_SECONDS = 300
+JOB_LEASE_SECONDS = 120
+JOB_HEARTBEAT_SECONDS = 10
+JOB_POLL_SECONDS = 1.0
+JOB_CHUNK_SIZE = 50
+JOB_STATUS_REFRESH_SECONDS = 3
+
+# Archive of rendered invoices, stored pre-compressed with each branding image written once
+# by content hash. Brotli and zopfli settings favour size since archives are written once;
+# SERVE_GZIP_LEVEL is for compressing on the fly when serving. Records are packed into
+# segment files that are sealed at ARCHIVE_SEGMENT_BYTES and compacted once less than
+# ARCHIVE_COMPACT_LIVE_RATIO of a sealed segment is still current.
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+ARCHIVE_ENCODINGS = ('br',)
+ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+ARCHIVE_COMPACT_LIVE_RATIO = 0.5
+ARCHIVE_BATCH_SIZE = 200
+BROTLI_QUALITY = 11
+ZOPFLI_ITERATIONS = 15
+SERVE_GZIP_LEVEL = 1
+HTML_SUFFIXES = {'identity': ".html", 'br': ".html.br", 'gz': ".html.gz", 'gzip': ".html.gz"}
+
+# Append-only audit log of invoice creates and edits
+AUDIT_DB_PATH = os.path.join(DATA_DIR, "audit.db")
+AUDIT_FLUSH_SECONDS = 0.5
+AUDIT_BATCH_SIZE = 500
+# A failed batch is retried with doubling delays before it is spilled to a file for the next start
+AUDIT_RETRY_ATTEMPTS = 5
+AUDIT_RETRY_SECONDS = 0.5
+
+# Autosaved drafts of unfinished invoice forms: each draft is written at most once per
+# DRAFT_SAVE_SECONDS, and drafts untouched for DRAFT_MAX_AGE_DAYS are removed
+DRAFTS_DIR = os.path.join(DATA_DIR, "drafts")
+DRAFT_SAVE_SECONDS = 3.0
+DRAFT_MAX_AGE_DAYS = 30
+DRAFTS_SHOWN = 10
+DRAFT_TEXT_FIELDS = ('patient_name', 'patient_age', 'problem_desc', 'treatment_notes')
+
+# Calendar (.ics) import: completed appointments become draft invoices, one per patient,
+# clinic and calendar month. Times are billed on CALENDAR_TIMEZONE dates and job progress
+# is reported every CALENDAR_REPORT_BYTES read.
+CALENDAR_TIMEZONE = "Asia/Kolkata"
+CALENDAR_REPORT_BYTES = 1024 * 1024
+ICS_DURATION = re.compile(r'([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+ICS_ESCAPE = re.compile(r'\\([\\;,nN])')
+# A phone number in an appointment title or notes, and the separators between its parts
+# ("Ravi Kumar - 60 Mins Physiotherapy Session (98480 12345)")
+CALENDAR_PHONE = re.compile(r'\+?\d[\d \t()-]{8,}\d')
+CALENDAR_TITLE_SEPARATORS = re.compile(r'\s+[-–|:/]\s+|[()\[\]]')
+
+# Accounts receivable: payments against stored invoices, aging buckets as
+# (label, oldest age in days) and how many patient balances the report lists
+PAYMENT_METHODS = ("Cash", "UPI", "Card", "Bank Transfer", "Insurance")
+AGING_BUCKETS = (("0-30", 30), ("31-60", 60), ("61-90", 90), ("90+", None))
+RECEIVABLES_TOP_PATIENTS = 25
+
+# Invoice search results per page
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_RESULTS = 1000
+
+# Batch sanitization parses numbers from fixed-width character blocks of up to this many
+# cells; smaller batches than SANITIZE_BATCH_MIN_ROWS use the scalar helpers
+SANITIZE_CHUNK_CELLS = 4_000_000
+SANITIZE_BATCH_MIN_ROWS = 200
+SANITIZE_MAX_NUMBER_WIDTH = 32
+POWERS_OF_TEN = 10.0 ** np.arange(SANITIZE_MAX_NUMBER_WIDTH + 1)
+
+NON_NUMERIC_CHARS = re.compile(r'[^\d.-]')
+NON_DIGITS = re.compile(r'\D')
+# Optional 0091/091/91 or trunk 0 prefix, then the 10-digit national number
+PHONE_NUMBER = re.compile(r'(?:0{0,2}91|0)?([1-9]\d{9})')
+# A number after a "Phone:" label in any format, or an unlabelled +91 number
+PHONE_IN_TEXT = re.compile(r'Phone:[ \t]*([+(\d][\d \t()+-]*)|(\+91[ \t-]*(?:\d[ \t-]?){9}\d)')
+
+# A4 invoice layout in CSS pixels (96 dpi), inside the 0.5in @page margins. Page height is
+# rounded down so a laid-out page never spills onto a second printed sheet.
+INVOICE_PAGE_WIDTH = 698
+INVOICE_PAGE_HEIGHT = 1020
+INVOICE_PAGE_PADDING = 20
+INVOICE_LOGO_HEIGHT = 80
+# Average Arial glyph width as a fraction of the font size, rounded up so estimates err long
+INVOICE_CHAR_WIDTH_EM = 0.56
+
+# Raster previews: invoice pages drawn with PyMuPDF, cached on disk by content hash. Bump
+# RASTER_LAYOUT_VERSION whenever the drawing changes so stale images are not served.
+# Images are palette PNGs, which st.image serves as-is (it re-encodes WebP to JPEG).
+RASTER_CACHE_DIR = os.path.join(DATA_DIR, "thumbnails")
+RASTER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RASTER_LAYOUT_VERSION = 1
+RASTER_PALETTE_COLORS = 64
+THUMBNAIL_WIDTH = 160
+PREVIEW_IMAGE_WIDTH = 900
+BATCH_THUMBNAILS_SHOWN = 12
+RASTER_WIDTH_CACHE_SIZE = 50000
+
+# Shared cache of rendered invoice HTML and parsed invoice PDFs, kept in one SQLite file (WAL,
+# so readers never block) that every server process and job worker on the host reads behind
+# its own in-process LRU of SHARED_CACHE_MEMORY_ENTRIES. The least recently used entries are
+# pruned past SHARED_CACHE_MAX_BYTES; last-use times are rewritten at most once every
+# SHARED_CACHE_TOUCH_SECONDS so hits stay reads. On startup a process loads the
+# SHARED_CACHE_WARM_ENTRIES most recently used entries and renders the latest
+# SHARED_CACHE_WARM_INVOICES invoices still missing. Bump RENDER_CACHE_VERSION or
+# PARSE_CACHE_VERSION whenever the invoice HTML or the PDF parser changes.
+SHARED_CACHE_PATH = os.path.join(DATA_DIR, "shared_cache.db")
+SHARED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+SHARED_CACHE_MEMORY_ENTRIES = 256
+SHARED_CACHE_TOUCH_SECONDS = 3600
+SHARED_CACHE_WARM_ENTRIES = 128
+SHARED_CACHE_WARM_INVOICES = 50
+SHARED_CACHE_PRUNE_WRITES = 200
+RENDER_CACHE_VERSION = 1
+PARSE_CACHE_VERSION = 2
+# Stands in for a branding image in cached HTML; the image is put back on the way out
+SHARED_CACHE_IMAGE_PLACEHOLDER = "pal-cached-image:{}"
+SHARED_CACHE_IMAGE_PATTERN = re.compile(r"pal-cached-image:(?:logo|watermark|signature)")
+
+# Print batches: invoice pages placed on A4 (in points) inside the same 0.5in margins the HTML
+# prints with, PRINT_CHUNK_SIZE invoices drawn between incremental saves, and the cover lists
+# PRINT_COVER_ROWS invoices per page
+PRINT_PAGE_WIDTH = 595.28
+PRINT_PAGE_HEIGHT = 841.89
+PRINT_MARGIN = 36
+PRINT_CHUNK_SIZE = 50
+PRINT_COVER_ROWS = 44
+
+# Fonts embedded in generated PDFs are cut down to the glyphs a document draws plus the font's
+# common characters, so most documents share one cached subset per font; FONT_SUBSET_CACHE_SIZE
+# subsets are kept per process
+FONT_BASIC_CHARS = ''.join(map(chr, range(0x20, 0x7f))) + "·–—‘’“”•…"
+FONT_COMMON_CHARS = {'regular': FONT_BASIC_CHARS, 'bold': FONT_BASIC_CHARS, 'symbol': "₹"}
+FONT_SUBSET_CACHE_SIZE = 32
+
+# Per-session memory: over SESSION_STATE_MAX_BYTES a session drops state it can rebuild, and
+# sessions idle for SESSION_IDLE_SECONDS (a tab left open overnight) are reset. Values are the
+# page that still needs each transient entry.
+SESSION_STATE_MAX_BYTES = 4 * 1024 * 1024
+SESSION_IDLE_SECONDS = int(os.environ.get("PAL_SESSION_IDLE_SECONDS", 2 * 60 * 60))
+SESSION_SWEEP_SECONDS = 60
+SESSION_TRANSIENT_KEYS = {
+    'uploaded_invoice_data': 'upload',
+    'edit_original': 'form',
+    'invoice_data': 'preview'
 }
 
 # Helper functions for type safety
@@ -142,20 +329,20 @@ def safe_int(value, default=0):
     """Safely convert value to int"""
     try:
         if isinstance(value, str):
-            cleaned = re.sub(r'[^\d.-]', '', value)
+            cleaned = NON_NUMERIC_CHARS.sub('', value)
             return int(float(cleaned)) if cleaned else default
         return int(value)
-    except (ValueError, TypeError):
+    except (ValueError, TypeError, OverflowError):
         return default
 
 def safe_float(value, default=0.0):
     """Safely convert value to float"""
     try:
         if isinstance(value, str):
-            cleaned = re.sub(r'[^\d.-]', '', value)
+            cleaned = NON_NUMERIC_CHARS.sub('', value)
             return float(cleaned) if cleaned else default
         return float(value)
-    except (ValueError, TypeError):
+    except (ValueError, TypeError, OverflowError):
         return default
 
 def clean_text_field(text, max_length=100):
@@ -167,28 +354,760 @@ def clean_text_field(text, max_length=100):
         cleaned = cleaned[:max_length].strip()
     return cleaned
 
+def text_rows_mask(objects):
+    """Return a mask of the entries in an object array that are str"""
+    if pd.api.types.infer_dtype(objects, skipna=False) == 'string':
+        return np.ones(len(objects), dtype=bool)
+    return np.fromiter((type(value) is str for value in objects), dtype=bool, count=len(objects))
+
+def factorize_texts(texts):
+    """Return (codes, distinct strings, matched) for an object array of strings.
+    
+    pandas hashes strings only up to the first NUL, so matched flags the rows
+    whose string really equals its distinct value.
+    """
+    codes, uniques = pd.factorize(texts)
+    uniques = np.asarray(uniques, dtype=object)
+    return codes, uniques, texts == uniques[codes]
+
+def char_blocks(texts, max_width):
+    """Yield (row indexes, code point matrix) blocks for the strings that fit in max_width characters"""
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    rows = np.flatnonzero(lengths <= max_width)
+    if not len(rows):
+        return
+    width = max(1, int(lengths[rows].max()))
+    if len(rows) < len(texts):
+        texts = texts[rows]
+    chars = texts.astype(f'U{width}').view(np.uint32).reshape(len(rows), width)
+    step = max(1, SANITIZE_CHUNK_CELLS // width)
+    for start in range(0, len(rows), step):
+        yield rows[start:start + step], chars[start:start + step]
+
+def parse_numeric_block(chars):
+    """Parse rows of characters the way safe_float cleans them.
+    
+    Returns (values, valid, exact): valid is False where float() would fail or
+    nothing numeric is left, and exact is False for rows this fast path cannot
+    round exactly (non-ASCII digits or more than 15 digits).
+    """
+    row_index = np.arange(len(chars))
+    digits = chars - np.uint32(48)
+    is_digit = digits < 10
+    is_dot = chars == 46
+    is_minus = chars == 45
+    kept = is_digit | is_dot | is_minus
+    digit_count = np.count_nonzero(is_digit, axis=1)
+    dot_count = np.count_nonzero(is_dot, axis=1)
+    minus_count = np.count_nonzero(is_minus, axis=1)
+    leading_minus = chars[row_index, kept.argmax(axis=1)] == 45
+    valid = (digit_count > 0) & (dot_count <= 1) & ((minus_count == 0) | ((minus_count == 1) & leading_minus))
+    
+    # Weight each digit by its power of ten; 15 digits or fewer stay exact in float64
+    digit_rank = np.cumsum(is_digit, axis=1, dtype=np.int8)
+    powers = np.minimum(digit_count[:, None] - digit_rank, len(POWERS_OF_TEN) - 1)
+    mantissa = np.einsum('ij,ij->i', np.where(is_digit, digits, 0).astype(np.float64), POWERS_OF_TEN[powers])
+    fraction_digits = np.where(dot_count > 0, digit_count - digit_rank[row_index, is_dot.argmax(axis=1)], 0)
+    values = mantissa / POWERS_OF_TEN[np.minimum(fraction_digits, len(POWERS_OF_TEN) - 1)]
+    values = np.where(minus_count > 0, -values, values)
+    
+    # Non-ASCII digits (Devanagari, Arabic-Indic, ...) are left to float()
+    exact = digit_count <= 15
+    non_ascii = chars > 127
+    if non_ascii.any():
+        decimals = [code for code in np.unique(chars[non_ascii]) if chr(code).isdecimal()]
+        if decimals:
+            exact &= ~np.isin(chars, decimals).any(axis=1)
+    return values, valid, exact
+
+def numeric_text_values(objects):
+    """Split an object array into parsed string values and rows that need the scalar helpers"""
+    text_rows = np.flatnonzero(text_rows_mask(objects))
+    codes, uniques, matched = factorize_texts(objects[text_rows])
+    unique_values = np.zeros(len(uniques))
+    unique_valid = np.zeros(len(uniques), dtype=bool)
+    unique_exact = np.zeros(len(uniques), dtype=bool)
+    for block_rows, chars in char_blocks(uniques, SANITIZE_MAX_NUMBER_WIDTH):
+        unique_values[block_rows], unique_valid[block_rows], unique_exact[block_rows] = parse_numeric_block(chars)
+    
+    values = np.zeros(len(objects))
+    valid = np.zeros(len(objects), dtype=bool)
+    fallback = np.ones(len(objects), dtype=bool)
+    values[text_rows] = unique_values[codes]
+    valid[text_rows] = unique_valid[codes]
+    fallback[text_rows] = ~(unique_exact[codes] & matched)
+    return values, valid, fallback
+
+def numeric_series(values):
+    """Wrap a list or array in a Series, converting all-number input to a numeric dtype.
+    
+    pd.Series(list) infers the dtype several times slower than checking an
+    object array once, which dominates batches of plain ints such as line quantities.
+    """
+    if isinstance(values, pd.Series):
+        return values
+    objects = values if isinstance(values, np.ndarray) else np.fromiter(values, dtype=object, count=len(values))
+    if objects.dtype == object:
+        inferred = pd.api.types.infer_dtype(objects, skipna=False)
+        try:
+            if inferred == 'integer':
+                return pd.Series(objects.astype(np.int64))
+            if inferred == 'floating':
+                return pd.Series(objects.astype(np.float64))
+        except OverflowError:
+            pass
+    return pd.Series(objects)
+
+def safe_float_series(values, default=0.0):
+    """Vectorized safe_float over a Series or array, returning a float Series"""
+    series = numeric_series(values)
+    if series.dtype.kind in 'biuf':
+        return series.astype(float)
+    objects = series.to_numpy(dtype=object)
+    parsed, valid, fallback = numeric_text_values(objects)
+    result = np.where(valid, parsed, default)
+    rows = np.flatnonzero(fallback)
+    result[rows] = [safe_float(value, default) for value in objects[rows]]
+    return pd.Series(result, index=series.index)
+
+def safe_int_series(values, default=0):
+    """Vectorized safe_int over a Series or array, returning an int Series"""
+    series = numeric_series(values)
+    if series.dtype.kind in 'bi':
+        return series.astype(np.int64)
+    objects = series.to_numpy(dtype=object)
+    if series.dtype.kind == 'f':
+        parsed = objects.astype(float)
+        valid, fallback = np.isfinite(parsed), np.zeros(len(objects), dtype=bool)
+    else:
+        parsed, valid, fallback = numeric_text_values(objects)
+    # Values beyond int64 become Python ints through the scalar helper
+    fallback |= valid & ~(np.abs(parsed) < 2.0 ** 63)
+    result = np.where(valid & ~fallback, np.trunc(parsed), 0).astype(np.int64).astype(object)
+    result[~valid] = default
+    rows = np.flatnonzero(fallback)
+    result[rows] = [safe_int(value, default) for value in objects[rows]]
+    try:
+        return pd.Series(result.astype(np.int64), index=series.index)
+    except (TypeError, ValueError, OverflowError):
+        # Defaults that are not ints, or values beyond int64, stay as Python objects
+        return pd.Series(result, index=series.index)
+
+def clean_text_series(texts, max_length=100):
+    """Batch clean_text_field over a Series or array of strings; missing values become "".
+    
+    Each distinct string is cleaned once, which is where bulk columns such as
+    clinic names and problem descriptions spend their time.
+    """
+    series = texts if isinstance(texts, pd.Series) else pd.Series(texts)
+    objects = series.to_numpy(dtype=object)
+    result = np.full(len(objects), "", dtype=object)
+    text_rows = np.flatnonzero(text_rows_mask(objects))
+    codes, uniques, matched = factorize_texts(objects[text_rows])
+    result[text_rows] = np.array([clean_text_field(text, max_length) for text in uniques], dtype=object)[codes]
+    done = np.zeros(len(objects), dtype=bool)
+    done[text_rows[matched]] = True
+    other_rows = np.flatnonzero(~done)
+    result[other_rows] = [clean_text_field(value, max_length) if type(value) is str or not pd.isna(value) else ""
+                          for value in objects[other_rows]]
+    return pd.Series(result, index=series.index)
+
+def phone_key(phone):
+    """Return the 10-digit national number of an Indian mobile or landline as an int, or None.
+    
+    Accepts +91, 0091, 91 and trunk 0 prefixes with any spacing or punctuation,
+    so "+91 98480 12345", "098480-12345" and "040 2345 6789" all normalize.
+    """
+    if not phone:
+        return None
+    match = PHONE_NUMBER.fullmatch(NON_DIGITS.sub('', phone))
+    return int(match.group(1)) if match else None
+
+def phone_keys(phones):
+    """Batch phone_key over a Series or array, returning int64 keys with 0 where a number is invalid"""
+    objects = (phones if isinstance(phones, pd.Series) else pd.Series(phones, dtype=object)).to_numpy(dtype=object)
+    keys = np.zeros(len(objects), dtype=np.int64)
+    text_rows = np.flatnonzero(text_rows_mask(objects))
+    codes, uniques, matched = factorize_texts(objects[text_rows])
+    unique_keys = np.array([phone_key(phone) or 0 for phone in uniques], dtype=np.int64)
+    keys[text_rows] = unique_keys[codes]
+    rows = text_rows[~matched]
+    keys[rows] = [phone_key(phone) or 0 for phone in objects[rows]]
+    return keys
+
+def format_phone(key):
+    """Render a phone key in the canonical +91 form used on invoices"""
+    return f"+91 {key}"
+
 def extract_phone_number(text_content):
-    """Extract phone number with better pattern matching"""
-    phone_patterns = [
-        r'Phone:\s*(\+91\s*\d{10})',
-        r'Phone:\s*(\+91\s*\d{5}\s*\d{5})',
-        r'Phone:\s*(\+91\s*\d+)',
-        r'(\+91\s*\d{10})',
-        r'(\+91\s*\d{5}\s*\d{5})'
-    ]
+    """Extract the patient's phone number from invoice text, preferring the labelled one"""
+    first_unlabelled = None
+    for match in PHONE_IN_TEXT.finditer(text_content):
+        key = phone_key(match.group(1) or match.group(2))
+        if key and match.group(1):
+            return format_phone(key)
+        if key and first_unlabelled is None:
+            first_unlabelled = key
+    return format_phone(first_unlabelled) if first_unlabelled else "+91 "
+
+def load_catalog_file(path):
+    """Parse and validate a clinic catalog file"""
+    with open(path, 'r', encoding='utf-8') as catalog_file:
+        if path.endswith('.toml'):
+            import toml
+            catalog = toml.load(catalog_file)
+        else:
+            import yaml
+            catalog = yaml.safe_load(catalog_file)
+    
+    if not isinstance(catalog, dict) or not catalog.get('clinics') or not catalog.get('services'):
+        raise ValueError(f"Catalog {path} must define clinics and services")
+    for clinic_key, clinic in catalog['clinics'].items():
+        missing = [field for field in CLINIC_FIELDS if not clinic.get(field)]
+        if missing:
+            raise ValueError(f"Clinic '{clinic_key}' in {path} is missing {', '.join(missing)}")
+    
+    services = catalog['services']
+    catalog['default_service'] = next((service for service in services if service.get('default')), services[0])
+    catalog['services'] = {service['description']: service for service in services}
+    catalog.setdefault('treatment_plans', {})
+    catalog.setdefault('contact', {})
+    catalog.setdefault('policy', {})
+    catalog.setdefault('branding', {})
+    catalog.setdefault('practitioners', {})
+    catalog['base_dir'] = os.path.dirname(os.path.abspath(path))
+    return catalog
+
+class CatalogStore:
+    """Holds the current catalog and swaps in a freshly parsed copy when the file changes.
+    
+    Readers take one snapshot per script run via get_catalog(), so a reload
+    never changes the catalog underneath a page that is already rendering.
+    """
+    
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.catalog = load_catalog_file(self.path)
+        self.loaded_at = datetime.now()
+        self.last_error = None
+        self._observer = None
+    
+    def reload(self):
+        """Re-read the catalog file, keeping the previous catalog if it is invalid"""
+        try:
+            catalog = load_catalog_file(self.path)
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+        self.catalog = catalog
+        self.loaded_at = datetime.now()
+        self.last_error = None
+        return True
+    
+    def start_watching(self):
+        """Reload the catalog whenever the file is written, replaced or renamed into place"""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return
+        
+        store = self
+        
+        class CatalogFileHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                paths = {os.path.abspath(event.src_path), os.path.abspath(getattr(event, 'dest_path', '') or event.src_path)}
+                if store.path in paths and event.event_type in ('modified', 'created', 'moved'):
+                    store.reload()
+        
+        self._observer = Observer()
+        self._observer.schedule(CatalogFileHandler(), os.path.dirname(self.path))
+        self._observer.daemon = True
+        self._observer.start()
+
+@st.cache_resource
+def get_catalog_store():
+    """Load the catalog once per server process and start watching it for changes"""
+    store = CatalogStore(CATALOG_PATH)
+    store.start_watching()
+    return store
+
+def get_catalog():
+    """Return the current catalog snapshot"""
+    return get_catalog_store().catalog
+
+def default_session_line():
+    """Return a new session line for the catalog's default service"""
+    service = get_catalog()['default_service']
+    return {'description': service['description'], 'qty': 1, 'per_session_cost': service['per_session_cost']}
+
+def intern_descriptions(sessions):
+    """Share one string object per distinct description across session lines, in place"""
+    for session in sessions:
+        if type(session.get('description')) is str:
+            session['description'] = sys.intern(session['description'])
+    return sessions
+
+class SessionLine:
+    """One invoice line: a service, how many sessions and the cost of each.
+
+    A slotted row holds its three values without a per-line dict; to_dict()
+    and from_dict() convert to the dict form used in session state and the store.
+    """
+    __slots__ = ('description', 'qty', 'per_session_cost')
+
+    def __init__(self, description, qty=1, per_session_cost=0):
+        self.description = sys.intern(description) if type(description) is str else description
+        self.qty = qty
+        self.per_session_cost = per_session_cost
+
+    @classmethod
+    def from_dict(cls, line):
+        return cls(line['description'], line['qty'], line['per_session_cost'])
+
+    def to_dict(self):
+        return {'description': self.description, 'qty': self.qty, 'per_session_cost': self.per_session_cost}
+
+    def __getitem__(self, key):
+        """Read a field by name, so code written for line dicts also accepts rows"""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    @property
+    def total(self):
+        return self.qty * self.per_session_cost
+
+    def __eq__(self, other):
+        if not isinstance(other, SessionLine):
+            return NotImplemented
+        return (self.description, self.qty, self.per_session_cost) == (other.description, other.qty, other.per_session_cost)
+
+    def __repr__(self):
+        return f"SessionLine({self.description!r}, qty={self.qty!r}, per_session_cost={self.per_session_cost!r})"
+
+class SessionLineColumns:
+    """Session lines of many invoices stored column by column, for batch and analytics work.
+
+    Each distinct description is kept once and lines refer to it by a uint32
+    code; quantities (int32) and costs (float64) live in typed arrays. Lines
+    are grouped by invoice, so group_totals() gives per-invoice totals. Values
+    are sanitized with safe_int/safe_float on the way in, as invoice_totals does.
+    """
+
+    def __init__(self):
+        self.descriptions = []
+        self._description_codes = {}
+        self.codes = array.array('I')
+        self.qtys = array.array('i')
+        self.costs = array.array('d')
+        self.group_starts = array.array('q')
+
+    @classmethod
+    def from_records(cls, records):
+        """Build columns from invoice records, one group per record"""
+        columns = cls()
+        columns.extend_groups([record['sessions'] for record in records])
+        return columns
+
+    def extend(self, lines):
+        """Add one invoice's lines, given as dicts or SessionLine rows, as a new group"""
+        self.extend_groups([lines])
+
+    def extend_groups(self, groups):
+        """Add several invoices' lines at once, sanitizing their values in one batch"""
+        offset = len(self.codes)
+        for lines in groups:
+            self.group_starts.append(offset)
+            offset += len(lines)
+        lines = [line for lines in groups for line in lines]
+        if not lines:
+            return
+        if len(lines) < SANITIZE_BATCH_MIN_ROWS:
+            qtys = [safe_int(line['qty'], 1) for line in lines]
+            costs = [safe_float(line['per_session_cost']) for line in lines]
+        else:
+            qtys = safe_int_series([line['qty'] for line in lines], 1).to_numpy()
+            costs = safe_float_series([line['per_session_cost'] for line in lines]).to_numpy(dtype=float)
+        # Absurd quantities saturate rather than wrap around in the 32-bit column
+        self.qtys.frombytes(np.clip(np.asarray(qtys, dtype=np.float64), -2**31, 2**31 - 1).astype(np.int32).tobytes())
+        self.costs.frombytes(np.asarray(costs, dtype=np.float64).tobytes())
+        self.codes.frombytes(self._codes(np.array([line['description'] for line in lines], dtype=object)).tobytes())
+
+    def _code(self, description):
+        """Return the table code of a description, adding it on first sight"""
+        if type(description) is not str:
+            description = "" if description is None else str(description)
+        code = self._description_codes.get(description)
+        if code is None:
+            description = sys.intern(description)
+            code = self._description_codes[description] = len(self.descriptions)
+            self.descriptions.append(description)
+        return code
+
+    def _codes(self, descriptions):
+        """Map an object array of descriptions to table codes, looking up each distinct one once"""
+        codes, uniques, matched = factorize_texts(descriptions)
+        result = np.array([self._code(description) for description in uniques], dtype=np.uint32)[codes]
+        for row in np.flatnonzero(~matched):
+            result[row] = self._code(descriptions[row])
+        return result
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return SessionLine(self.descriptions[self.codes[index]], self.qtys[index], self.costs[index])
+
+    def __iter__(self):
+        descriptions = self.descriptions
+        for code, qty, cost in zip(self.codes, self.qtys, self.costs):
+            yield SessionLine(descriptions[code], qty, cost)
+
+    @property
+    def group_count(self):
+        return len(self.group_starts)
+
+    def group_bounds(self, group):
+        start = self.group_starts[group]
+        end = self.group_starts[group + 1] if group + 1 < len(self.group_starts) else len(self.codes)
+        return start, end
+
+    def to_dicts(self, start=0, end=None):
+        """Return lines start:end in the dict form used by session state and the store"""
+        end = len(self.codes) if end is None else end
+        descriptions = self.descriptions
+        return [{'description': descriptions[code], 'qty': qty, 'per_session_cost': cost}
+                for code, qty, cost in zip(self.codes[start:end], self.qtys[start:end], self.costs[start:end])]
+
+    def group_dicts(self, group):
+        """Return one invoice's lines as dicts"""
+        return self.to_dicts(*self.group_bounds(group))
+
+    def amounts(self):
+        """Line totals (qty x cost) as a float array"""
+        return np.frombuffer(self.qtys, dtype=np.int32) * np.frombuffer(self.costs, dtype=np.float64)
+
+    def group_index(self):
+        """The group number of every line"""
+        starts = np.frombuffer(self.group_starts, dtype=np.int64)
+        return np.repeat(np.arange(len(starts)), np.diff(starts, append=len(self.codes)))
+
+    def group_totals(self):
+        """The session total of every group as a float array"""
+        return np.bincount(self.group_index(), weights=self.amounts(), minlength=len(self.group_starts))
+
+    def group_sessions(self):
+        """The number of sessions (sum of quantities) in every group as an int array"""
+        sessions = np.bincount(self.group_index(), weights=np.frombuffer(self.qtys, dtype=np.int32), minlength=len(self.group_starts))
+        return sessions.astype(np.int64)
+
+    def description_totals(self):
+        """Sessions and amount billed per description, as {description: (sessions, amount)}"""
+        codes = np.frombuffer(self.codes, dtype=np.uint32)
+        sessions = np.bincount(codes, weights=np.frombuffer(self.qtys, dtype=np.int32), minlength=len(self.descriptions))
+        amounts = np.bincount(codes, weights=self.amounts(), minlength=len(self.descriptions))
+        return {description: (int(sessions[code]), float(amounts[code]))
+                for code, description in enumerate(self.descriptions)}
+
+    def nbytes(self):
+        """Approximate memory held by the columns and the description table"""
+        return (sum(column.buffer_info()[1] * column.itemsize for column in (self.codes, self.qtys, self.costs, self.group_starts)) +
+                sum(sys.getsizeof(description) for description in self.descriptions) +
+                sys.getsizeof(self.descriptions) + sys.getsizeof(self._description_codes))
+
+def default_practitioner(clinic_location):
+    """Return the practitioner who signs invoices for a clinic by default"""
+    catalog = get_catalog()
+    clinic = catalog['clinics'].get(clinic_location, {})
+    return clinic.get('practitioner') or catalog['contact'].get('doctor', '')
+
+def clinic_details(clinic_location):
+    """Return a clinic's catalog entry, or one naming just the location once it is no longer in the catalog"""
+    clinic = get_catalog()['clinics'].get(clinic_location)
+    if clinic is None:
+        # Stored invoices keep only the location, so a renamed or removed clinic shows that
+        clinic = {field: clinic_location for field in CLINIC_FIELDS}
+    return clinic
+
+def resolve_branding_spec(clinic_location, practitioner=None):
+    """Merge default, clinic and practitioner branding settings from the catalog"""
+    catalog = get_catalog()
+    practitioner = practitioner or default_practitioner(clinic_location)
+    practitioner_info = catalog['practitioners'].get(practitioner, {})
+    spec = {'logo': None, 'watermark': None, 'signature': None,
+            'primary_color': DEFAULT_PRIMARY_COLOR, 'accent_color': DEFAULT_ACCENT_COLOR}
+    spec.update(catalog['branding'])
+    spec.update(catalog['clinics'].get(clinic_location, {}).get('branding', {}))
+    spec.update(practitioner_info.get('branding', {}))
+    if practitioner_info.get('signature'):
+        spec['signature'] = practitioner_info['signature']
+    for asset in ('logo', 'watermark', 'signature'):
+        if spec[asset]:
+            spec[asset] = os.path.join(catalog['base_dir'], spec[asset])
+    spec['practitioner'] = practitioner
+    spec['registration'] = practitioner_info.get('registration') or catalog['contact'].get('registration', '')
+    return spec
+
+class BrandingCache:
+    """Keyed LRU cache of branding bundles, one per clinic / practitioner pair.
+    
+    Each image file is read once and shared by every bundle that uses it;
+    images are released when the last bundle using them is evicted.
+    """
+    
+    def __init__(self, max_bundles=BRANDING_CACHE_SIZE):
+        self.max_bundles = max_bundles
+        self._lock = threading.Lock()
+        self._bundles = OrderedDict()
+        self._images = {}
+    
+    def _load_image(self, path, fallback_loader):
+        if not path:
+            return fallback_loader()
+        if path not in self._images:
+            try:
+                with open(path, "rb") as img_file:
+                    self._images[path] = base64.b64encode(img_file.read()).decode()
+            except OSError:
+                self._images[path] = fallback_loader()
+        return self._images[path]
+    
+    def get(self, clinic_location, practitioner=None):
+        """Return the branding bundle for a clinic and practitioner, loading it on first use"""
+        spec = resolve_branding_spec(clinic_location, practitioner)
+        key = (clinic_location, spec['practitioner'])
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is None or bundle['spec'] != spec:
+                bundle = {
+                    'spec': spec,
+                    'practitioner': spec['practitioner'],
+                    'registration': spec['registration'],
+                    'primary_color': spec['primary_color'],
+                    'accent_color': spec['accent_color'],
+                    'logo_b64': self._load_image(spec['logo'], load_logo_as_base64),
+                    'watermark_b64': self._load_image(spec['watermark'], load_watermark_as_base64),
+                    'signature_b64': self._load_image(spec['signature'], load_signature_as_base64)
+                }
+                self._bundles[key] = bundle
+                while len(self._bundles) > self.max_bundles:
+                    self._bundles.popitem(last=False)
+                self._release_unused_images()
+            self._bundles.move_to_end(key)
+            return bundle
+    
+    def _release_unused_images(self):
+        in_use = {bundle['spec'][asset] for bundle in self._bundles.values() for asset in ('logo', 'watermark', 'signature')}
+        for path in [path for path in self._images if path not in in_use]:
+            del self._images[path]
+    
+    def stats(self):
+        """Report the image memory referenced by each loaded bundle and in total"""
+        with self._lock:
+            bundles = []
+            unique_images = {}
+            for (clinic_location, practitioner), bundle in self._bundles.items():
+                images = [bundle[field] for field in ('logo_b64', 'watermark_b64', 'signature_b64') if bundle[field]]
+                for image in images:
+                    unique_images[id(image)] = sys.getsizeof(image)
+                bundles.append({
+                    'clinic_location': clinic_location,
+                    'practitioner': practitioner,
+                    'bytes': sum(sys.getsizeof(image) for image in images)
+                })
+            return {'bundles': bundles, 'total_bytes': sum(unique_images.values())}
+
+@st.cache_resource
+def get_branding_cache():
+    """Share one branding cache across all sessions in the server process"""
+    return BrandingCache()
+
+def shared_cache_key(*parts):
+    """Hash everything a cached value depends on into a shared cache key"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+class SharedCache:
+    """Two-tier cache of derived bytes: an in-process LRU in front of a SQLite file shared by every process.
+    
+    Values are kept zlib-compressed under (namespace, key) in the shared tier,
+    so a value computed by one server process or job worker is a hit in all
+    the others, and survives restarts. Each namespace counts its memory hits,
+    shared hits and misses. Cache errors are logged and treated as misses.
+    """
+    
+    def __init__(self, path=SHARED_CACHE_PATH, max_bytes=SHARED_CACHE_MAX_BYTES,
+                 memory_entries=SHARED_CACHE_MEMORY_ENTRIES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._conn = None
+        self._writes = 0
+        self.counters = {}
+        self.warmed = {'loaded': 0, 'rendered': 0}
+    
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_used ON entries (used_at)")
+            self._conn = conn
+        return self._conn
+    
+    def _remember(self, entry_key, value):
+        self._memory[entry_key] = value
+        self._memory.move_to_end(entry_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+    
+    def _count(self, namespace, tier):
+        counters = self.counters.setdefault(namespace, {'memory': 0, 'shared': 0, 'misses': 0})
+        counters[tier] += 1
+    
+    def get(self, namespace, key):
+        """Return the cached bytes for a key from the nearest tier that has them, or None"""
+        with self._lock:
+            value = self._memory.get((namespace, key))
+            if value is not None:
+                self._memory.move_to_end((namespace, key))
+                self._count(namespace, 'memory')
+                return value
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT value, used_at FROM entries WHERE namespace = ? AND key = ?",
+                                   (namespace, key)).fetchone()
+                if row is not None and row[1] < time.time() - SHARED_CACHE_TOUCH_SECONDS:
+                    conn.execute("UPDATE entries SET used_at = ? WHERE namespace = ? AND key = ?",
+                                 (time.time(), namespace, key))
+            except sqlite3.Error as e:
+                print(f"Shared cache read failed: {e}", file=sys.stderr)
+                row = None
+            if row is None:
+                self._count(namespace, 'misses')
+                return None
+            value = zlib.decompress(row[0])
+            self._remember((namespace, key), value)
+            self._count(namespace, 'shared')
+            return value
+    
+    def contains(self, namespace, key):
+        """Whether either tier holds a key, without counting a hit or miss"""
+        with self._lock:
+            if (namespace, key) in self._memory:
+                return True
+            try:
+                return self._connect().execute("SELECT 1 FROM entries WHERE namespace = ? AND key = ?",
+                                               (namespace, key)).fetchone() is not None
+            except sqlite3.Error:
+                return False
     
-    for pattern in phone_patterns:
-        match = re.search(pattern, text_content)
-        if match:
-            phone = match.group(1).strip()
-            if phone.startswith('+91') and len(re.sub(r'\D', '', phone)) >= 12:
-                digits = re.sub(r'\D', '', phone)[2:]
-                if len(digits) == 10:
-                    return f"+91 {digits}"
-                elif len(digits) > 10:
-                    return f"+91 {digits[:10]}"
+    def put(self, namespace, key, value):
+        """Store bytes in both tiers"""
+        compressed = zlib.compress(value, 6)
+        with self._lock:
+            self._remember((namespace, key), value)
+            try:
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO entries (namespace, key, value, size, used_at) VALUES (?, ?, ?, ?, ?)",
+                    (namespace, key, compressed, len(compressed), time.time())
+                )
+                self._writes += 1
+                if self._writes % SHARED_CACHE_PRUNE_WRITES == 0:
+                    self._prune()
+            except sqlite3.Error as e:
+                print(f"Shared cache write failed: {e}", file=sys.stderr)
+    
+    def _prune(self):
+        """Delete the least recently used entries until the shared tier is under 80% of max_bytes"""
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for namespace, key, size in conn.execute("SELECT namespace, key, size FROM entries ORDER BY used_at"):
+            if total <= self.max_bytes * 0.8:
+                break
+            expired.append((namespace, key))
+            total -= size
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", expired)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
     
-    return "+91 "
+    def load_recent(self, limit=SHARED_CACHE_WARM_ENTRIES):
+        """Copy the most recently used shared entries into memory, returning how many were loaded"""
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    "SELECT namespace, key, value FROM entries ORDER BY used_at DESC LIMIT ?", (limit,)
+                ).fetchall()
+            except sqlite3.Error as e:
+                print(f"Shared cache warm-up failed: {e}", file=sys.stderr)
+                return 0
+            for namespace, key, value in reversed(rows):
+                if (namespace, key) not in self._memory:
+                    self._remember((namespace, key), zlib.decompress(value))
+            return len(rows)
+    
+    def stats(self):
+        """Report hits per tier and misses for each namespace, and the shared tier's size"""
+        with self._lock:
+            try:
+                entries, stored_bytes = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            except sqlite3.Error:
+                entries, stored_bytes = 0, 0
+            return {'namespaces': {namespace: dict(counters) for namespace, counters in self.counters.items()},
+                    'memory_entries': len(self._memory), 'shared_entries': entries,
+                    'shared_bytes': stored_bytes, 'warmed': dict(self.warmed)}
+
+def warm_shared_cache(cache):
+    """Fill a new process's memory tier from the shared tier, then render the latest invoices still missing"""
+    cache.warmed['loaded'] = cache.load_recent()
+    conn = open_invoice_db()
+    try:
+        invoice_nos = [row['invoice_no'] for row in conn.execute(
+            "SELECT invoice_no FROM invoices ORDER BY saved_at DESC LIMIT ?", (SHARED_CACHE_WARM_INVOICES,))]
+    finally:
+        conn.close()
+    for record in get_invoice_records(invoice_nos):
+        data = build_invoice_data(record['form_data'])
+        total_amount = sum(session['qty'] * session['per_session_cost'] for session in record['sessions'])
+        key, placeholder_urls, _ = invoice_html_cache_entry(data, record['sessions'], total_amount)
+        if not cache.contains('html', key):
+            cache.put('html', key, render_invoice_html(data, record['sessions'], total_amount, placeholder_urls).encode())
+            cache.warmed['rendered'] += 1
+
+@st.cache_resource
+def get_shared_cache():
+    """Return the process's view of the shared cache, warming it in the background on first use"""
+    cache = SharedCache()
+    threading.Thread(target=warm_shared_cache, args=(cache,), name="cache-warm", daemon=True).start()
+    return cache
+
+def detect_clinic_location(text_content):
+    """Match a catalog clinic from the address text on an invoice"""
+    for clinic_key in get_catalog()['clinics']:
+        if any(part.strip() in text_content for part in clinic_key.split(',')):
+            return clinic_key
+    return None
 
 def initialize_session_state():
     """Initialize all session state variables with proper defaults"""
@@ -197,17 +1116,28 @@ def initialize_session_state():
     if 'invoice_data' not in st.session_state:
         st.session_state.invoice_data = {}
     if 'sessions' not in st.session_state:
-        st.session_state.sessions = [{'description': '60 Mins Physiotherapy Session', 'qty': 1, 'per_session_cost': 500}]
+        st.session_state.sessions = [default_session_line()]
     if 'uploaded_invoice_data' not in st.session_state:
         st.session_state.uploaded_invoice_data = None
     if 'edit_mode' not in st.session_state:
         st.session_state.edit_mode = False
     
+    if 'edit_original' not in st.session_state:
+        st.session_state.edit_original = None
+    
+    if 'replaces_invoice_no' not in st.session_state:
+        st.session_state.replaces_invoice_no = None
+    
+    if 'suggested_invoice_no' not in st.session_state:
+        st.session_state.suggested_invoice_no = None
+    
     if 'form_data' not in st.session_state:
+        st.session_state.suggested_invoice_no = next_invoice_number()
         st.session_state.form_data = {
-            'invoice_no': "PAL-PT-2026-001",
+            'invoice_no': st.session_state.suggested_invoice_no,
             'invoice_date': datetime.now().date(),
-            'clinic_location': "Vittal Rao Nagar, Madhapur",
+            'clinic_location': next(iter(get_catalog()['clinics'])),
+            'practitioner': "",
             'patient_name': "",
             'patient_sex': "Male",
             'patient_age': "",
@@ -219,19 +1149,285 @@ def initialize_session_state():
             'session_end_date': datetime.now().date()
         }
 
-def extract_text_from_uploaded_pdf(uploaded_file):
-    """Extract text content from uploaded PDF file"""
+def estimate_object_bytes(value, seen=None):
+    """Approximate the memory held by a value and the containers and strings inside it"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_object_bytes(key, seen) + estimate_object_bytes(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_object_bytes(item, seen) for item in value)
+    return size
+
+def enforce_session_memory_cap():
+    """Drop transient entries while this session's state is over SESSION_STATE_MAX_BYTES.
+    
+    An entry is only dropped on pages that do not use it. Returns the state
+    size after any cleanup.
+    """
+    state_bytes = estimate_object_bytes(st.session_state.to_dict())
+    for key, needed_on in SESSION_TRANSIENT_KEYS.items():
+        if state_bytes <= SESSION_STATE_MAX_BYTES:
+            break
+        if st.session_state.get(key) is not None and st.session_state.page != needed_on:
+            state_bytes -= estimate_object_bytes(st.session_state[key])
+            st.session_state[key] = None
+    return state_bytes
+
+class SessionMonitor:
+    """Tracks rerun count, CPU time and state size for every browser session.
+    
+    Sessions idle for SESSION_IDLE_SECONDS have their state cleared; Streamlit
+    itself only drops a session once its websocket has been closed for a
+    while, so an open but abandoned tab would otherwise hold its invoices
+    forever. Session state is referenced weakly so the monitor never keeps a
+    closed session alive.
+    """
+    
+    def __init__(self, idle_seconds=SESSION_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._last_sweep = time.monotonic()
+        self.sessions_reset = 0
+    
+    def record(self, session_id, session_state, usage):
+        """Note a finished rerun, then reset idle sessions if a sweep is due"""
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = (weakref.ref(session_state), usage, now)
+            if now - self._last_sweep < min(SESSION_SWEEP_SECONDS, self.idle_seconds / 2):
+                return
+            self._last_sweep = now
+            idle = [(key, ref) for key, (ref, _, last_active) in self._sessions.items()
+                    if key != session_id and now - last_active > self.idle_seconds]
+            for key, _ in idle:
+                del self._sessions[key]
+            for key in [key for key, (ref, _, _) in self._sessions.items() if ref() is None]:
+                del self._sessions[key]
+        for _, ref in idle:
+            state = ref()
+            if state is not None:
+                for key in list(state.filtered_state):
+                    del state[key]
+                state['session_expired'] = True
+                self.sessions_reset += 1
+    
+    def stats(self):
+        """Report live session count, total state size and CPU time per rerun"""
+        with self._lock:
+            usages = [usage for ref, usage, _ in self._sessions.values() if ref() is not None]
+        reruns = sum(usage['reruns'] for usage in usages)
+        return {
+            'sessions': len(usages),
+            'state_bytes': sum(usage['state_bytes'] for usage in usages),
+            'cpu_ms_per_rerun': sum(usage['cpu_seconds'] for usage in usages) / reruns * 1000 if reruns else 0.0,
+            'sessions_reset': self.sessions_reset
+        }
+
+@st.cache_resource
+def get_session_monitor():
+    """Share one session monitor across all sessions in the server process"""
+    return SessionMonitor()
+
+def record_session_usage(cpu_started, wall_started):
+    """Add this rerun's CPU and wall time to the session's usage and report it to the monitor"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    usage = st.session_state.get('session_usage') or {'reruns': 0, 'cpu_seconds': 0.0, 'wall_seconds': 0.0, 'state_bytes': 0}
+    usage['reruns'] += 1
+    usage['cpu_seconds'] += time.thread_time() - cpu_started
+    usage['wall_seconds'] += time.perf_counter() - wall_started
+    st.session_state.session_usage = usage
+    usage['state_bytes'] = enforce_session_memory_cap()
+    # The SafeSessionState wrapper is recreated for every script run; keep the state it wraps
+    get_session_monitor().record(ctx.session_id, ctx.session_state._state, usage)
+
+def uploaded_pdf_size_ok(uploaded_file):
+    """Check an uploaded PDF against MAX_UPLOAD_BYTES, showing an error when it is too large"""
+    file_size = getattr(uploaded_file, 'size', None)
+    if file_size is None:
+        uploaded_file.seek(0, os.SEEK_END)
+        file_size = uploaded_file.tell()
+    if file_size > MAX_UPLOAD_BYTES:
+        st.error(f"PDF is too large ({file_size / (1024 * 1024):.1f} MB). Invoices must be under {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+        return False
+    return True
+
+def uploaded_pdf_pages_ok(page_count):
+    """Check an uploaded PDF against MAX_PDF_PAGES, showing an error when it has too many pages"""
+    if page_count > MAX_PDF_PAGES:
+        st.error(f"PDF has {page_count} pages. Invoices must have at most {MAX_PDF_PAGES} pages.")
+        return False
+    return True
+
+def extract_invoice_layout(uploaded_file, max_pages=MAX_EXTRACT_PAGES):
+    """Extract (text from the first pages, words per page) from an uploaded PDF.
+    
+    Words are PyMuPDF (x0, y0, x1, y1, word, block, line, word number) tuples,
+    which parse_session_table reads the sessions table from by position. The
+    text is rebuilt from the same words, one line per PDF text line. Without
+    PyMuPDF this falls back to extract_text_from_uploaded_pdf and no words.
+    """
+    try:
+        import fitz
+    except ImportError:
+        return extract_text_from_uploaded_pdf(uploaded_file, max_pages), None
+    
+    try:
+        if not uploaded_pdf_size_ok(uploaded_file):
+            return None, None
+        uploaded_file.seek(0)
+        # UploadedFile is a BytesIO over the upload's bytes; getvalue() hands those bytes back
+        # without a copy, where getbuffer() makes the buffer unshare and copy the whole file
+        data = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+        with fitz.open(stream=data, filetype="pdf") as document:
+            if not uploaded_pdf_pages_ok(document.page_count):
+                return None, None
+            # Every page is read for words, since a long sessions table runs past the first pages
+            page_words = [page.get_text("words") for page in document]
+        text_lines = []
+        text_length = 0
+        for words in page_words[:max_pages]:
+            for _, line_words in itertools.groupby(words, key=lambda word: (word[5], word[6])):
+                text_lines.append(' '.join(word[4] for word in line_words))
+                text_length += len(text_lines[-1]) + 1
+            if text_length >= MAX_EXTRACT_CHARS:
+                break
+        return "\n".join(text_lines)[:MAX_EXTRACT_CHARS] + "\n", page_words
+    except Exception as e:
+        st.error(f"Error reading PDF: {str(e)}")
+        return None, None
+
+def parse_session_table(page_words):
+    """Read session lines from the sessions table by column position, or return None if it is not found.
+    
+    On each page the "Description ... QTY" header row fixes the columns. Below
+    it, lines run together into rows until a gap the height of cell padding.
+    A row holds a number in the S.No column plus description lines, and the
+    table ends at the first group that is not a row (a "Carried forward" or
+    total row). Any row whose quantity or cost does not parse gives None, so
+    flattened text falls back to the regexes.
+    """
+    sessions = []
+    for words in page_words:
+        header = None
+        for word in words:
+            if word[4].upper() == 'QTY':
+                middle = (word[1] + word[3]) / 2
+                line = sorted((other for other in words if abs((other[1] + other[3]) / 2 - middle) < (word[3] - word[1]) / 2),
+                              key=lambda other: other[0])
+                if any(other[4].lower() == 'description' for other in line):
+                    header = line
+                    break
+        if header is None:
+            continue
+        
+        # Split the header into S.No / Description / QTY / Per Session Cost / Total labels
+        starts = {}
+        for index, word in enumerate(header):
+            label = word[4].lower()
+            for column, keywords in (('description', ('description',)), ('qty', ('qty',)),
+                                     ('cost', ('per', 'rate', 'cost')), ('total', ('total', 'amount'))):
+                if label in keywords and column not in starts:
+                    starts[column] = index
+        if list(starts) != ['description', 'qty', 'cost', 'total']:
+            continue
+        # Headers sit at the left of their cells like the cells' text, except Total, which is right-aligned
+        # like its amounts: a word belongs to the last column whose header starts left of it, or to Total
+        # when its centre is past the gap between the cost and total headers
+        tolerance = (header[0][3] - header[0][1]) / 2
+        column_starts = [header[starts[column]][0] - tolerance for column in ('description', 'qty', 'cost')]
+        total_from = (header[starts['total'] - 1][2] + header[starts['total']][0]) / 2
+        header_bottom = max(word[3] for word in header)
+        
+        lines = []
+        for word in sorted((word for word in words if word[1] >= header_bottom - 1), key=lambda word: (word[1], word[0])):
+            middle = (word[1] + word[3]) / 2
+            if lines and middle - lines[-1]['middle'] < (word[3] - word[1]) / 2:
+                lines[-1]['words'].append(word)
+                lines[-1]['bottom'] = max(lines[-1]['bottom'], word[3])
+            else:
+                lines.append({'middle': middle, 'top': word[1], 'bottom': word[3], 'words': [word]})
+        
+        # Table rows are separated by cell padding, so split the lines into groups at vertical gaps
+        groups = []
+        for line in lines:
+            if groups and line['top'] - groups[-1][-1]['bottom'] < (line['bottom'] - line['top']) / 2:
+                groups[-1].append(line)
+            else:
+                groups.append([line])
+        
+        page_rows = []
+        for group in groups:
+            group_rows = []
+            leading = []
+            for line in group:
+                cells = [[] for _ in range(5)]
+                for word in line['words']:
+                    column = 4 if (word[0] + word[2]) / 2 > total_from else bisect.bisect(column_starts, word[0])
+                    cells[column].append(word[4])
+                cells = [' '.join(cell) for cell in cells]
+                if cells[0].isdigit():
+                    # Numbers sit at the middle of a row, so description lines above them belong to it too
+                    qty = cells[2].replace(',', '')
+                    cost = cells[3].replace('₹', '').replace(',', '').strip()
+                    if not qty.isdigit() or not re.fullmatch(r'\d+(?:\.\d+)?', cost):
+                        return None
+                    group_rows.append({'description': ' '.join(leading + [cells[1]]), 'qty': int(qty),
+                                       'per_session_cost': safe_int(float(cost))})
+                    leading = []
+                elif cells[1] and not any(cells[column] for column in (0, 2, 3, 4)):
+                    if group_rows:
+                        group_rows[-1]['description'] += ' ' + cells[1]
+                    else:
+                        leading.append(cells[1])
+                else:
+                    group_rows = []
+                    break
+            if group_rows:
+                page_rows.extend(group_rows)
+            elif page_rows:
+                # The "Carried forward" or total row, or whatever follows the table
+                break
+        sessions.extend(page_rows)
+    
+    for session in sessions:
+        session['description'] = sys.intern(' '.join(session['description'].split()))
+        if not session['description']:
+            return None
+    return sessions or None
+
+def extract_text_from_uploaded_pdf(uploaded_file, max_pages=MAX_EXTRACT_PAGES):
+    """Extract text from the first pages of an uploaded PDF without copying the upload"""
     try:
         import PyPDF2
-        from io import BytesIO
         
-        pdf_reader = PyPDF2.PdfReader(BytesIO(uploaded_file.read()))
-        text_content = ""
+        if not uploaded_pdf_size_ok(uploaded_file):
+            return None
         
-        for page in pdf_reader.pages:
-            text_content += page.extract_text() + "\n"
+        # UploadedFile is already an in-memory buffer, so read it in place
+        uploaded_file.seek(0)
+        pdf_reader = PyPDF2.PdfReader(uploaded_file)
         
-        return text_content
+        page_count = len(pdf_reader.pages)
+        if not uploaded_pdf_pages_ok(page_count):
+            return None
+        
+        text_parts = []
+        text_length = 0
+        for page_index in range(min(page_count, max_pages)):
+            page_text = pdf_reader.pages[page_index].extract_text() or ""
+            text_parts.append(page_text[:MAX_EXTRACT_CHARS - text_length])
+            text_length += len(text_parts[-1])
+            if text_length >= MAX_EXTRACT_CHARS:
+                break
+        
+        return "\n".join(text_parts) + "\n"
     except ImportError:
         st.error("PyPDF2 library not available. PDF text extraction disabled.")
         return None
@@ -239,8 +1435,12 @@ def extract_text_from_uploaded_pdf(uploaded_file):
         st.error(f"Error reading PDF: {str(e)}")
         return None
 
-def parse_invoice_data_from_text(text_content):
-    """Parse invoice data from extracted PDF text with improved field extraction and session parsing"""
+def parse_invoice_data_from_text(text_content, page_words=None):
+    """Parse invoice data from extracted PDF text with improved field extraction and session parsing.
+    
+    With `page_words` from extract_invoice_layout, sessions are read from the
+    table layout and the regexes are only the fallback.
+    """
     if not text_content:
         return None
     
@@ -248,7 +1448,8 @@ def parse_invoice_data_from_text(text_content):
         parsed_data = {
             'invoice_no': "",
             'invoice_date': datetime.now().date(),
-            'clinic_location': "Vittal Rao Nagar, Madhapur",
+            'clinic_location': next(iter(get_catalog()['clinics'])),
+            'practitioner': "",
             'patient_name': "",
             'patient_sex': "Male",
             'patient_age': "",
@@ -260,13 +1461,13 @@ def parse_invoice_data_from_text(text_content):
             'session_end_date': datetime.now().date()
         }
         
-        parsed_sessions = []
+        default_cost = get_catalog()['default_service']['per_session_cost']
         
-        # Extract invoice number
+        # Extract invoice number; numbers run past three digits after the 999th invoice of a year
         invoice_patterns = [
-            r'Invoice number:\s*(PAL-PT-\d{4}-\d{3})',
-            r'Invoice No:\s*(PAL-PT-\d{4}-\d{3})',
-            r'(PAL-PT-\d{4}-\d{3})'
+            r'Invoice number:\s*(PAL-PT-\d{4}-\d{3,})\b',
+            r'Invoice No:\s*(PAL-PT-\d{4}-\d{3,})\b',
+            r'\b(PAL-PT-\d{4}-\d{3,})\b'
         ]
         for pattern in invoice_patterns:
             match = re.search(pattern, text_content)
@@ -338,10 +1539,14 @@ def parse_invoice_data_from_text(text_content):
             parsed_data['mode_of_treatment'] = mode_match.group(1)
         
         # Extract clinic location
-        if "Sri Ramnagar" in text_content or "Kondapur" in text_content:
-            parsed_data['clinic_location'] = "Sri Ramnagar, Kondapur"
-        elif "Vittal Rao Nagar" in text_content or "Madhapur" in text_content:
-            parsed_data['clinic_location'] = "Vittal Rao Nagar, Madhapur"
+        clinic_location = detect_clinic_location(text_content)
+        if clinic_location:
+            parsed_data['clinic_location'] = clinic_location
+        
+        # Extract practitioner
+        doctor_match = re.search(r'Doctor:\s*([^\n]+)', text_content)
+        if doctor_match and clean_text_field(doctor_match.group(1), 50) in get_catalog()['practitioners']:
+            parsed_data['practitioner'] = clean_text_field(doctor_match.group(1), 50)
         
         # Extract invoice date
         date_match = re.search(r'Date:\s*(\d{2}/\d{2}/\d{4})', text_content)
@@ -366,37 +1571,39 @@ def parse_invoice_data_from_text(text_content):
             except:
                 pass
         
-        # Extract session details from table
-        session_patterns = [
-            r'(\d+)\s+((?:\d+\s*)?Mins?\s+[^\d\n₹]+?(?:Session|Therapy))\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)\s+₹([\d,]+(?:\.\d{2})?)',
-            r'(\d+)\s+([^\n₹]+?(?:Physiotherapy|Session|Therapy)[^\n₹]*?)\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)',
-            r'(\d+)\s+([^₹\n]+?)\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)\s+₹([\d,]+(?:\.\d{2})?)'
-        ]
-        
-        session_matches = []
-        for pattern in session_patterns:
-            matches = re.findall(pattern, text_content, re.MULTILINE)
-            if matches:
-                session_matches = matches
-                break
-        
-        for match in session_matches:
-            try:
-                raw_description = match[1].strip()
-                description = ' '.join(raw_description.split())
-                if description and len(description) > 3:
-                    session = {
-                        'description': description,
-                        'qty': safe_int(match[2], 1),
-                        'per_session_cost': safe_int(safe_float(match[3].replace(',', ''), 500))
-                    }
-                    parsed_sessions.append(session)
-            except Exception:
-                continue
+        # Extract session details from table, by column position when the words' boxes are known
+        parsed_sessions = (parse_session_table(page_words) if page_words else None) or []
+        if not parsed_sessions:
+            session_patterns = [
+                r'(\d+)\s+((?:\d+\s*)?Mins?\s+[^\d\n₹]+?(?:Session|Therapy))\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)\s+₹([\d,]+(?:\.\d{2})?)',
+                r'(\d+)\s+([^\n₹]+?(?:Physiotherapy|Session|Therapy)[^\n₹]*?)\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)',
+                r'(\d+)\s+([^₹\n]+?)\s+(\d+)\s+₹([\d,]+(?:\.\d{2})?)\s+₹([\d,]+(?:\.\d{2})?)'
+            ]
+            
+            session_matches = []
+            for pattern in session_patterns:
+                matches = re.findall(pattern, text_content, re.MULTILINE)
+                if matches:
+                    session_matches = matches
+                    break
+            
+            for match in session_matches:
+                try:
+                    raw_description = match[1].strip()
+                    description = ' '.join(raw_description.split())
+                    if description and len(description) > 3:
+                        session = {
+                            'description': sys.intern(description),
+                            'qty': safe_int(match[2], 1),
+                            'per_session_cost': safe_int(safe_float(match[3].replace(',', ''), default_cost))
+                        }
+                        parsed_sessions.append(session)
+                except Exception:
+                    continue
         
         # If no sessions found, add default
         if not parsed_sessions:
-            parsed_sessions = [{'description': '60 Mins Physiotherapy Session', 'qty': 1, 'per_session_cost': 500}]
+            parsed_sessions = [default_session_line()]
         
         return {'form_data': parsed_data, 'sessions': parsed_sessions}
         
@@ -404,59 +1611,1372 @@ def parse_invoice_data_from_text(text_content):
         st.error(f"Error parsing invoice data: {str(e)}")
         return None
 
-def load_logo_as_base64():
-    """Load logo and convert to base64"""
-    logo_paths = [
-        "pal_logo.png",
-        "pal_logo_full.png",
-        "assets/pal_logo.png",
-        "images/pal_logo.png"
-    ]
-    for path in logo_paths:
-        try:
-            if os.path.exists(path):
-                with open(path, "rb") as img_file:
-                    return base64.b64encode(img_file.read()).decode()
-        except:
-            continue
-    return None
+def parse_invoice_pdf(pdf_file):
+    """Extract and parse an invoice PDF, returning (text, parsed data) as the two steps would.
+    
+    Results are kept in the shared cache under the PDF's content hash, so any
+    process that has read the same file today answers without opening it
+    (fields missing from a PDF default to today's date). On a hit the text is
+    the stored extraction.
+    """
+    if not uploaded_pdf_size_ok(pdf_file):
+        return None, None
+    pdf_file.seek(0)
+    data = pdf_file.getvalue() if hasattr(pdf_file, 'getvalue') else pdf_file.read()
+    catalog = get_catalog()
+    key = shared_cache_key(PARSE_CACHE_VERSION, hashlib.sha1(data).hexdigest(), datetime.now().date(),
+                           list(catalog['clinics']), catalog['default_service'], list(catalog['practitioners']))
+    cache = get_shared_cache()
+    cached = cache.get('parse', key)
+    if cached is not None:
+        cached = json.loads(cached)
+        parsed = {'form_data': deserialize_form_data(cached['form_data']), 'sessions': intern_descriptions(cached['sessions'])}
+        return cached['text'], parsed
+    
+    text_content, page_words = extract_invoice_layout(pdf_file if hasattr(pdf_file, 'getvalue') else io.BytesIO(data))
+    parsed = parse_invoice_data_from_text(text_content, page_words) if text_content else None
+    if parsed is not None:
+        cache.put('parse', key, json.dumps({'text': text_content, 'form_data': serialize_form_data(parsed['form_data']),
+                                            'sessions': parsed['sessions']}).encode('utf-8'))
+    return text_content, parsed
 
-def load_watermark_as_base64():
-    """Load watermark image and convert to base64"""
-    watermark_paths = [
-        "pal_logo_icon.png",
-        "watermark_logo.png",
-        "pal_pal_logo_icon.png",
-        "assets/pal_logo_icon.png",
-        "images/pal_logo_icon.png"
-    ]
-    for path in watermark_paths:
-        try:
-            if os.path.exists(path):
-                with open(path, "rb") as img_file:
-                    return base64.b64encode(img_file.read()).decode()
-        except:
-            continue
-    return None
+def open_invoice_db():
+    """Open a connection to the local invoice store, creating it if needed"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(INVOICE_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # The search index and the patient registry follow invoices by id; as an explicit
+    # INTEGER PRIMARY KEY it survives VACUUM, and AUTOINCREMENT never hands out a used one again
+    conn.execute(INVOICES_TABLE_SQL.format(table="invoices"))
+    ensure_invoice_ids(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices (invoice_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_clinic_date ON invoices (clinic_location, invoice_date)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS invoice_sequences (
+            prefix TEXT PRIMARY KEY,
+            last_number INTEGER NOT NULL
+        )
+    """)
+    ensure_invoice_search_index(conn)
+    ensure_receivables_tables(conn)
+    ensure_statement_tables(conn)
+    return conn
 
-def get_fallback_logo():
-    """SVG fallback logo"""
-    svg_logo = """
-    <svg width="200" height="200" viewBox="0 0 200 200" xmlns="http://www.w3.org/2000/svg">
-        <defs>
-            <linearGradient id="grad1" x1="0%" y1="0%" x2="100%" y2="100%">
-                <stop offset="0%" style="stop-color:#30b392;stop-opacity:1" />
-                <stop offset="100%" style="stop-color:#27ae60;stop-opacity:1" />
-            </linearGradient>
-        </defs>
-        <circle cx="100" cy="100" r="80" fill="url(#grad1)"/>
-        <path d="M 70 100 L 90 120 L 130 70" stroke="white" stroke-width="12" fill="none" stroke-linecap="round"/>
-        <text x="100" y="180" text-anchor="middle" fill="white" font-size="24" font-weight="bold">PAL</text>
-    </svg>
-    """
-    return f"data:image/svg+xml;base64,{base64.b64encode(svg_logo.encode()).decode()}"
+INVOICES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_no TEXT NOT NULL UNIQUE,
+        invoice_date TEXT NOT NULL,
+        clinic_location TEXT NOT NULL,
+        patient_name TEXT NOT NULL,
+        patient_phone TEXT NOT NULL,
+        form_data TEXT NOT NULL,
+        sessions TEXT NOT NULL,
+        total_amount REAL NOT NULL,
+        saved_at TEXT NOT NULL
+    )
+"""
 
-def load_signature_as_base64():
+def ensure_invoice_ids(conn):
+    """Rebuild an invoices table keyed only by invoice_no with an id column, keeping each row's rowid"""
+    if any(column['name'] == 'id' for column in conn.execute("PRAGMA table_info(invoices)")):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if any(column['name'] == 'id' for column in conn.execute("PRAGMA table_info(invoices)")):
+            conn.execute("ROLLBACK")
+            return
+        conn.execute(INVOICES_TABLE_SQL.format(table="invoices_with_ids"))
+        conn.execute("""
+            INSERT INTO invoices_with_ids (id, invoice_no, invoice_date, clinic_location, patient_name,
+                                           patient_phone, form_data, sessions, total_amount, saved_at)
+            SELECT rowid, invoice_no, invoice_date, clinic_location, patient_name,
+                   patient_phone, form_data, sessions, total_amount, saved_at
+            FROM invoices
+        """)
+        # Dropping the table drops its indexes and search triggers; the search index is rebuilt with them
+        conn.execute("DROP TABLE invoices")
+        conn.execute("DROP TABLE IF EXISTS invoices_fts")
+        conn.execute("ALTER TABLE invoices_with_ids RENAME TO invoices")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def ensure_invoice_search_index(conn):
+    """Create the full-text index over invoices and keep it in sync with triggers"""
+    # INSERT OR REPLACE only fires delete triggers with recursive triggers enabled
+    conn.execute("PRAGMA recursive_triggers = ON")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'invoices_fts'").fetchone():
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'invoices_fts'").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        conn.execute("""
+            CREATE VIRTUAL TABLE invoices_fts USING fts5(
+                patient_name, problem_desc, treatment_notes,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER invoices_fts_insert AFTER INSERT ON invoices BEGIN
+                INSERT INTO invoices_fts (rowid, patient_name, problem_desc, treatment_notes)
+                VALUES (new.id, new.patient_name,
+                        json_extract(new.form_data, '$.problem_desc'),
+                        json_extract(new.form_data, '$.treatment_notes'));
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER invoices_fts_delete AFTER DELETE ON invoices BEGIN
+                DELETE FROM invoices_fts WHERE rowid = old.id;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER invoices_fts_update AFTER UPDATE ON invoices BEGIN
+                UPDATE invoices_fts SET patient_name = new.patient_name,
+                    problem_desc = json_extract(new.form_data, '$.problem_desc'),
+                    treatment_notes = json_extract(new.form_data, '$.treatment_notes')
+                WHERE rowid = old.id;
+            END
+        """)
+        conn.execute("""
+            INSERT INTO invoices_fts (rowid, patient_name, problem_desc, treatment_notes)
+            SELECT id, patient_name, json_extract(form_data, '$.problem_desc'),
+                   json_extract(form_data, '$.treatment_notes')
+            FROM invoices
+        """)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def ensure_receivables_tables(conn):
+    """Create the payments table and the receivable aggregates, filling them from stored invoices.
+
+    receivables_daily holds billed and paid amounts per clinic and invoice
+    date, and patient_balances per patient, both in paise. Every invoice save
+    and payment adds its difference to them, so aging and balance reports read
+    a few thousand aggregate rows instead of scanning invoices and payments.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'patient_balances'").fetchone():
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'patient_balances'").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_no TEXT NOT NULL,
+                paid_on TEXT NOT NULL,
+                amount REAL NOT NULL,
+                method TEXT NOT NULL,
+                reference TEXT NOT NULL,
+                recorded_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_invoice ON payments (invoice_no)")
+        conn.execute("""
+            CREATE TABLE receivables_daily (
+                clinic_location TEXT NOT NULL,
+                invoice_date TEXT NOT NULL,
+                billed_paise INTEGER NOT NULL,
+                paid_paise INTEGER NOT NULL,
+                PRIMARY KEY (clinic_location, invoice_date)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE patient_balances (
+                patient_key TEXT PRIMARY KEY,
+                patient_name TEXT NOT NULL,
+                patient_phone TEXT NOT NULL,
+                billed_paise INTEGER NOT NULL,
+                paid_paise INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX idx_patient_balances_due ON patient_balances (billed_paise - paid_paise)")
+        paid = dict(conn.execute("SELECT invoice_no, SUM(amount) FROM payments GROUP BY invoice_no").fetchall())
+        apply_receivable_changes(conn, [
+            receivable_change(row, 1, paid.get(row['invoice_no'], 0))
+            for row in conn.execute(
+                "SELECT invoice_no, invoice_date, clinic_location, patient_name, patient_phone, total_amount FROM invoices")
+        ])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def to_paise(amount):
+    """Convert a rupee amount to whole paise"""
+    return int(round(safe_float(amount) * 100))
+
+def receivable_change(row, sign, paid=0):
+    """Return the aggregate change for adding (sign 1) or removing (sign -1) a stored invoice row"""
+    patient = {'patient_name': row['patient_name'], 'patient_phone': row['patient_phone']}
+    return (row['clinic_location'], row['invoice_date'], PatientRegistry.patient_key(patient),
+            row['patient_name'], row['patient_phone'], sign * to_paise(row['total_amount']), sign * to_paise(paid))
+
+def apply_receivable_changes(conn, changes):
+    """Add (clinic, date, patient key, name, phone, billed paise, paid paise) changes to the aggregates"""
+    daily = {}
+    patients = {}
+    for clinic_location, invoice_date, patient_key, patient_name, patient_phone, billed, paid in changes:
+        totals = daily.setdefault((clinic_location, invoice_date), [0, 0])
+        totals[0] += billed
+        totals[1] += paid
+        if not patient_key:
+            continue
+        # Later changes win the name and phone, so an invoice's new details replace its old ones
+        entry = patients.setdefault(patient_key, [patient_name, patient_phone, 0, 0])
+        if billed >= 0:
+            entry[0], entry[1] = patient_name, patient_phone
+        entry[2] += billed
+        entry[3] += paid
+    conn.executemany(
+        """INSERT INTO receivables_daily (clinic_location, invoice_date, billed_paise, paid_paise)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT (clinic_location, invoice_date) DO UPDATE SET
+               billed_paise = billed_paise + excluded.billed_paise,
+               paid_paise = paid_paise + excluded.paid_paise""",
+        [(clinic_location, invoice_date, billed, paid) for (clinic_location, invoice_date), (billed, paid) in daily.items()]
+    )
+    conn.executemany(
+        """INSERT INTO patient_balances (patient_key, patient_name, patient_phone, billed_paise, paid_paise)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (patient_key) DO UPDATE SET
+               patient_name = excluded.patient_name,
+               patient_phone = excluded.patient_phone,
+               billed_paise = billed_paise + excluded.billed_paise,
+               paid_paise = paid_paise + excluded.paid_paise""",
+        [(patient_key, *entry) for patient_key, entry in patients.items()]
+    )
+
+def ensure_statement_tables(conn):
+    """Create the per-patient statement aggregates, filling them from stored invoices.
+
+    patient_invoices lists each patient's invoices in date order, and
+    patient_services sums their session lines per month and description, both
+    in paise. Invoice saves and payments keep them current, so a statement
+    reads one patient's rows by primary key however long their history is.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'patient_services'").fetchone():
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'patient_services'").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        conn.execute("""
+            CREATE TABLE patient_invoices (
+                patient_key TEXT NOT NULL,
+                invoice_date TEXT NOT NULL,
+                invoice_no TEXT NOT NULL,
+                clinic_location TEXT NOT NULL,
+                billed_paise INTEGER NOT NULL,
+                paid_paise INTEGER NOT NULL,
+                PRIMARY KEY (patient_key, invoice_date, invoice_no)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE patient_services (
+                patient_key TEXT NOT NULL,
+                month TEXT NOT NULL,
+                description TEXT NOT NULL,
+                sessions INTEGER NOT NULL,
+                amount_paise INTEGER NOT NULL,
+                PRIMARY KEY (patient_key, month, description)
+            ) WITHOUT ROWID
+        """)
+        paid = dict(conn.execute("SELECT invoice_no, SUM(amount) FROM payments GROUP BY invoice_no").fetchall())
+        rows = conn.execute(
+            """SELECT invoice_no, invoice_date, clinic_location, patient_name, patient_phone, sessions, total_amount
+               FROM invoices"""
+        ).fetchall()
+        apply_statement_changes(conn, [], rows, paid)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def statement_lines(row):
+    """Return (month, description, sessions, amount paise) for each session line of a stored invoice row"""
+    month = row['invoice_date'][:7]
+    lines = []
+    for session in json.loads(row['sessions']):
+        qty = safe_int(session.get('qty'), 1)
+        lines.append((month, ' '.join(str(session.get('description', '')).split()), qty,
+                      to_paise(qty * safe_float(session.get('per_session_cost')))))
+    return lines
+
+def apply_statement_changes(conn, removed_rows, added_rows, paid):
+    """Replace the stored versions of invoices (removed_rows) with their new ones in the statement aggregates"""
+    services = {}
+    for sign, rows in ((-1, removed_rows), (1, added_rows)):
+        for row in rows:
+            patient_key = PatientRegistry.patient_key(dict(row))
+            for month, description, sessions, amount in statement_lines(row):
+                totals = services.setdefault((patient_key, month, description), [0, 0])
+                totals[0] += sign * sessions
+                totals[1] += sign * amount
+    conn.executemany(
+        "DELETE FROM patient_invoices WHERE patient_key = ? AND invoice_date = ? AND invoice_no = ?",
+        [(PatientRegistry.patient_key(dict(row)), row['invoice_date'], row['invoice_no']) for row in removed_rows]
+    )
+    conn.executemany(
+        """INSERT OR REPLACE INTO patient_invoices
+           (patient_key, invoice_date, invoice_no, clinic_location, billed_paise, paid_paise)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(PatientRegistry.patient_key(dict(row)), row['invoice_date'], row['invoice_no'], row['clinic_location'],
+          to_paise(row['total_amount']), to_paise(paid.get(row['invoice_no'], 0))) for row in added_rows]
+    )
+    changed = [(*key, sessions, amount) for key, (sessions, amount) in services.items() if sessions or amount]
+    conn.executemany(
+        """INSERT INTO patient_services (patient_key, month, description, sessions, amount_paise)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (patient_key, month, description) DO UPDATE SET
+               sessions = sessions + excluded.sessions,
+               amount_paise = amount_paise + excluded.amount_paise""",
+        changed
+    )
+    conn.executemany(
+        """DELETE FROM patient_services
+           WHERE patient_key = ? AND month = ? AND description = ? AND sessions = 0 AND amount_paise = 0""",
+        [change[:3] for change in changed]
+    )
+
+def serialize_form_data(form_data):
+    """Convert form data to a JSON-safe dict (dates as ISO strings)"""
+    serialized = dict(form_data)
+    for field in DATE_FIELDS:
+        value = serialized.get(field)
+        if hasattr(value, 'isoformat'):
+            serialized[field] = value.isoformat()
+    return serialized
+
+def deserialize_form_data(serialized):
+    """Convert stored form data back to the session state format"""
+    form_data = dict(serialized)
+    for field in DATE_FIELDS:
+        value = form_data.get(field)
+        if isinstance(value, str):
+            try:
+                form_data[field] = datetime.strptime(value[:10], '%Y-%m-%d').date()
+            except ValueError:
+                form_data[field] = datetime.now().date()
+    return form_data
+
+def row_to_invoice_record(row):
+    """Convert an invoices table row to a {'form_data', 'sessions'} record"""
+    return {
+        'form_data': deserialize_form_data(json.loads(row['form_data'])),
+        'sessions': intern_descriptions(json.loads(row['sessions']))
+    }
+
+def save_invoice_record(form_data, sessions, previous=None, replaces=None):
+    """Insert or update an invoice in the local store and index its patient.
+    
+    previous is the version the edit started from when it is not in the store
+    yet, such as an invoice parsed from an uploaded PDF. replaces is the
+    invoice number the form may overwrite; saving over any other stored
+    invoice raises ValueError.
+    """
+    record = {
+        'form_data': {key: value for key, value in form_data.items() if key != 'clinic_address'},
+        'sessions': [dict(session) for session in sessions]
+    }
+    if previous:
+        record['previous'] = previous
+    if replaces:
+        record['replaces'] = replaces
+    save_invoice_records([record])
+    return record
+
+def invoice_totals(records):
+    """Return the session total of each record, sanitizing all session lines in one batch"""
+    lines = [session for record in records for session in record['sessions']]
+    if len(lines) < SANITIZE_BATCH_MIN_ROWS:
+        return [sum(safe_int(s['qty'], 1) * safe_float(s['per_session_cost']) for s in record['sessions'])
+                for record in records]
+    record_index = np.repeat(np.arange(len(records)), [len(record['sessions']) for record in records])
+    amounts = (safe_int_series([line['qty'] for line in lines], 1) *
+               safe_float_series([line['per_session_cost'] for line in lines])).to_numpy(dtype=float)
+    return np.bincount(record_index, weights=amounts, minlength=len(records)).tolist()
+
+def save_invoice_records(records, source='form', skip_existing=False):
+    """Save many invoice records in a single transaction, audit the changes and queue a job to archive them"""
+    saved_at = datetime.now().isoformat(timespec='seconds')
+    conn = open_invoice_db()
+    try:
+        with conn:
+            # Take the write lock first so no other save can claim a number between the check and the insert
+            conn.execute("BEGIN IMMEDIATE")
+            for record in records:
+                if not str(record['form_data'].get('invoice_no') or "").strip():
+                    record['form_data']['invoice_no'] = allocate_invoice_number(
+                        conn, getattr(record['form_data'].get('invoice_date'), 'year', None))
+            invoice_nos = [record['form_data']['invoice_no'] for record in records]
+            stored = {}
+            paid = {}
+            for start in range(0, len(invoice_nos), 500):
+                chunk = invoice_nos[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(
+                    f"""SELECT invoice_no, invoice_date, clinic_location, patient_name, patient_phone,
+                               form_data, sessions, total_amount
+                        FROM invoices WHERE invoice_no IN ({placeholders})""",
+                    chunk
+                ):
+                    stored[row['invoice_no']] = row
+                paid.update(conn.execute(
+                    f"SELECT invoice_no, SUM(amount) FROM payments WHERE invoice_no IN ({placeholders}) GROUP BY invoice_no",
+                    chunk
+                ).fetchall())
+            
+            accepted = []
+            seen = set()
+            for record in records:
+                invoice_no = record['form_data']['invoice_no']
+                if invoice_no in seen or (invoice_no in stored and record.get('replaces') != invoice_no):
+                    if skip_existing:
+                        continue
+                    raise ValueError(f"Invoice {invoice_no} already exists. Use another invoice number, "
+                                     f"or open {invoice_no} from Search Invoices to edit it.")
+                seen.add(invoice_no)
+                accepted.append(record)
+            records = accepted
+            stored_rows = [stored[record['form_data']['invoice_no']] for record in records
+                           if record['form_data']['invoice_no'] in stored]
+            
+            rows = []
+            for record, total_amount in zip(records, invoice_totals(records)):
+                serialized = serialize_form_data(record['form_data'])
+                rows.append((
+                    serialized['invoice_no'],
+                    serialized['invoice_date'],
+                    serialized['clinic_location'],
+                    serialized['patient_name'],
+                    serialized['patient_phone'],
+                    json.dumps(serialized),
+                    json.dumps(record['sessions']),
+                    total_amount,
+                    saved_at
+                ))
+            # Only the invoices named by 'replaces' may be overwritten; a new number that is taken fails the save
+            conn.executemany(
+                """INSERT OR REPLACE INTO invoices
+                   (invoice_no, invoice_date, clinic_location, patient_name, patient_phone,
+                    form_data, sessions, total_amount, saved_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [row for row in rows if row[0] in stored]
+            )
+            conn.executemany(
+                """INSERT INTO invoices
+                   (invoice_no, invoice_date, clinic_location, patient_name, patient_phone,
+                    form_data, sessions, total_amount, saved_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [row for row in rows if row[0] not in stored]
+            )
+            # Move each invoice's billed and paid amounts from its stored version to the new one
+            columns = ('invoice_no', 'invoice_date', 'clinic_location', 'patient_name', 'patient_phone')
+            new_rows = [dict(zip(columns, row[:5]), sessions=row[6], total_amount=row[7]) for row in rows]
+            apply_receivable_changes(conn, [
+                receivable_change(row, -1, paid.get(row['invoice_no'], 0)) for row in stored_rows
+            ] + [
+                receivable_change(row, 1, paid.get(row['invoice_no'], 0)) for row in new_rows
+            ])
+            apply_statement_changes(conn, stored_rows, new_rows, paid)
+    finally:
+        conn.close()
+    
+    audit_log = get_audit_log()
+    for record, row in zip(records, rows):
+        previous = stored.get(row[0])
+        if previous is not None:
+            previous = (previous['form_data'], previous['sessions'])
+        elif record.get('previous'):
+            previous = (json.dumps(serialize_form_data(record['previous']['form_data'])),
+                        json.dumps(record['previous']['sessions']))
+        audit_log.append(row[0], saved_at, source, previous, (row[5], row[6]))
+    if records:
+        submit_job('archive', {'invoice_nos': [record['form_data']['invoice_no'] for record in records]}, "archive")
+    return records
+
+def record_payment(invoice_no, amount, paid_on, method, reference=""):
+    """Record a payment against a stored invoice and add it to the receivable balances"""
+    if safe_float(amount) <= 0:
+        raise ValueError("Payment amount must be greater than zero")
+    conn = open_invoice_db()
+    try:
+        with conn:
+            row = conn.execute(
+                """SELECT invoice_no, invoice_date, clinic_location, patient_name, patient_phone
+                   FROM invoices WHERE invoice_no = ?""",
+                (invoice_no,)
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Invoice {invoice_no} has not been saved yet")
+            conn.execute(
+                "INSERT INTO payments (invoice_no, paid_on, amount, method, reference, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (invoice_no, str(paid_on), round(safe_float(amount), 2), method, clean_text_field(reference, 100),
+                 datetime.now().isoformat(timespec='seconds'))
+            )
+            apply_receivable_changes(conn, [receivable_change(dict(row, total_amount=0), 1, amount)])
+            conn.execute(
+                """UPDATE patient_invoices SET paid_paise = paid_paise + ?
+                   WHERE patient_key = ? AND invoice_date = ? AND invoice_no = ?""",
+                (to_paise(amount), PatientRegistry.patient_key(dict(row)), row['invoice_date'], invoice_no)
+            )
+    finally:
+        conn.close()
+
+def payment_status(total_amount, paid):
+    """Label an invoice Paid, Partially Paid or Outstanding"""
+    if to_paise(paid) >= to_paise(total_amount):
+        return "Paid"
+    return "Partially Paid" if to_paise(paid) > 0 else "Outstanding"
+
+def get_invoice_payments(invoice_no):
+    """Return (stored total, payments oldest first) for an invoice; the total is None if it is not stored"""
+    conn = open_invoice_db()
+    try:
+        row = conn.execute("SELECT total_amount FROM invoices WHERE invoice_no = ?", (invoice_no,)).fetchone()
+        payments = [dict(payment) for payment in conn.execute(
+            "SELECT paid_on, amount, method, reference FROM payments WHERE invoice_no = ? ORDER BY paid_on, id",
+            (invoice_no,)
+        )]
+    finally:
+        conn.close()
+    return (row['total_amount'] if row else None), payments
+
+def get_patient_balance(form_data):
+    """Return (billed, paid) in rupees across all of a patient's stored invoices"""
+    conn = open_invoice_db()
+    try:
+        row = conn.execute("SELECT billed_paise, paid_paise FROM patient_balances WHERE patient_key = ?",
+                           (PatientRegistry.patient_key(form_data),)).fetchone()
+    finally:
+        conn.close()
+    return (row['billed_paise'] / 100, row['paid_paise'] / 100) if row else (0.0, 0.0)
+
+def receivables_aging(as_of):
+    """Return the outstanding balance per clinic in AGING_BUCKETS as of a date, in rupees.
+
+    Reads the per-day aggregates, so the cost grows with clinics x days of
+    history rather than with the number of invoices and payments.
+    """
+    cutoffs = [(label, (as_of - timedelta(days=days)).isoformat()) for label, days in AGING_BUCKETS if days is not None]
+    bucket = "CASE " + " ".join("WHEN invoice_date >= ? THEN ?" for _ in cutoffs) + " ELSE ? END"
+    params = [value for label, cutoff in cutoffs for value in (cutoff, label)] + [AGING_BUCKETS[-1][0]]
+    conn = open_invoice_db()
+    try:
+        rows = conn.execute(
+            f"""SELECT clinic_location, {bucket} AS bucket, SUM(billed_paise - paid_paise) AS due_paise
+                FROM receivables_daily WHERE billed_paise != paid_paise
+                GROUP BY clinic_location, bucket""",
+            params
+        ).fetchall()
+    finally:
+        conn.close()
+    labels = [label for label, _ in AGING_BUCKETS]
+    aging = pd.DataFrame(0.0, index=sorted({row['clinic_location'] for row in rows}), columns=labels)
+    for row in rows:
+        aging.loc[row['clinic_location'], row['bucket']] = row['due_paise'] / 100
+    aging['Total'] = aging[labels].sum(axis=1)
+    return aging
+
+def top_patient_balances(limit=RECEIVABLES_TOP_PATIENTS):
+    """Return the patients with the largest outstanding balances"""
+    conn = open_invoice_db()
+    try:
+        rows = conn.execute(
+            """SELECT patient_name, patient_phone, billed_paise, paid_paise FROM patient_balances
+               WHERE billed_paise - paid_paise > 0 ORDER BY billed_paise - paid_paise DESC LIMIT ?""",
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [{'patient_name': row['patient_name'], 'patient_phone': row['patient_phone'],
+             'billed': row['billed_paise'] / 100, 'paid': row['paid_paise'] / 100,
+             'balance': (row['billed_paise'] - row['paid_paise']) / 100} for row in rows]
+
+def patient_statement(patient_key, date_from, date_to):
+    """Return one patient's invoices and services between two dates, or None if there are none.
+
+    Services in whole months come from the per-month aggregates; only the
+    invoices in a partly covered first or last month are summed line by line.
+    The patient details and branding are those of the latest invoice.
+    """
+    partial_months = set()
+    if date_from.day != 1:
+        partial_months.add(date_from.isoformat()[:7])
+    if (date_to + timedelta(days=1)).day != 1:
+        partial_months.add(date_to.isoformat()[:7])
+    
+    conn = open_invoice_db()
+    try:
+        invoices = conn.execute(
+            """SELECT invoice_no, invoice_date, clinic_location, billed_paise, paid_paise FROM patient_invoices
+               WHERE patient_key = ? AND invoice_date BETWEEN ? AND ? ORDER BY invoice_date, invoice_no""",
+            (patient_key, str(date_from), str(date_to))
+        ).fetchall()
+        if not invoices:
+            return None
+        brought_forward = conn.execute(
+            """SELECT COALESCE(SUM(billed_paise - paid_paise), 0) FROM patient_invoices
+               WHERE patient_key = ? AND invoice_date < ?""",
+            (patient_key, str(date_from))
+        ).fetchone()[0]
+        placeholders = ','.join('?' * len(partial_months))
+        services = {row['description']: [row['sessions'], row['amount_paise']] for row in conn.execute(
+            f"""SELECT description, SUM(sessions) AS sessions, SUM(amount_paise) AS amount_paise
+                FROM patient_services WHERE patient_key = ? AND month BETWEEN ? AND ?
+                AND month NOT IN ({placeholders}) GROUP BY description""",
+            [patient_key, date_from.isoformat()[:7], date_to.isoformat()[:7], *partial_months]
+        )}
+        partial_invoices = [row['invoice_no'] for row in invoices if row['invoice_date'][:7] in partial_months]
+        for start in range(0, len(partial_invoices), 500):
+            chunk = partial_invoices[start:start + 500]
+            for row in conn.execute(
+                f"SELECT invoice_date, sessions FROM invoices WHERE invoice_no IN ({','.join('?' * len(chunk))})", chunk
+            ):
+                for _, description, sessions, amount in statement_lines(row):
+                    totals = services.setdefault(description, [0, 0])
+                    totals[0] += sessions
+                    totals[1] += amount
+        latest = conn.execute("SELECT form_data FROM invoices WHERE invoice_no = ?",
+                              (invoices[-1]['invoice_no'],)).fetchone()
+    finally:
+        conn.close()
+    
+    return {
+        'form_data': deserialize_form_data(json.loads(latest['form_data'])),
+        'date_from': date_from,
+        'date_to': date_to,
+        'invoices': [{'invoice_no': row['invoice_no'],
+                      'invoice_date': datetime.strptime(row['invoice_date'], '%Y-%m-%d').date(),
+                      'clinic_location': row['clinic_location'],
+                      'billed': row['billed_paise'] / 100, 'paid': row['paid_paise'] / 100} for row in invoices],
+        'services': [{'description': description, 'sessions': sessions, 'amount': amount / 100}
+                     for description, (sessions, amount) in sorted(services.items()) if sessions or amount],
+        'brought_forward': brought_forward / 100,
+        'billed': sum(row['billed_paise'] for row in invoices) / 100,
+        'paid': sum(row['paid_paise'] for row in invoices) / 100
+    }
+
+def query_invoice_records(date_from, date_to, clinic_location=None):
+    """Yield stored invoices dated within [date_from, date_to], optionally for one clinic"""
+    query = "SELECT form_data, sessions FROM invoices WHERE invoice_date BETWEEN ? AND ?"
+    params = [str(date_from), str(date_to)]
+    if clinic_location:
+        query += " AND clinic_location = ?"
+        params.append(clinic_location)
+    conn = open_invoice_db()
+    try:
+        for row in conn.execute(query + " ORDER BY invoice_date, invoice_no", params):
+            yield row_to_invoice_record(row)
+    finally:
+        conn.close()
+
+def get_invoice_records(invoice_nos):
+    """Return stored invoices for the given invoice numbers, in the same order"""
+    conn = open_invoice_db()
+    try:
+        placeholders = ",".join("?" * len(invoice_nos))
+        rows = conn.execute(
+            f"SELECT invoice_no, form_data, sessions FROM invoices WHERE invoice_no IN ({placeholders})",
+            list(invoice_nos)
+        ).fetchall()
+    finally:
+        conn.close()
+    records = {row['invoice_no']: row_to_invoice_record(row) for row in rows}
+    return [records[invoice_no] for invoice_no in invoice_nos if invoice_no in records]
+
+def uploaded_invoice_match(form_data):
+    """Return whether the invoice stored under an uploaded invoice's number is the same patient's on the same date.
+    
+    Returns None if nothing is stored under the number. Invoices from before
+    the store all printed the same default number, so the number alone does
+    not show which stored invoice an upload is.
+    """
+    conn = open_invoice_db()
+    try:
+        row = conn.execute("SELECT invoice_date, patient_name, patient_phone FROM invoices WHERE invoice_no = ?",
+                           (form_data['invoice_no'],)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    if row['invoice_date'] != serialize_form_data(form_data)['invoice_date']:
+        return False
+    uploaded_phone = phone_key(form_data.get('patient_phone'))
+    if uploaded_phone is not None and uploaded_phone == phone_key(row['patient_phone']):
+        return True
+    return ' '.join(form_data['patient_name'].split()).casefold() == ' '.join(row['patient_name'].split()).casefold()
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query matching every word as a prefix"""
+    return " ".join(f'"{word}"*' for word in re.findall(r'\w+', text.lower()))
+
+def search_invoices(text, date_from, date_to, clinic_location=None, page=0, page_size=20):
+    """Return one page of invoices matching free text and filters, best matches first.
+    
+    Text searches rank the most recent SEARCH_MAX_RESULTS matches so that broad
+    terms cost the same as narrow ones; the total is capped at that limit.
+    """
+    filters = "i.invoice_date BETWEEN ? AND ?"
+    params = [str(date_from), str(date_to)]
+    if clinic_location:
+        filters += " AND i.clinic_location = ?"
+        params.append(clinic_location)
+    
+    columns = "i.invoice_no, i.invoice_date, i.clinic_location, i.patient_name, i.total_amount"
+    fts_query = build_fts_query(text or "")
+    conn = open_invoice_db()
+    try:
+        if fts_query:
+            # Unary + keeps the planner from driving the join off the date/clinic
+            # indexes, which would re-run the MATCH once per candidate row
+            matches = conn.execute(
+                f"""SELECT {columns}, snippet(invoices_fts, -1, '**', '**', '…', 12) AS snippet,
+                           bm25(invoices_fts, 4.0, 2.0, 1.0) AS score
+                    FROM invoices_fts JOIN invoices AS i ON i.id = invoices_fts.rowid
+                    WHERE invoices_fts MATCH ? AND {filters.replace("i.", "+i.")}
+                    ORDER BY invoices_fts.rowid DESC LIMIT ?""",
+                [fts_query] + params + [SEARCH_MAX_RESULTS]
+            ).fetchall()
+            matches.sort(key=lambda row: row['score'])
+            total = len(matches)
+            rows = matches[page * page_size:(page + 1) * page_size]
+        else:
+            total = conn.execute(f"SELECT COUNT(*) FROM invoices AS i WHERE {filters}", params).fetchone()[0]
+            rows = conn.execute(
+                f"""SELECT {columns}, '' AS snippet FROM invoices AS i WHERE {filters}
+                    ORDER BY i.invoice_date DESC, i.invoice_no DESC LIMIT ? OFFSET ?""",
+                params + [page_size, page * page_size]
+            ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows], total
+
+def diff_invoice_versions(previous, current):
+    """Return field-level changes between two stored invoice versions as [path, old, new] triples"""
+    old_form, old_sessions = previous if previous else ({}, [])
+    new_form, new_sessions = current
+    changes = []
+    for field in sorted(set(old_form) | set(new_form)):
+        if field != 'clinic_address' and old_form.get(field) != new_form.get(field):
+            changes.append([f"form_data.{field}", old_form.get(field), new_form.get(field)])
+    for index in range(max(len(old_sessions), len(new_sessions))):
+        old_line = old_sessions[index] if index < len(old_sessions) else None
+        new_line = new_sessions[index] if index < len(new_sessions) else None
+        if old_line is None or new_line is None:
+            changes.append([f"sessions.{index}", old_line, new_line])
+            continue
+        for field in sorted(set(old_line) | set(new_line)):
+            if old_line.get(field) != new_line.get(field):
+                changes.append([f"sessions.{index}.{field}", old_line.get(field), new_line.get(field)])
+    return changes
+
+class AuditLog:
+    """Append-only log of invoice creates and edits, stored as field-level diffs.
+    
+    Saves only queue the before/after JSON; a background thread computes the
+    diffs and appends them in batches, one fsync per batch. Rows cannot be
+    updated or deleted once written. Entries that cannot be written after
+    retries are kept in a spill file and written when the log next starts.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.spill_path = path + ".spill"
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def open_db(self):
+        """Open a connection to the audit database, creating it if needed"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_no TEXT NOT NULL,
+                recorded_at TEXT NOT NULL,
+                action TEXT NOT NULL,
+                source TEXT NOT NULL,
+                changes TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_audit_invoice ON audit_log (invoice_no, id);
+            CREATE TRIGGER IF NOT EXISTS audit_log_no_update BEFORE UPDATE ON audit_log BEGIN
+                SELECT RAISE(ABORT, 'audit log is append-only');
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON audit_log BEGIN
+                SELECT RAISE(ABORT, 'audit log is append-only');
+            END;
+        """)
+        return conn
+    
+    def start(self):
+        """Start the writer thread, which first writes any entries spilled by earlier failures"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+                    self._thread.start()
+    
+    def append(self, invoice_no, recorded_at, source, previous, current):
+        """Queue one saved invoice version; previous and current are (form_data, sessions) JSON pairs"""
+        self.start()
+        self._queue.put((invoice_no, recorded_at, source, previous, current))
+    
+    def flush(self):
+        """Block until every queued entry has been written"""
+        if self._thread is not None:
+            self._queue.join()
+    
+    def history(self, invoice_no):
+        """Return the audit entries for one invoice, newest first"""
+        self.flush()
+        conn = self.open_db()
+        try:
+            rows = conn.execute(
+                "SELECT recorded_at, action, source, changes FROM audit_log WHERE invoice_no = ? ORDER BY id DESC",
+                (invoice_no,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row, changes=json.loads(row['changes'])) for row in rows]
+    
+    def _run(self):
+        conn = self.open_db()
+        self._replay_spill(conn)
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+            while len(batch) < AUDIT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write_or_spill(conn, batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _write_or_spill(self, conn, batch):
+        delay = AUDIT_RETRY_SECONDS
+        for attempt in range(AUDIT_RETRY_ATTEMPTS):
+            try:
+                self._write(conn, batch)
+                return
+            except Exception as e:
+                error = e
+                if attempt + 1 < AUDIT_RETRY_ATTEMPTS:
+                    time.sleep(delay)
+                    delay *= 2
+        # A bad entry fails every retry, so write the rest one by one and spill only what still fails
+        failed = []
+        for entry in batch:
+            try:
+                self._write(conn, [entry])
+            except Exception:
+                failed.append(entry)
+        if failed:
+            print(f"Audit log write failed: {error}; {len(failed)} entries kept in {self.spill_path}", file=sys.stderr)
+            self._spill(failed)
+    
+    def _spill(self, entries):
+        if not entries:
+            return
+        with open(self.spill_path, 'a', encoding='utf-8') as spill_file:
+            spill_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+    
+    def _replay_spill(self, conn):
+        """Write spilled entries, including those a process claimed and then died replaying"""
+        directory, name = os.path.split(self.spill_path)
+        claims = [os.path.join(directory or ".", entry) for entry in os.listdir(directory or ".")
+                  if entry.startswith(name + ".") and entry[len(name) + 1:].isdigit()
+                  and not process_alive(int(entry[len(name) + 1:]))]
+        for path in [self.spill_path] + claims:
+            # Renaming the file claims it, so two processes starting together never replay it twice
+            claimed = f"{self.spill_path}.{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed, 'r', encoding='utf-8') as spill_file:
+                lines = spill_file.read().splitlines()
+            failed = []
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The tail of a spill cut short by a crash
+                    print(f"Audit log spill entry unreadable, skipped: {line[:80]}", file=sys.stderr)
+                    continue
+                try:
+                    self._write(conn, [entry])
+                except Exception:
+                    failed.append(entry)
+            self._spill(failed)
+            os.remove(claimed)
+    
+    def _write(self, conn, batch):
+        entries = []
+        for invoice_no, recorded_at, source, previous, current in batch:
+            before = (json.loads(previous[0]), json.loads(previous[1])) if previous else None
+            changes = diff_invoice_versions(before, (json.loads(current[0]), json.loads(current[1])))
+            if changes:
+                action = 'edit' if before else 'create'
+                entries.append((invoice_no, recorded_at, action, source, json.dumps(changes, separators=(',', ':'))))
+        with conn:
+            conn.executemany(
+                "INSERT INTO audit_log (invoice_no, recorded_at, action, source, changes) VALUES (?, ?, ?, ?, ?)",
+                entries
+            )
+
+@st.cache_resource
+def get_audit_log():
+    """Return the process-wide audit log, writing any spilled entries now and flushing it when the process exits"""
+    audit_log = AuditLog(AUDIT_DB_PATH)
+    audit_log.start()
+    atexit.register(audit_log.flush)
+    return audit_log
+
+class DraftStore:
+    """Autosaved invoice forms, one JSON file per draft.
+    
+    save() only keeps the latest snapshot in memory; a background thread
+    writes each draft at most once every DRAFT_SAVE_SECONDS, so the edits in
+    between coalesce into one write. Files are replaced by an atomic rename
+    and editors never share a file, so the lock is only held for dict updates.
+    """
+    
+    def __init__(self, directory, interval=DRAFT_SAVE_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self._pending = {}
+        self._written_at = {}
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._writing = 0
+        self._flushing = 0
+    
+    def path(self, draft_id):
+        return os.path.join(self.directory, f"{draft_id}.json")
+    
+    def save(self, draft_id, draft):
+        """Queue the latest snapshot of a draft; the write happens in the background"""
+        if self._thread is None:
+            with self._condition:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="draft-writer", daemon=True)
+                    self._thread.start()
+        with self._condition:
+            self._pending[draft_id] = dict(draft, draft_id=draft_id, saved_at=datetime.now().isoformat(timespec='seconds'))
+            self._condition.notify()
+    
+    def flush(self):
+        """Block until every pending draft has been written, ignoring the debounce interval"""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._pending and not self._writing, timeout=30)
+            self._flushing -= 1
+    
+    def load(self, draft_id):
+        """Return one draft, or None if it has been discarded"""
+        with self._condition:
+            draft = self._pending.get(draft_id)
+        if draft is not None:
+            return draft
+        try:
+            with open(self.path(draft_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def list_drafts(self, limit=DRAFTS_SHOWN):
+        """Return the most recently saved drafts, newest first, removing expired ones"""
+        cutoff = time.time() - DRAFT_MAX_AGE_DAYS * 86400
+        try:
+            entries = [(entry.stat().st_mtime, entry.name[:-len('.json')])
+                       for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        except FileNotFoundError:
+            entries = []
+        with self._condition:
+            pending = dict(self._pending)
+        drafts = dict(pending)
+        for modified, draft_id in sorted(entries, reverse=True):
+            if modified < cutoff:
+                self.discard(draft_id)
+            elif draft_id not in drafts and len(drafts) < limit + len(pending):
+                draft = self.load(draft_id)
+                if draft is not None:
+                    drafts[draft_id] = draft
+        return sorted(drafts.values(), key=lambda draft: draft['saved_at'], reverse=True)[:limit]
+    
+    def discard(self, draft_id):
+        """Drop a draft, pending or written"""
+        with self._condition:
+            self._pending.pop(draft_id, None)
+            self._written_at.pop(draft_id, None)
+        with self._write_lock:
+            try:
+                os.remove(self.path(draft_id))
+            except FileNotFoundError:
+                pass
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    due = [draft_id for draft_id in self._pending
+                           if self._flushing or self._written_at.get(draft_id, float('-inf')) + self.interval <= now]
+                    if due:
+                        break
+                    next_due = min((self._written_at[draft_id] + self.interval for draft_id in self._pending), default=None)
+                    self._condition.wait(None if next_due is None else next_due - now)
+                batch = [(draft_id, self._pending.pop(draft_id)) for draft_id in due]
+                for draft_id in due:
+                    self._written_at[draft_id] = now
+                self._writing += 1
+            try:
+                for draft_id, draft in batch:
+                    self._write(draft_id, draft)
+            finally:
+                with self._condition:
+                    self._writing -= 1
+                    self._condition.notify_all()
+    
+    def _write(self, draft_id, draft):
+        try:
+            data = json.dumps({
+                **draft,
+                'form_data': serialize_form_data(draft['form_data']),
+                'edit_original': draft['edit_original'] and {
+                    'form_data': serialize_form_data(draft['edit_original']['form_data']),
+                    'sessions': draft['edit_original']['sessions']
+                }
+            }, separators=(',', ':'))
+            path = self.path(draft_id)
+            with self._write_lock:
+                with self._condition:
+                    if draft_id not in self._written_at:
+                        return
+                os.makedirs(self.directory, exist_ok=True)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, path)
+        except Exception as e:
+            print(f"Draft write failed: {e}", file=sys.stderr)
+
+@st.cache_resource
+def get_draft_store():
+    """Return the process-wide draft store, writing pending drafts when the process exits"""
+    draft_store = DraftStore(DRAFTS_DIR)
+    atexit.register(draft_store.flush)
+    return draft_store
+
+class PatientRegistry:
+    """In-memory index of returning patients built from past invoices.
+    
+    Names and phone numbers are kept in sorted lists for prefix lookups,
+    with a trigram index as a fallback for partial or misspelled names.
+    Normalized phone keys map straight to their patient and invoices for
+    exact lookups and duplicate detection.
+    """
+    
+    PATIENT_FIELDS = ('patient_name', 'patient_age', 'patient_sex', 'patient_phone',
+                      'problem_desc', 'mode_of_treatment')
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held across a whole sync so two sessions never index the same new rows
+        self._sync_lock = threading.Lock()
+        self.patients = {}
+        self._name_prefixes = []
+        self._phone_prefixes = []
+        self._trigrams = {}
+        self.patients_by_phone = {}
+        self.invoices_by_phone = {}
+        self._invoice_phones = {}
+        self.last_id = 0
+    
+    @staticmethod
+    def patient_key(form_data, key=None):
+        """Identify a patient by phone number, or by name when no valid phone is given"""
+        key = key if key is not None else phone_key(form_data.get('patient_phone', ''))
+        if key:
+            return str(key)
+        return ' '.join(form_data.get('patient_name', '').lower().split())
+    
+    @staticmethod
+    def _trigrams_of(text):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    def _make_entry(self, record, phone=None):
+        form_data = record['form_data']
+        name = ' '.join(form_data.get('patient_name', '').split())
+        key = self.patient_key(form_data, phone)
+        if not name or not key:
+            return None, None
+        entry = {field: form_data.get(field, '') for field in self.PATIENT_FIELDS}
+        entry['patient_name'] = name
+        entry['sessions'] = [dict(session) for session in record['sessions']]
+        entry['last_invoice_date'] = form_data.get('invoice_date')
+        return key, entry
+    
+    @staticmethod
+    def _is_older(entry, existing):
+        return bool(existing and existing['last_invoice_date'] and entry['last_invoice_date']
+                    and existing['last_invoice_date'] > entry['last_invoice_date'])
+    
+    def _track_invoice(self, invoice_no, phone):
+        previous = self._invoice_phones.pop(invoice_no, None)
+        if previous:
+            self.invoices_by_phone[previous].discard(invoice_no)
+        if invoice_no and phone:
+            self._invoice_phones[invoice_no] = phone
+            self.invoices_by_phone.setdefault(phone, set()).add(invoice_no)
+    
+    def add_invoice(self, record):
+        """Index or refresh the patient on an invoice record"""
+        phone = phone_key(record['form_data'].get('patient_phone', ''))
+        key, entry = self._make_entry(record, phone or 0)
+        with self._lock:
+            self._track_invoice(record['form_data'].get('invoice_no'), phone)
+        if key is None:
+            return
+        
+        with self._lock:
+            existing = self.patients.get(key)
+            if self._is_older(entry, existing):
+                return
+            if existing:
+                self._unindex(key, existing)
+            self.patients[key] = entry
+            self._index(key, entry)
+    
+    def _index(self, key, entry):
+        name = entry['patient_name'].lower()
+        for token in name.split():
+            bisect.insort(self._name_prefixes, (token, key))
+        phone = phone_key(entry['patient_phone'])
+        if phone:
+            bisect.insort(self._phone_prefixes, (str(phone), key))
+            self.patients_by_phone[phone] = key
+        for trigram in self._trigrams_of(name):
+            self._trigrams.setdefault(trigram, set()).add(key)
+    
+    def _unindex(self, key, entry):
+        name = entry['patient_name'].lower()
+        for token in name.split():
+            position = bisect.bisect_left(self._name_prefixes, (token, key))
+            if position < len(self._name_prefixes) and self._name_prefixes[position] == (token, key):
+                del self._name_prefixes[position]
+        phone = phone_key(entry['patient_phone'])
+        if phone:
+            position = bisect.bisect_left(self._phone_prefixes, (str(phone), key))
+            if position < len(self._phone_prefixes) and self._phone_prefixes[position] == (str(phone), key):
+                del self._phone_prefixes[position]
+            if self.patients_by_phone.get(phone) == key:
+                del self.patients_by_phone[phone]
+        for trigram in self._trigrams_of(name):
+            keys = self._trigrams.get(trigram)
+            if keys:
+                keys.discard(key)
+    
+    @staticmethod
+    def _prefix_range(sorted_entries, prefix):
+        return (bisect.bisect_left(sorted_entries, (prefix,)),
+                bisect.bisect_left(sorted_entries, (prefix + '\uffff',)))
+    
+    def search(self, query, limit=8):
+        """Return up to `limit` patients matching a name or phone fragment"""
+        query = ' '.join(query.lower().split())
+        if len(query) < 2:
+            return []
+        
+        with self._lock:
+            keys = []
+            compact = re.sub(r'[\s+()-]', '', query)
+            if compact.isdigit():
+                phone = phone_key(compact)
+                if phone in self.patients_by_phone:
+                    return [self.patients[self.patients_by_phone[phone]]]
+                if query.startswith('+91') or (compact.startswith('91') and len(compact) > 10):
+                    compact = compact[2:]
+                compact = compact.lstrip('0')
+                start, end = self._prefix_range(self._phone_prefixes, compact)
+                for _, key in self._phone_prefixes[start:min(end, start + limit)]:
+                    keys.append(key)
+                return [self.patients[key] for key in keys]
+            
+            # Scan the narrowest token prefix range, checking the other tokens per candidate
+            tokens = query.split()
+            ranges = [self._prefix_range(self._name_prefixes, token) for token in tokens]
+            start, end = min(ranges, key=lambda r: r[1] - r[0])
+            for position in range(start, end):
+                key = self._name_prefixes[position][1]
+                name = self.patients[key]['patient_name'].lower()
+                if key not in keys and all(token in name for token in tokens):
+                    keys.append(key)
+                    if len(keys) >= limit:
+                        break
+            
+            # Fuzzy fallback for misspellings, counting only the more selective trigrams
+            if not keys:
+                postings = sorted((self._trigrams.get(trigram, ()) for trigram in self._trigrams_of(query)), key=len)
+                postings = [p for p in postings if p]
+                selective = [p for p in postings if len(p) <= max(1000, len(self.patients) // 20)]
+                postings = selective if len(selective) >= 2 else postings[:2]
+                scores = Counter(itertools.chain.from_iterable(postings))
+                threshold = max(2, len(postings) // 2)
+                for key, score in scores.most_common():
+                    if score < threshold or len(keys) >= limit:
+                        break
+                    if key not in keys:
+                        keys.append(key)
+            return [self.patients[key] for key in keys]
+    
+    def bulk_load(self, records):
+        """Index many invoice records at once, sorting the prefix lists a single time"""
+        phones = phone_keys([record['form_data'].get('patient_phone', '') for record in records]).tolist()
+        with self._lock:
+            patient_phones = {}
+            for record, phone in zip(records, phones):
+                self._track_invoice(record['form_data'].get('invoice_no'), phone)
+                key, entry = self._make_entry(record, phone)
+                if key is not None and not self._is_older(entry, self.patients.get(key)):
+                    self.patients[key] = entry
+                    patient_phones[key] = phone
+            for key, entry in self.patients.items():
+                name = entry['patient_name'].lower()
+                self._name_prefixes.extend((token, key) for token in name.split())
+                phone = patient_phones.get(key)
+                if phone:
+                    self._phone_prefixes.append((str(phone), key))
+                    self.patients_by_phone[phone] = key
+                for trigram in self._trigrams_of(name):
+                    self._trigrams.setdefault(trigram, set()).add(key)
+            self._name_prefixes.sort()
+            self._phone_prefixes.sort()
+
+    def lookup_phone(self, phone):
+        """Return (patient, invoice numbers) for a phone number in any format, or (None, [])"""
+        key = phone_key(phone)
+        with self._lock:
+            patient_key = self.patients_by_phone.get(key)
+            return (self.patients.get(patient_key), sorted(self.invoices_by_phone.get(key, ())))
+    
+    def sync_from_store(self):
+        """Index invoices saved since the last sync, including those saved by job workers"""
+        with self._sync_lock:
+            conn = open_invoice_db()
+            try:
+                rows = conn.execute(
+                    "SELECT id, form_data, sessions FROM invoices WHERE id > ? ORDER BY id",
+                    (self.last_id,)
+                ).fetchall()
+            finally:
+                conn.close()
+            if not rows:
+                return
+            
+            records = [row_to_invoice_record(row) for row in rows]
+            if self.patients:
+                for record in records:
+                    self.add_invoice(record)
+            else:
+                self.bulk_load(records)
+            self.last_id = max(self.last_id, rows[-1]['id'])
+
+@st.cache_resource
+def load_patient_registry():
+    """Create the patient registry once per server process"""
+    return PatientRegistry()
+
+def get_patient_registry():
+    """Return the shared patient registry, indexing any newly saved invoices first"""
+    registry = load_patient_registry()
+    registry.sync_from_store()
+    return registry
+
+@st.cache_resource
+def load_logo_as_base64():
+    """Load logo and convert to base64"""
+    logo_paths = [
+        "pal_logo.png",
+        "pal_logo_full.png",
+        "assets/pal_logo.png",
+        "images/pal_logo.png"
+    ]
+    for path in logo_paths:
+        try:
+            if os.path.exists(path):
+                with open(path, "rb") as img_file:
+                    return base64.b64encode(img_file.read()).decode()
+        except:
+            continue
+    return None
+
+@st.cache_resource
+def load_watermark_as_base64():
+    """Load watermark image and convert to base64"""
+    watermark_paths = [
+        "pal_logo_icon.png",
+        "watermark_logo.png",
+        "pal_pal_logo_icon.png",
+        "assets/pal_logo_icon.png",
+        "images/pal_logo_icon.png"
+    ]
+    for path in watermark_paths:
+        try:
+            if os.path.exists(path):
+                with open(path, "rb") as img_file:
+                    return base64.b64encode(img_file.read()).decode()
+        except:
+            continue
+    return None
+
+def get_fallback_logo():
+    """SVG fallback logo"""
+    svg_logo = """
+    <svg width="200" height="200" viewBox="0 0 200 200" xmlns="http://www.w3.org/2000/svg">
+        <defs>
+            <linearGradient id="grad1" x1="0%" y1="0%" x2="100%" y2="100%">
+                <stop offset="0%" style="stop-color:#30b392;stop-opacity:1" />
+                <stop offset="100%" style="stop-color:#27ae60;stop-opacity:1" />
+            </linearGradient>
+        </defs>
+        <circle cx="100" cy="100" r="80" fill="url(#grad1)"/>
+        <path d="M 70 100 L 90 120 L 130 70" stroke="white" stroke-width="12" fill="none" stroke-linecap="round"/>
+        <text x="100" y="180" text-anchor="middle" fill="white" font-size="24" font-weight="bold">PAL</text>
+    </svg>
+    """
+    return f"data:image/svg+xml;base64,{base64.b64encode(svg_logo.encode()).decode()}"
+
+@st.cache_resource
+def load_signature_as_base64():
     """Load signature image and convert to base64"""
     signature_paths = [
         "dr_bhuvana_signature.png",
@@ -508,7 +3028,11 @@ def show_dashboard():
         """, unsafe_allow_html=True)
         
         if st.button("+ Create New Invoice", use_container_width=True):
+            st.session_state.pop('draft_id', None)
             st.session_state.edit_mode = False
+            st.session_state.replaces_invoice_no = None
+            st.session_state.suggested_invoice_no = next_invoice_number()
+            st.session_state.form_data['invoice_no'] = st.session_state.suggested_invoice_no
             st.session_state.uploaded_invoice_data = None
             st.session_state.page = 'form'
             st.rerun()
@@ -526,9 +3050,31 @@ def show_dashboard():
         
         if st.button("📤 Upload & Edit Invoice", use_container_width=True):
             st.session_state.edit_mode = True
+            st.session_state.edit_original = None
             st.session_state.page = 'upload'
             st.rerun()
     
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        if st.button("🗓️ Month-End Plan Billing", use_container_width=True):
+            st.session_state.page = 'plans'
+            st.rerun()
+    with col2:
+        if st.button("🔍 Search Invoices", use_container_width=True):
+            st.session_state.page = 'search'
+            st.rerun()
+    with col3:
+        if st.button("💰 Receivables", use_container_width=True):
+            st.session_state.page = 'receivables'
+            st.rerun()
+    with col4:
+        if st.button("📑 Patient Statements", use_container_width=True):
+            st.session_state.page = 'statements'
+            st.rerun()
+    
+    show_draft_panel()
+    show_job_panel()
+    
     st.markdown("---")
     
     col1, col2, col3 = st.columns(3)
@@ -560,6 +3106,123 @@ def show_dashboard():
         </div>
         """, unsafe_allow_html=True)
 
+def show_draft_panel():
+    """Dashboard list of autosaved invoice drafts that can be reopened or discarded"""
+    drafts = get_draft_store().list_drafts()
+    if not drafts:
+        return
+    with st.expander(f"📝 Unsaved Drafts ({len(drafts)})", expanded=True):
+        for draft in drafts:
+            form_data = draft['form_data']
+            saved_at = datetime.fromisoformat(draft['saved_at']).strftime('%d/%m/%Y %H:%M')
+            col1, col2, col3 = st.columns([6, 2, 1])
+            with col1:
+                st.markdown(f"**{form_data.get('patient_name') or 'Unnamed patient'}** · {form_data.get('invoice_no') or 'Not numbered yet'} · "
+                            f"{'Edit' if draft['edit_mode'] else 'New invoice'} · saved {saved_at}")
+            with col2:
+                st.button("Restore", key=f"restore_draft_{draft['draft_id']}", use_container_width=True,
+                          on_click=restore_draft, args=(draft['draft_id'],))
+            with col3:
+                st.button("🗑️", key=f"discard_draft_{draft['draft_id']}", help="Discard this draft",
+                          on_click=get_draft_store().discard, args=(draft['draft_id'],))
+
+def show_job_panel():
+    """Dashboard panel for submitting and monitoring background jobs"""
+    with st.expander("⚙️ Background Jobs", expanded=False):
+        catalog = get_catalog()
+        today = datetime.now().date()
+        col1, col2 = st.columns(2)
+        with col1:
+            staff_name = st.text_input("Staff Name", key="staff_name", placeholder="Who is queuing this job?")
+            job_kind = st.selectbox("Job", options=list(JOB_KINDS.keys()), format_func=lambda x: JOB_KINDS[x])
+        with col2:
+            if job_kind == 'import':
+                source_path = st.text_input("Archive Path", placeholder="Zip file or folder of invoice PDFs on the server")
+            else:
+                if job_kind == 'calendar':
+                    source_path = st.text_input("Calendar Path", placeholder=".ics file or folder of .ics exports on the server")
+                date_from = st.date_input("From", value=today.replace(day=1), key="job_date_from")
+                date_to = st.date_input("To", value=today, key="job_date_to")
+                clinic_location = st.selectbox(
+                    "Clinic",
+                    options=[""] + list(catalog['clinics'].keys()),
+                    format_func=lambda x: catalog['clinics'][x]['display_name'] if x else "All clinics",
+                    key="job_clinic"
+                )
+                if job_kind == 'print':
+                    duplex = st.checkbox("Duplex", key="job_duplex",
+                                         help="Start every invoice on the front of a sheet")
+                    cover = st.checkbox("Cover summary", value=True, key="job_cover")
+        
+        if st.button("Queue Job"):
+            params = {}
+            if job_kind in ('import', 'calendar'):
+                if not source_path.strip() or not os.path.exists(source_path.strip()):
+                    st.error(f"Please enter an existing {'archive' if job_kind == 'import' else 'calendar'} path")
+                    return
+                params['source_path'] = os.path.abspath(source_path.strip())
+            if job_kind != 'import':
+                params.update(date_from=date_from.isoformat(), date_to=date_to.isoformat(),
+                              clinic_location=clinic_location or None)
+                if job_kind == 'print':
+                    if not search_invoices("", date_from, date_to, clinic_location or None, page_size=1)[1]:
+                        st.error("There are no invoices to print in this period")
+                        return
+                    params.update(duplex=duplex, cover=cover)
+            job_id = submit_job(job_kind, params, staff_name.strip())
+            st.success(f"✅ Job #{job_id} queued")
+        
+        show_job_status()
+
+@st.fragment(run_every=JOB_STATUS_REFRESH_SECONDS)
+def show_job_status():
+    """Poll and display recent jobs; refreshes on its own without rerunning the page"""
+    jobs = list_jobs()
+    if not jobs:
+        st.caption("No background jobs yet.")
+        return
+    if any(job['status'] == 'queued' for job in jobs):
+        ensure_job_workers()
+    
+    for job in jobs:
+        col1, col2 = st.columns([4, 2])
+        with col1:
+            timing = f" · {job['run_seconds']:.1f}s" if job['run_seconds'] else ""
+            st.markdown(f"**#{job['id']} {JOB_KINDS[job['kind']]}** · {job['submitted_by']} · {job['status']}{timing}")
+            if job['status'] in ('queued', 'running'):
+                fraction = job['progress'] / job['total'] if job['total'] else 0.0
+                st.progress(min(fraction, 1.0), text=f"{job['progress']} / {job['total'] or '?'}")
+            elif job['status'] == 'failed':
+                st.caption(f"❌ {job['error']}")
+            elif job['result'] and 'drafts' in job['result']:
+                calendar = job['result']['calendar']
+                st.caption(f"Created {job['result']['drafts']} draft invoices from {calendar.get('visits', 0)} completed "
+                           f"appointments · skipped {calendar.get('cancelled', 0)} cancelled, "
+                           f"{calendar.get('upcoming', 0)} upcoming and {calendar.get('recurring', 0)} recurring")
+            elif job['result'] and 'imported' in job['result']:
+                st.caption(f"Imported {job['result']['imported']} invoices, skipped {len(job['result']['skipped'])} files")
+            elif job['result'] and 'archived' in job['result']:
+                result = job['result']
+                st.caption(f"Archived {result['archived']} invoices in {result['stored_bytes'] / 1024:,.0f} KB "
+                           f"({result['html_bytes'] / 1024:,.0f} KB as HTML downloads) · archive holds "
+                           f"{result['archive']['records']} invoices in {result['archive']['segments']} segments "
+                           f"and {result['archive']['assets']} shared images")
+            elif job['result'] and 'pages' in job['result']:
+                st.caption(f"{job['result']['invoices']} invoices on {job['result']['pages']} A4 pages"
+                           f" · {job['result'].get('bytes', 0) / 1024:,.0f} KB")
+        with col2:
+            output_path = (job['result'] or {}).get('output_path')
+            if job['status'] == 'done' and output_path and os.path.exists(output_path):
+                with open(output_path, 'rb') as output_file:
+                    st.download_button(
+                        label="📥 Download",
+                        data=output_file.read(),
+                        file_name=os.path.basename(output_path),
+                        key=f"job_download_{job['id']}",
+                        use_container_width=True,
+                        on_click="ignore"
+                    )
+
 def show_upload_page():
     """PDF upload page for editing existing invoices"""
     col1, col2, col3 = st.columns([1, 6, 1])
@@ -606,12 +3269,9 @@ def show_upload_page():
         
         with st.spinner("🔄 Extracting invoice data from PDF..."):
             try:
-                uploaded_file.seek(0)
-                text_content = extract_text_from_uploaded_pdf(uploaded_file)
+                text_content, parsed_data = parse_invoice_pdf(uploaded_file)
                 
                 if text_content:
-                    parsed_data = parse_invoice_data_from_text(text_content)
-                    
                     if parsed_data:
                         st.success("✅ Invoice data extracted successfully!")
                         st.session_state.uploaded_invoice_data = parsed_data
@@ -645,7 +3305,16 @@ def show_upload_page():
                             if st.button("✏️ Edit This Invoice", use_container_width=True):
                                 st.session_state.form_data.update(parsed_data['form_data'])
                                 st.session_state.sessions = parsed_data['sessions']
+                                st.session_state.edit_original = parsed_data
                                 st.session_state.edit_mode = True
+                                match = uploaded_invoice_match(parsed_data['form_data']) if parsed_data['form_data']['invoice_no'] else None
+                                st.session_state.replaces_invoice_no = parsed_data['form_data']['invoice_no'] if match else None
+                                st.session_state.suggested_invoice_no = None
+                                if match is False:
+                                    # Another invoice is stored under this number; save the upload under a new one
+                                    st.session_state.suggested_invoice_no = next_invoice_number()
+                                    st.session_state.form_data['invoice_no'] = st.session_state.suggested_invoice_no
+                                st.session_state.pop('draft_id', None)
                                 st.session_state.page = 'form'
                                 st.rerun()
                         
@@ -664,13 +3333,13 @@ def show_upload_page():
                 st.info("💡 **Note:** PDF processing requires the PyPDF2 library. Some PDF formats may not be supported.")
     
     else:
-        st.markdown("""
+        st.markdown(f"""
         <div class="upload-info">
             <h4 style="color: #0a2a43; margin-bottom: 1rem;">📋 Upload Instructions:</h4>
             <ol style="color: #666; line-height: 1.6;">
                 <li><strong>Select a PDF file</strong> - Only PDF files are supported</li>
                 <li><strong>PAL Invoice PDFs work best</strong> - Upload invoices generated by this system</li>
-                <li><strong>File size limit</strong> - Keep files under 200MB for best performance</li>
+                <li><strong>File size limit</strong> - Files must be under {MAX_UPLOAD_BYTES // (1024 * 1024)}MB and {MAX_PDF_PAGES} pages</li>
                 <li><strong>Data extraction</strong> - The system will automatically extract patient and invoice details</li>
                 <li><strong>Edit and regenerate</strong> - Modify any details and create an updated invoice</li>
             </ol>
@@ -679,251 +3348,1844 @@ def show_upload_page():
         
         st.info("🔍 **Supported Data:** Patient details, invoice numbers, clinic information, session details, pricing, and dates will be automatically extracted from PAL Physiotherapy invoice PDFs.")
 
-def show_form():
-    """Invoice form page with session state preservation and edit mode"""
+def show_plan_billing_page():
+    """Month-end billing page that applies a treatment plan to many patients at once"""
     col1, col2, col3 = st.columns([1, 6, 1])
     with col1:
         if st.button("← Back"):
-            save_form_data()
             st.session_state.page = 'dashboard'
             st.rerun()
     
-    with col2:
-        if st.session_state.edit_mode:
-            st.markdown("""
-            <div style="text-align: center;">
-                <h1 style="color: #0a2a43;">✏️ Edit Invoice</h1>
-                <p style="color: #666;">Modify the invoice details below and regenerate</p>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown("""
-            <div style="text-align: center;">
-                <h1 style="color: #0a2a43;">Create New Invoice</h1>
-                <p style="color: #666;">Fill in the patient and session details below</p>
-            </div>
-            """, unsafe_allow_html=True)
+    with col2:
+        st.markdown("""
+        <div style="text-align: center;">
+            <h1 style="color: #0a2a43;">Month-End Plan Billing</h1>
+            <p style="color: #666;">Generate invoices for patients on a fixed treatment plan</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Treatment Plan</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    catalog = get_catalog()
+    today = datetime.now().date()
+    col1, col2 = st.columns(2)
+    with col1:
+        plan_name = st.selectbox("Treatment Plan", options=list(catalog['treatment_plans'].keys()))
+        clinic_location = st.selectbox(
+            "Clinic Location",
+            options=list(catalog['clinics'].keys()),
+            format_func=lambda x: catalog['clinics'][x]['display_name']
+        )
+    with col2:
+        period_start = st.date_input("Billing Period Start", value=today.replace(day=1))
+        period_end = st.date_input("Billing Period End", value=today)
+        invoice_date = st.date_input("Invoice Date", value=today)
+    
+    if not plan_name:
+        st.warning("No treatment plans are defined in the clinic catalog.")
+        return
+    
+    plan = catalog['treatment_plans'][plan_name]
+    plan_sessions, _ = expand_treatment_plan(plan, period_start, period_end)
+    plan_total = sum(s['qty'] * s['per_session_cost'] for s in plan_sessions)
+    st.info(f"📋 **{len(plan_sessions)} sessions** of {plan['description']} per patient · ₹{plan_total:,.2f} per invoice")
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Patients</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    registry = get_patient_registry()
+    if st.checkbox("Bill all registered patients"):
+        patients = list(registry.patients.values())
+    else:
+        patient_keys = st.multiselect(
+            "Select Patients",
+            options=list(registry.patients.keys()),
+            format_func=lambda key: f"{registry.patients[key]['patient_name']} · {registry.patients[key]['patient_phone']}"
+        )
+        patients = [registry.patients[key] for key in patient_keys]
+    
+    if not registry.patients:
+        st.caption("No registered patients yet. Patients are added when their invoices are generated.")
+    
+    col1, col2, col3 = st.columns([2, 2, 2])
+    with col2:
+        generate = st.button(f"Generate {len(patients)} Invoices", use_container_width=True,
+                             disabled=not patients or not plan_sessions)
+    
+    if generate:
+        with st.spinner("🔄 Generating invoices..."):
+            records = build_plan_invoices(plan, patients, clinic_location, period_start, period_end, invoice_date)
+            try:
+                save_invoice_records(records, source='plan_billing')
+            except ValueError as e:
+                st.error(str(e))
+                return
+            output = write_invoice_zip(records, io.BytesIO())
+        
+        st.success(f"✅ {len(records)} invoices generated ({records[0]['form_data']['invoice_no']} to {records[-1]['form_data']['invoice_no']})")
+        rasterizer = get_invoice_rasterizer()
+        shown = records[:BATCH_THUMBNAILS_SHOWN]
+        thumbnails = [rasterizer.image(build_invoice_data(record['form_data']), record['sessions']) for record in shown]
+        if all(thumbnails):
+            st.image(thumbnails, width=THUMBNAIL_WIDTH,
+                     caption=[f"{record['form_data']['invoice_no']} · {record['form_data']['patient_name']}" for record in shown])
+            if len(records) > len(shown):
+                st.caption(f"Showing the first {len(shown)} of {len(records)} invoices")
+        with col2:
+            st.download_button(
+                label="📥 Download All Invoices (ZIP)",
+                data=output,
+                file_name=f"PAL_Invoices_{period_start.strftime('%Y%m%d')}_{period_end.strftime('%Y%m%d')}.zip",
+                mime="application/zip",
+                use_container_width=True,
+                type="primary",
+                on_click="ignore"
+            )
+
+def show_search_page():
+    """Search stored invoices by patient name, problem description and treatment notes"""
+    col1, col2, col3 = st.columns([1, 6, 1])
+    with col1:
+        if st.button("← Back"):
+            st.session_state.page = 'dashboard'
+            st.rerun()
+    
+    with col2:
+        st.markdown("""
+        <div style="text-align: center;">
+            <h1 style="color: #0a2a43;">Search Invoices</h1>
+            <p style="color: #666;">Find past invoices by patient name, problem or treatment notes</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    catalog = get_catalog()
+    today = datetime.now().date()
+    query_text = st.text_input("Search", placeholder='e.g. "ACL", "frozen shoulder" or a patient name')
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        date_from = st.date_input("From", value=today.replace(year=today.year - 1), key="search_date_from")
+    with col2:
+        date_to = st.date_input("To", value=today, key="search_date_to")
+    with col3:
+        clinic_location = st.selectbox(
+            "Clinic",
+            options=[""] + list(catalog['clinics'].keys()),
+            format_func=lambda x: catalog['clinics'][x]['display_name'] if x else "All clinics",
+            key="search_clinic"
+        )
+    
+    filters = (query_text, date_from, date_to, clinic_location)
+    if st.session_state.get('search_filters') != filters:
+        st.session_state.search_filters = filters
+        st.session_state.search_page = 0
+    page = st.session_state.get('search_page', 0)
+    
+    results, total = search_invoices(query_text, date_from, date_to, clinic_location or None,
+                                     page=page, page_size=SEARCH_PAGE_SIZE)
+    page_count = max(1, -(-total // SEARCH_PAGE_SIZE))
+    shown_total = f"{total:,}+" if query_text.strip() and total >= SEARCH_MAX_RESULTS else f"{total:,}"
+    st.caption(f"{shown_total} invoices found · page {page + 1} of {page_count}")
+    
+    records = {record['form_data']['invoice_no']: record
+               for record in get_invoice_records([result['invoice_no'] for result in results])}
+    for result in results:
+        col0, col1, col2 = st.columns([1, 4, 1])
+        with col0:
+            record = records.get(result['invoice_no'])
+            thumbnail = record and get_invoice_rasterizer().image(build_invoice_data(record['form_data']), record['sessions'])
+            if thumbnail:
+                st.image(thumbnail, width=THUMBNAIL_WIDTH)
+        with col1:
+            st.markdown(f"**{result['patient_name']}** · {result['invoice_no']} · "
+                        f"{datetime.strptime(result['invoice_date'], '%Y-%m-%d').strftime('%d/%m/%Y')} · "
+                        f"{result['clinic_location']} · ₹{result['total_amount']:,.2f}")
+            if result['snippet']:
+                st.caption(result['snippet'])
+        with col2:
+            if st.button("✏️ Open", key=f"open_invoice_{result['invoice_no']}", use_container_width=True):
+                record = get_invoice_records([result['invoice_no']])[0]
+                st.session_state.form_data.update(record['form_data'])
+                st.session_state.sessions = record['sessions']
+                st.session_state.edit_original = None
+                st.session_state.edit_mode = True
+                st.session_state.replaces_invoice_no = record['form_data']['invoice_no']
+                st.session_state.suggested_invoice_no = None
+                st.session_state.pop('draft_id', None)
+                st.session_state.page = 'form'
+                st.rerun()
+    
+    col1, col2, col3 = st.columns([1, 4, 1])
+    with col1:
+        if st.button("← Previous", disabled=page == 0, use_container_width=True):
+            st.session_state.search_page = page - 1
+            st.rerun()
+    with col3:
+        if st.button("Next →", disabled=page + 1 >= page_count, use_container_width=True):
+            st.session_state.search_page = page + 1
+            st.rerun()
+
+def show_receivables_page():
+    """Outstanding balances per clinic by age, and the patients who owe the most"""
+    col1, col2, col3 = st.columns([1, 6, 1])
+    with col1:
+        if st.button("← Back"):
+            st.session_state.page = 'dashboard'
+            st.rerun()
+    
+    with col2:
+        st.markdown("""
+        <div style="text-align: center;">
+            <h1 style="color: #0a2a43;">Accounts Receivable</h1>
+            <p style="color: #666;">Unpaid invoice balances by clinic and age</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    catalog = get_catalog()
+    as_of = st.date_input("As of", value=datetime.now().date(), key="receivables_as_of")
+    aging = receivables_aging(as_of)
+    if aging.empty:
+        st.info("No outstanding balances. Payments are recorded from the invoice preview.")
+        return
+    
+    columns = st.columns(len(aging.columns))
+    for column, label in zip(columns, aging.columns):
+        with column:
+            st.metric(f"{label} days" if label != 'Total' else "Total Due", f"₹{aging[label].sum():,.0f}")
+    
+    aging.index = [catalog['clinics'].get(clinic, {}).get('display_name', clinic) for clinic in aging.index]
+    st.markdown("### By Clinic")
+    st.dataframe(aging.style.format("₹{:,.2f}"), use_container_width=True)
+    
+    patients = top_patient_balances()
+    if patients:
+        st.markdown("### Largest Patient Balances")
+        st.dataframe(
+            pd.DataFrame(patients).rename(columns={
+                'patient_name': "Patient", 'patient_phone': "Phone",
+                'billed': "Billed", 'paid': "Paid", 'balance': "Balance"
+            }).style.format({"Billed": "₹{:,.2f}", "Paid": "₹{:,.2f}", "Balance": "₹{:,.2f}"}),
+            use_container_width=True, hide_index=True
+        )
+
+def show_statement_page():
+    """Consolidated statement of one patient's invoices over a period"""
+    col1, col2, col3 = st.columns([1, 6, 1])
+    with col1:
+        if st.button("← Back"):
+            st.session_state.page = 'dashboard'
+            st.rerun()
+    
+    with col2:
+        st.markdown("""
+        <div style="text-align: center;">
+            <h1 style="color: #0a2a43;">Patient Statements</h1>
+            <p style="color: #666;">One statement of a patient's invoices, services and payments over a period</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    patient_query = st.text_input("🔎 Patient", key="statement_patient_query", placeholder="Type a name or phone number")
+    matches = get_patient_registry().search(patient_query) if patient_query.strip() else []
+    if not matches:
+        if patient_query.strip():
+            st.caption("No previous invoices found for this patient.")
+        return
+    match_index = st.selectbox(
+        "Matching Patients",
+        options=range(len(matches)),
+        format_func=lambda i: f"{matches[i]['patient_name']} · {matches[i]['patient_phone']} · last visit {matches[i]['last_invoice_date'].strftime('%d/%m/%Y')}",
+        key="statement_patient"
+    )
+    today = datetime.now().date()
+    col1, col2 = st.columns(2)
+    with col1:
+        date_from = st.date_input("From", value=today.replace(year=today.year - 1), key="statement_date_from")
+    with col2:
+        date_to = st.date_input("To", value=today, key="statement_date_to")
+    if date_from > date_to:
+        st.error("The start date must be on or before the end date.")
+        return
+    
+    statement = patient_statement(PatientRegistry.patient_key(matches[match_index]), date_from, date_to)
+    if statement is None:
+        st.info("No invoices for this patient in the selected period.")
+        return
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Invoices", f"{len(statement['invoices']):,}")
+    with col2:
+        st.metric("Billed", f"₹{statement['billed']:,.0f}")
+    with col3:
+        st.metric("Paid", f"₹{statement['paid']:,.0f}")
+    with col4:
+        st.metric("Balance Due", f"₹{statement['brought_forward'] + statement['billed'] - statement['paid']:,.0f}")
+    
+    html_content = generate_statement_html(statement)
+    st.components.v1.html(html_content, height=1400, scrolling=True)
+    
+    col1, col2, col3 = st.columns([2, 2, 2])
+    with col2:
+        st.download_button(
+            label="📥 Download Statement",
+            data=html_content,
+            file_name=statement_filename(statement),
+            mime="text/html",
+            use_container_width=True,
+            type="primary"
+        )
+
+def show_form():
+    """Invoice form page with session state preservation and edit mode"""
+    col1, col2, col3 = st.columns([1, 6, 1])
+    with col1:
+        go_back = st.button("← Back")
+    
+    with col2:
+        if st.session_state.edit_mode:
+            st.markdown("""
+            <div style="text-align: center;">
+                <h1 style="color: #0a2a43;">✏️ Edit Invoice</h1>
+                <p style="color: #666;">Modify the invoice details below and regenerate</p>
+            </div>
+            """, unsafe_allow_html=True)
+        else:
+            st.markdown("""
+            <div style="text-align: center;">
+                <h1 style="color: #0a2a43;">Create New Invoice</h1>
+                <p style="color: #666;">Fill in the patient and session details below</p>
+            </div>
+            """, unsafe_allow_html=True)
+    
+    if st.session_state.edit_mode:
+        st.success("📝 **Edit Mode**: You're editing a previously uploaded invoice. All fields have been pre-filled with the extracted data.")
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Invoice Details</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        invoice_no = st.text_input("Invoice No", value=st.session_state.form_data['invoice_no'],
+                                   placeholder="Assigned when saved")
+    with col2:
+        invoice_date = st.date_input("Date", value=st.session_state.form_data['invoice_date'])
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Clinic Location</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    catalog = get_catalog()
+    clinic_keys = list(catalog['clinics'].keys())
+    current_clinic = st.session_state.form_data['clinic_location']
+    clinic_location_index = clinic_keys.index(current_clinic) if current_clinic in catalog['clinics'] else 0
+    clinic_location = st.selectbox(
+        "Select Clinic Location",
+        options=clinic_keys,
+        index=clinic_location_index,
+        format_func=lambda x: catalog['clinics'][x]['display_name'],
+        help="Choose the clinic location for this invoice"
+    )
+    
+    selected_address = catalog['clinics'][clinic_location]
+    st.info(f"📍 **Selected Address:** {selected_address['short_address']}")
+    
+    practitioner = st.session_state.form_data.get('practitioner', "")
+    if catalog['practitioners']:
+        practitioner_names = list(catalog['practitioners'].keys())
+        current_practitioner = practitioner or default_practitioner(clinic_location)
+        practitioner = st.selectbox(
+            "Practitioner",
+            options=practitioner_names,
+            index=practitioner_names.index(current_practitioner) if current_practitioner in practitioner_names else 0,
+            help="The practitioner whose signature appears on the invoice"
+        )
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Patient Details</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    patient_query = st.text_input("🔎 Find Returning Patient", key="patient_lookup", placeholder="Type a name or phone number")
+    if patient_query.strip():
+        matches = get_patient_registry().search(patient_query)
+        if matches:
+            col1, col2 = st.columns([4, 2])
+            with col1:
+                match_index = st.selectbox(
+                    "Matching Patients",
+                    options=range(len(matches)),
+                    format_func=lambda i: f"{matches[i]['patient_name']} · {matches[i]['patient_phone']} · last visit {matches[i]['last_invoice_date'].strftime('%d/%m/%Y')}",
+                    label_visibility="collapsed"
+                )
+            with col2:
+                st.button("Use Patient Details", use_container_width=True,
+                          on_click=apply_registered_patient, args=(matches[match_index],))
+        else:
+            st.caption("No previous invoices found for this patient.")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        patient_name = st.text_input("Patient Name", value=st.session_state.form_data['patient_name'], placeholder="Enter patient's full name")
+        patient_sex_index = ["Male", "Female", "Others"].index(st.session_state.form_data['patient_sex'])
+        patient_sex = st.selectbox("Patient Sex", options=["Male", "Female", "Others"], index=patient_sex_index)
+    with col2:
+        patient_age = st.text_input("Patient Age", value=st.session_state.form_data['patient_age'], placeholder="Enter patient's age")
+        patient_phone = st.text_input("Patient Phone No", value=st.session_state.form_data['patient_phone'])
+        phone = phone_key(patient_phone)
+        if phone:
+            registered, phone_invoices = get_patient_registry().lookup_phone(patient_phone)
+            phone_invoices = [number for number in phone_invoices if number != invoice_no]
+            if registered and phone_invoices:
+                invoice_count = f"{len(phone_invoices)} previous invoice{'s' if len(phone_invoices) != 1 else ''}"
+                if ' '.join(patient_name.lower().split()) not in ('', registered['patient_name'].lower()):
+                    st.warning(f"📞 This number is already registered to {registered['patient_name']} "
+                               f"({invoice_count}). Check for a duplicate patient.")
+                else:
+                    st.caption(f"Returning patient · {invoice_count} with this number")
+        elif len(NON_DIGITS.sub('', patient_phone)) > 2:
+            st.caption("⚠️ Not a valid Indian mobile or landline number")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        problem_desc = st.text_area("Problem Description", value=st.session_state.form_data['problem_desc'], placeholder="Problem Description...", height=100)
+        mode_of_treatment_index = ["Clinic visit", "Home Visit", "Online Treatment"].index(st.session_state.form_data['mode_of_treatment'])
+        mode_of_treatment = st.selectbox("Mode of Treatment", options=["Clinic visit", "Home Visit", "Online Treatment"], index=mode_of_treatment_index)
+    with col2:
+        treatment_notes = st.text_area("Treatment Notes", value=st.session_state.form_data['treatment_notes'], placeholder="Treatment provided...", height=100)
+    
+    st.markdown("""
+    <div class="form-section">
+        <div class="section-title">Session Details</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        session_start_date = st.date_input("Session Start Date", value=st.session_state.form_data['session_start_date'])
+    with col2:
+        session_end_date = st.date_input("Session End Date", value=st.session_state.form_data['session_end_date'])
+    
+    col1, col2 = st.columns([4, 2])
+    with col1:
+        plan_name = st.selectbox("Treatment Plan", options=list(catalog['treatment_plans'].keys()),
+                                 help="Fill the session lines from a fixed treatment plan starting on the session start date")
+    with col2:
+        st.markdown("<div style='height: 1.75rem;'></div>", unsafe_allow_html=True)
+        st.button("Apply Plan", use_container_width=True, on_click=apply_treatment_plan,
+                  args=(plan_name, session_start_date), disabled=not plan_name)
+    
+    col1, col2 = st.columns([4, 2])
+    with col1:
+        service_name = st.selectbox(
+            "Service",
+            options=list(catalog['services'].keys()),
+            index=list(catalog['services'].keys()).index(catalog['default_service']['description']),
+            format_func=lambda x: f"{x} (₹{catalog['services'][x]['per_session_cost']:,})"
+        )
+    with col2:
+        st.markdown("<div style='height: 1.75rem;'></div>", unsafe_allow_html=True)
+        add_session = st.button("+ Add Session", use_container_width=True)
+    if add_session:
+        service = catalog['services'][service_name]
+        st.session_state.sessions = st.session_state.sessions + [{
+            'description': service['description'],
+            'qty': 1,
+            'per_session_cost': service['per_session_cost']
+        }]
+        st.rerun()
+    
+    show_session_grid(catalog)
+    
+    form_values = {
+        'invoice_no': invoice_no,
+        'invoice_date': invoice_date,
+        'clinic_location': clinic_location,
+        'patient_name': patient_name,
+        'patient_sex': patient_sex,
+        'patient_age': patient_age,
+        'patient_phone': format_phone(phone) if phone else patient_phone,
+        'problem_desc': problem_desc,
+        'treatment_notes': treatment_notes,
+        'mode_of_treatment': mode_of_treatment,
+        'session_start_date': session_start_date,
+        'session_end_date': session_end_date,
+        'practitioner': practitioner
+    }
+    save_form_data(form_values, preserve=go_back)
+    if go_back:
+        st.session_state.page = 'dashboard'
+        st.rerun()
+    
+    st.markdown("<br>", unsafe_allow_html=True)
+    col1, col2, col3 = st.columns([2, 2, 2])
+    with col2:
+        button_text = "Update Invoice Preview" if st.session_state.edit_mode else "Generate Invoice Preview"
+        if st.button(button_text, use_container_width=True):
+            if not patient_name.strip():
+                st.error("Please enter patient name")
+                return
+            if not patient_age.strip():
+                st.error("Please enter patient age")
+                return
+            if not st.session_state.sessions:
+                st.error("Please add at least one session")
+                return
+            
+            st.session_state.form_data.update(form_values)
+            if invoice_no.strip() == st.session_state.suggested_invoice_no:
+                # The number shown was only a suggestion; take whichever number is free when saving
+                st.session_state.form_data['invoice_no'] = ""
+            
+            try:
+                record = save_invoice_record(st.session_state.form_data, st.session_state.sessions,
+                                             previous=st.session_state.edit_original if st.session_state.edit_mode else None,
+                                             replaces=st.session_state.replaces_invoice_no)
+            except ValueError as e:
+                st.session_state.form_data['invoice_no'] = invoice_no
+                st.error(str(e))
+                return
+            # Going back to the form and saving again updates this invoice rather than clashing with it
+            st.session_state.form_data['invoice_no'] = record['form_data']['invoice_no']
+            st.session_state.replaces_invoice_no = record['form_data']['invoice_no']
+            st.session_state.suggested_invoice_no = None
+            st.session_state.invoice_data = build_invoice_data(st.session_state.form_data)
+            if 'draft_id' in st.session_state:
+                get_draft_store().discard(st.session_state.pop('draft_id'))
+            st.session_state.page = 'preview'
+            st.rerun()
+
+def sessions_to_frame(sessions):
+    """Return session lines as the DataFrame the session grid edits"""
+    return pd.DataFrame({
+        'description': [str(session['description']) for session in sessions],
+        'qty': safe_int_series([session['qty'] for session in sessions], 1).to_numpy(dtype=np.int64),
+        'per_session_cost': safe_int_series([session['per_session_cost'] for session in sessions]).to_numpy(dtype=np.int64),
+    })
+
+def frame_to_sessions(frame, default_cost):
+    """Validate an edited session grid in one batch and return its lines as dicts.
+    
+    Rows left without a description are dropped, quantities are at least 1
+    and blank or negative costs fall back to default_cost and 0.
+    """
+    descriptions = clean_text_series(frame['description'], 200)
+    qtys = safe_int_series(frame['qty'], 1).clip(lower=1)
+    costs = safe_int_series(frame['per_session_cost'], default_cost).clip(lower=0)
+    keep = (descriptions != "").to_numpy()
+    return intern_descriptions([
+        {'description': description, 'qty': qty, 'per_session_cost': cost}
+        for description, qty, cost in zip(descriptions[keep].tolist(), qtys[keep].tolist(), costs[keep].tolist())
+    ])
+
+def show_session_grid(catalog):
+    """Edit the session lines in one data grid, validating them once per edit"""
+    grid_key = f"session_grid_{st.session_state.get('session_grid_version', 0)}"
+    # Rebuild after outside changes, and when the grid was off screen and dropped its edits
+    if st.session_state.get('session_grid_lines') is not st.session_state.sessions or grid_key not in st.session_state:
+        st.session_state.session_grid_base = sessions_to_frame(st.session_state.sessions)
+        st.session_state.session_grid_version = st.session_state.get('session_grid_version', 0) + 1
+        st.session_state.session_grid_edits = None
+        st.session_state.session_grid_lines = st.session_state.sessions
+    
+    default_service = catalog['default_service']
+    grid_key = f"session_grid_{st.session_state.session_grid_version}"
+    edited = st.data_editor(
+        st.session_state.session_grid_base,
+        key=grid_key,
+        num_rows="dynamic",
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            'description': st.column_config.TextColumn(
+                "Description of Services", width="large", default=default_service['description'], required=True),
+            'qty': st.column_config.NumberColumn("QTY", min_value=1, step=1, format="%d", default=1, required=True),
+            'per_session_cost': st.column_config.NumberColumn(
+                "Per Session Cost (₹)", min_value=0, step=1, format="₹%d",
+                default=default_service['per_session_cost'], required=True),
+        },
+    )
+    
+    edits = json.dumps(st.session_state.get(grid_key), sort_keys=True, default=str)
+    if edits != st.session_state.session_grid_edits:
+        st.session_state.session_grid_edits = edits
+        st.session_state.sessions = frame_to_sessions(edited, default_service['per_session_cost'])
+        st.session_state.session_grid_lines = st.session_state.sessions
+    
+    sessions = st.session_state.sessions
+    session_count = sum(session['qty'] for session in sessions)
+    total_amount = sum(session['qty'] * session['per_session_cost'] for session in sessions)
+    st.caption(f"{len(sessions)} line{'s' if len(sessions) != 1 else ''} · {session_count} session"
+               f"{'s' if session_count != 1 else ''} · Total ₹{total_amount:,.2f}")
+
+def build_invoice_data(form_data):
+    """Build the renderer's invoice data from form data"""
+    invoice_data = {key: value for key, value in form_data.items() if key != 'clinic_address'}
+    invoice_data['problem_desc'] = form_data['problem_desc'] if form_data['problem_desc'] else "General consultation"
+    invoice_data['treatment_notes'] = form_data['treatment_notes'] if form_data['treatment_notes'] else "As per treatment plan"
+    invoice_data['clinic_address'] = clinic_details(form_data['clinic_location'])
+    return invoice_data
+
+def invoice_filename(data, edited=False):
+    """Build the download file name for an invoice"""
+    patient_name = data['patient_name'].strip().replace(' ', '_')
+    clinic_name = data['clinic_location'].replace(' ', '_').replace(',', '')
+    clean_filename = ''.join(c for c in patient_name if c.isalnum() or c == '_').lower()
+    edit_suffix = "_EDITED" if edited else ""
+    return f"PAL_Invoice_{clean_filename}_{clinic_name}_{data['invoice_date'].strftime('%Y%m%d')}{edit_suffix}.html"
+
+def expand_treatment_plan(plan, start_date, end_date=None):
+    """Expand a treatment plan into one session line per visit.
+    
+    Visits start on `start_date` and repeat every `cadence_days` until the
+    plan's qty is reached or `end_date` (the billing period end) is passed.
+    Returns the session lines and the date of the last visit.
+    """
+    cadence = timedelta(days=max(1, safe_int(plan['cadence_days'], 1)))
+    visits = safe_int(plan['qty'], 1)
+    if end_date is not None:
+        visits = min(visits, (end_date - start_date) // cadence + 1)
+    visits = max(visits, 0)
+    
+    line = {'description': plan['description'], 'qty': 1, 'per_session_cost': safe_int(plan['per_session_cost'])}
+    sessions = [dict(line) for _ in range(visits)]
+    last_visit = start_date + cadence * max(visits - 1, 0)
+    return sessions, last_visit
+
+def apply_treatment_plan(plan_name, start_date):
+    """Replace the form's session lines with an expanded treatment plan"""
+    sessions, last_visit = expand_treatment_plan(get_catalog()['treatment_plans'][plan_name], start_date)
+    st.session_state.sessions = sessions
+    st.session_state.form_data['session_start_date'] = start_date
+    st.session_state.form_data['session_end_date'] = last_visit
+
+def invoice_number_prefix(year=None):
+    """Return the PAL-PT-<year>- prefix invoice numbers are allocated under"""
+    return f"PAL-PT-{year or datetime.now().year}-"
+
+def last_invoice_number(conn, prefix):
+    """Return the last number allocated under a prefix, from its sequence or else the highest stored number"""
+    row = conn.execute("SELECT last_number FROM invoice_sequences WHERE prefix = ?", (prefix,)).fetchone()
+    if row is not None:
+        return row['last_number']
+    rows = conn.execute("SELECT invoice_no FROM invoices WHERE invoice_no LIKE ?", (prefix + '%',)).fetchall()
+    return max((safe_int(row['invoice_no'][len(prefix):]) for row in rows), default=0)
+
+def free_invoice_number(conn, prefix, last_number):
+    """Return (number, invoice number) for the first unused number after last_number"""
+    number = last_number + 1
+    while conn.execute("SELECT 1 FROM invoices WHERE invoice_no = ?", (f"{prefix}{number:03d}",)).fetchone():
+        number += 1
+    return number, f"{prefix}{number:03d}"
+
+def allocate_invoice_number(conn, year=None):
+    """Allocate the next unused PAL-PT-<year>-NNN invoice number.
+    
+    Must run inside the saving transaction after BEGIN IMMEDIATE, so the
+    number is reserved by the same commit that stores the invoice and no other
+    process can be given it.
+    """
+    prefix = invoice_number_prefix(year)
+    number, invoice_no = free_invoice_number(conn, prefix, last_invoice_number(conn, prefix))
+    conn.execute("INSERT OR REPLACE INTO invoice_sequences (prefix, last_number) VALUES (?, ?)", (prefix, number))
+    return invoice_no
+
+def next_invoice_number(year=None):
+    """Return the invoice number the next new invoice is likely to get, for showing on the form.
+    
+    Nothing is reserved; save_invoice_records allocates the number itself.
+    """
+    prefix = invoice_number_prefix(year)
+    conn = open_invoice_db()
+    try:
+        return free_invoice_number(conn, prefix, last_invoice_number(conn, prefix))[1]
+    finally:
+        conn.close()
+
+def build_plan_invoices(plan, patients, clinic_location, period_start, period_end, invoice_date):
+    """Create one unnumbered invoice record per patient for a treatment plan over a billing period"""
+    sessions, _ = expand_treatment_plan(plan, period_start, period_end)
+    records = []
+    for patient in patients:
+        form_data = {
+            # Numbered when saved
+            'invoice_no': "",
+            'invoice_date': invoice_date,
+            'clinic_location': clinic_location,
+            'patient_name': patient['patient_name'],
+            'patient_sex': patient['patient_sex'] or "Male",
+            'patient_age': patient['patient_age'],
+            'patient_phone': patient['patient_phone'],
+            'problem_desc': patient['problem_desc'],
+            'mode_of_treatment': patient['mode_of_treatment'] or "Clinic visit",
+            'treatment_notes': "",
+            'session_start_date': period_start,
+            'session_end_date': period_end
+        }
+        records.append({'form_data': form_data, 'sessions': [dict(session) for session in sessions]})
+    return records
+
+def read_ics_lines(paths, progress=None):
+    """Yield the unfolded content lines of .ics files one at a time.
+
+    Files are read line by line in binary so folded multi-byte characters are
+    rejoined before decoding; `progress(bytes_read)` is called every
+    CALENDAR_REPORT_BYTES.
+    """
+    bytes_read = reported = 0
+    for path in paths:
+        with open(path, 'rb') as ics_file:
+            current = None
+            for raw in ics_file:
+                bytes_read += len(raw)
+                line = raw.rstrip(b'\r\n')
+                if line[:1] in (b' ', b'\t') and current is not None:
+                    current += line[1:]
+                    continue
+                if current:
+                    yield current.decode('utf-8', 'replace')
+                current = line
+                if progress and bytes_read - reported >= CALENDAR_REPORT_BYTES:
+                    progress(bytes_read)
+                    reported = bytes_read
+            if current:
+                yield current.decode('utf-8', 'replace')
+    if progress:
+        progress(bytes_read)
+
+def parse_ics_line(line):
+    """Split a content line into (NAME, {PARAM: value}, value)"""
+    position = line.find(':')
+    if '"' in line[:position]:
+        # Quoted parameter values may contain colons
+        in_quotes = False
+        for position, char in enumerate(line):
+            if char == '"':
+                in_quotes = not in_quotes
+            elif char == ':' and not in_quotes:
+                break
+        else:
+            position = -1
+    if position < 0:
+        return line.upper(), {}, ''
+    if ';' not in line[:position]:
+        return line[:position].upper(), {}, line[position + 1:]
+    name, *params = line[:position].split(';')
+    return name.upper(), {key.upper(): value.strip('"') for key, _, value in (param.partition('=') for param in params)}, line[position + 1:]
+
+def parse_ics_events(lines):
+    """Yield each VEVENT as {NAME: (params, value)}, ignoring alarms and other nested components"""
+    event = None
+    nested = 0
+    for line in lines:
+        name, params, value = parse_ics_line(line)
+        if name == 'BEGIN':
+            if event is not None:
+                nested += 1
+            elif value.upper() == 'VEVENT':
+                event = {}
+        elif name == 'END' and event is not None:
+            if nested:
+                nested -= 1
+            else:
+                yield event
+                event = None
+        elif event is not None and not nested:
+            event.setdefault(name, (params, value))
+
+def ics_text(value):
+    """Unescape an iCalendar TEXT value"""
+    return ICS_ESCAPE.sub(lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+def ics_datetime(params, value):
+    """Return an iCalendar DATE or DATE-TIME as a naive datetime in CALENDAR_TIMEZONE.
+
+    UTC times and times with a known TZID are converted; floating times and
+    TZIDs that are not IANA names (as some exports use) are taken as local.
+    """
+    value = value.strip()
+    if not value[:8].isdigit():
+        raise ValueError(f"Invalid date: {value}")
+    if params.get('VALUE', '').upper() == 'DATE' or len(value) == 8:
+        return datetime(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    if value[8:9] != 'T' or not value[9:15].isdigit():
+        raise ValueError(f"Invalid date-time: {value}")
+    moment = datetime(int(value[:4]), int(value[4:6]), int(value[6:8]),
+                      int(value[9:11]), int(value[11:13]), int(value[13:15]))
+    zone = None
+    if value[-1:] in ('Z', 'z'):
+        zone = ZoneInfo('UTC')
+    elif params.get('TZID'):
+        try:
+            zone = ZoneInfo(params['TZID'].lstrip('/'))
+        except (KeyError, ValueError, OSError):
+            zone = None
+    if zone is None:
+        return moment
+    return moment.replace(tzinfo=zone).astimezone(ZoneInfo(CALENDAR_TIMEZONE)).replace(tzinfo=None)
+
+def ics_duration(value):
+    """Parse an iCalendar DURATION such as PT45M or P1DT2H"""
+    match = ICS_DURATION.fullmatch(value.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {value}")
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups()[1:])
+    duration = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+    return -duration if match.group(1) == '-' else duration
+
+def calendar_patient(summary, notes, services):
+    """Return (patient name, phone key or None, service) from an appointment's title and notes"""
+    phone = None
+    for match in CALENDAR_PHONE.finditer(f"{summary}\n{notes}"):
+        phone = phone_key(match.group(0))
+        if phone:
+            break
+    text = f"{summary} {notes}".lower()
+    service = next((service for service in services if service['description'].lower() in text), None)
+    name = ""
+    for part in CALENDAR_TITLE_SEPARATORS.split(CALENDAR_PHONE.sub(' ', summary)):
+        part = ' '.join(part.split())
+        if part and not any(part.lower() in service['description'].lower() for service in services):
+            name = part
+            break
+    return name, phone, service
+
+def calendar_visits(events, date_from, date_to, clinic_location, stats):
+    """Yield (date, patient name, phone key, service, clinic) for completed appointments between two dates.
+
+    Cancelled, upcoming, recurring and duplicate events are counted in `stats`
+    and skipped; only the UIDs inside the period are remembered.
+    """
+    catalog = get_catalog()
+    services = sorted(catalog['services'].values(), key=lambda service: -len(service['description']))
+    clinics = {key: [key.lower()] + [catalog['clinics'][key][field].lower() for field in ('display_name', 'short_address')]
+               for key in catalog['clinics']}
+    now = datetime.now(ZoneInfo(CALENDAR_TIMEZONE)).replace(tzinfo=None)
+    seen = set()
+    for event in events:
+        stats['events'] += 1
+        if 'DTSTART' not in event:
+            stats['invalid'] += 1
+            continue
+        if event.get('STATUS', ({}, ''))[1].strip().upper() == 'CANCELLED':
+            stats['cancelled'] += 1
+            continue
+        if 'RRULE' in event or 'RDATE' in event:
+            stats['recurring'] += 1
+            continue
+        try:
+            start = ics_datetime(*event['DTSTART'])
+            if not date_from <= start.date() <= date_to:
+                continue
+            if 'DTEND' in event:
+                end = ics_datetime(*event['DTEND'])
+            elif 'DURATION' in event:
+                end = start + ics_duration(event['DURATION'][1])
+            else:
+                end = start
+        except ValueError:
+            stats['invalid'] += 1
+            continue
+        if end > now:
+            stats['upcoming'] += 1
+            continue
+        uid = (event.get('UID', ({}, ''))[1], event.get('RECURRENCE-ID', ({}, ''))[1])
+        if uid[0] and uid in seen:
+            stats['duplicates'] += 1
+            continue
+        seen.add(uid)
+        
+        summary = ics_text(event.get('SUMMARY', ({}, ''))[1])
+        name, phone, service = calendar_patient(summary, ics_text(event.get('DESCRIPTION', ({}, ''))[1]), services)
+        if not name and not phone:
+            stats['invalid'] += 1
+            continue
+        location = ics_text(event.get('LOCATION', ({}, ''))[1]).lower()
+        clinic = clinic_location or next((key for key, names in clinics.items()
+                                          if location and any(location in text or text in location for text in names)),
+                                         next(iter(catalog['clinics'])))
+        stats['visits'] += 1
+        yield start.date(), name, phone, service or catalog['default_service'], clinic
+
+def group_calendar_visits(visits):
+    """Group visits into {(patient key, month, clinic): {'patient_name', 'patient_phone', 'visits'}}"""
+    groups = {}
+    for visit_date, name, phone, service, clinic in visits:
+        patient = {'patient_name': name, 'patient_phone': format_phone(phone) if phone else ""}
+        key = (PatientRegistry.patient_key(patient, phone or 0), visit_date.strftime('%Y-%m'), clinic)
+        group = groups.setdefault(key, dict(patient, visits=[]))
+        group['visits'].append((visit_date, service['description'], safe_int(service['per_session_cost'])))
+    return groups
+
+def build_calendar_drafts(groups, invoice_date):
+    """Turn grouped calendar visits into (draft id, draft) pairs with one session line per visit.
+
+    Patients already in the registry are filled in from their last invoice.
+    Draft ids are derived from the patient, month and clinic, so importing the
+    same calendar again replaces its drafts instead of adding more. Drafts are
+    unnumbered; each gets the next free invoice number when it is saved.
+    """
+    registry = get_patient_registry()
+    ordered = sorted(groups.items(), key=lambda item: (item[0][1], item[1]['patient_name'].lower(), item[0][2]))
+    for (patient_key, month, clinic), group in ordered:
+        registered = None
+        if group['patient_phone']:
+            registered, _ = registry.lookup_phone(group['patient_phone'])
+        else:
+            registered = next((patient for patient in registry.search(group['patient_name'])
+                               if patient['patient_name'].lower() == group['patient_name'].lower()), None)
+        visits = sorted(group['visits'])
+        form_data = {
+            'invoice_no': "",
+            'invoice_date': invoice_date,
+            'clinic_location': clinic,
+            'practitioner': "",
+            'patient_name': group['patient_name'],
+            'patient_sex': "Male",
+            'patient_age': "",
+            'patient_phone': group['patient_phone'] or "+91 ",
+            'problem_desc': "",
+            'mode_of_treatment': "Clinic visit",
+            'treatment_notes': "",
+            'session_start_date': visits[0][0],
+            'session_end_date': visits[-1][0]
+        }
+        if registered:
+            form_data.update({field: registered[field] or form_data[field] for field in PatientRegistry.PATIENT_FIELDS})
+        sessions = [{'description': description, 'qty': 1, 'per_session_cost': cost} for _, description, cost in visits]
+        draft_id = hashlib.sha1(f"calendar|{patient_key}|{month}|{clinic}".encode()).hexdigest()[:32]
+        yield draft_id, {'form_data': form_data, 'sessions': sessions, 'edit_mode': False, 'edit_original': None}
+
+def write_invoice_zip(records, output):
+    """Render invoice records into a zip of HTML files sharing one copy of each image"""
+    branding_cache = get_branding_cache()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        # Keyed by image identity; the stored reference keeps each id unique
+        written_assets = {}
+        for record in records:
+            data = build_invoice_data(record['form_data'])
+            branding = branding_cache.get(data['clinic_location'], data.get('practitioner'))
+            asset_urls = {}
+            for name in ('logo', 'watermark', 'signature'):
+                image_b64 = branding[f'{name}_b64']
+                if not image_b64:
+                    continue
+                if id(image_b64) not in written_assets:
+                    asset_path = f"assets/{hashlib.sha1(image_b64.encode()).hexdigest()[:16]}.png"
+                    archive.writestr(asset_path, base64.b64decode(image_b64), compress_type=zipfile.ZIP_STORED)
+                    written_assets[id(image_b64)] = (image_b64, asset_path)
+                asset_urls[name] = written_assets[id(image_b64)][1]
+            total_amount = sum(s['qty'] * s['per_session_cost'] for s in record['sessions'])
+            archive.writestr(f"{data['invoice_no']}_{invoice_filename(data)}", generate_invoice_html(data, record['sessions'], total_amount, asset_urls))
+    return output
+
+def compress_html(html, encoding):
+    """Compress rendered HTML for a .html.br or .html.gz file.
+    
+    'br' (brotli) and 'gz' (zopfli) spend CPU for the smallest archival files;
+    'gzip' is fast gzip for serving. Without zopfli installed, 'gz' falls back
+    to gzip at level 9.
+    """
+    data = html.encode('utf-8') if isinstance(html, str) else html
+    if encoding == 'br':
+        try:
+            import brotli
+        except ImportError:
+            raise ValueError("Brotli compression needs the brotli package")
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    if encoding == 'gz':
+        try:
+            import zopfli.gzip
+        except ImportError:
+            return gzip.compress(data, compresslevel=9, mtime=0)
+        return zopfli.gzip.compress(data, numiterations=ZOPFLI_ITERATIONS)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=SERVE_GZIP_LEVEL, mtime=0)
+    raise ValueError(f"Unknown HTML encoding: {encoding}")
+
+def decompress_html(data, encoding):
+    """Return the HTML bytes of a file written by compress_html"""
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(data)
+    if encoding in ('gz', 'gzip'):
+        return gzip.decompress(data)
+    return data
+
+def render_invoice_artifacts(data, sessions, total_amount, encodings=ARCHIVE_ENCODINGS, asset_urls=None):
+    """Render an invoice and return {file suffix: bytes}: the HTML plus one compressed copy per encoding"""
+    html = generate_invoice_html(data, sessions, total_amount, asset_urls).encode('utf-8')
+    artifacts = {HTML_SUFFIXES['identity']: html}
+    for encoding in encodings:
+        artifacts[HTML_SUFFIXES[encoding]] = compress_html(html, encoding)
+    return artifacts
+
+def process_alive(pid):
+    """Return whether a process with this pid is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class InvoiceArchive:
+    """Rendered invoices stored pre-compressed in append-only pack files.
+    
+    Records are appended to segment files under segments/ and found through a
+    SQLite index of (invoice_no, encoding) -> (segment, position, length).
+    Each record repeats its key and carries a CRC32 that is checked on every
+    read, and reads slice a memory map of the segment so serving an invoice
+    copies nothing. Re-archiving an invoice leaves its old record behind as
+    garbage; a background thread rewrites sealed segments that are less than
+    ARCHIVE_COMPACT_LIVE_RATIO live. Each process appends to its own segment.
     
-    if st.session_state.edit_mode:
-        st.success("📝 **Edit Mode**: You're editing a previously uploaded invoice. All fields have been pre-filled with the extracted data.")
+    Branding images are written once under assets/, named by content hash,
+    and the archived HTML links to them instead of inlining them as base64.
+    """
     
-    st.markdown("""
-    <div class="form-section">
-        <div class="section-title">Invoice Details</div>
-    </div>
-    """, unsafe_allow_html=True)
+    ASSET_LINK = re.compile(rb'\.\./assets/([0-9a-f]{20})\.png')
+    # Magic, encoding code, key length, payload length, CRC32 of key and payload
+    RECORD_HEADER = struct.Struct('<4sBHII')
+    RECORD_MAGIC = b'PALA'
+    ENCODING_CODES = {'identity': 0, 'br': 1, 'gz': 2}
     
-    col1, col2 = st.columns(2)
-    with col1:
-        invoice_no = st.text_input("Invoice No", value=st.session_state.form_data['invoice_no'])
-    with col2:
-        invoice_date = st.date_input("Date", value=st.session_state.form_data['invoice_date'])
+    def __init__(self, directory, encodings=ARCHIVE_ENCODINGS):
+        self.directory = directory
+        self.encodings = encodings
+        # Keyed by image identity; the stored reference keeps each id unique
+        self._assets = {}
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._segment = None
+        # Segment maps are opened by request threads and dropped by the compaction thread
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        self._compactor = None
+        self._thread_lock = threading.Lock()
     
-    st.markdown("""
-    <div class="form-section">
-        <div class="section-title">Clinic Location</div>
-    </div>
-    """, unsafe_allow_html=True)
+    def open_db(self):
+        """Open a connection to the archive index, creating it if needed"""
+        os.makedirs(os.path.join(self.directory, "segments"), exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.directory, "index.db"), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                writer_pid INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'active',
+                total_bytes INTEGER NOT NULL DEFAULT 0,
+                live_bytes INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS records (
+                invoice_no TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                segment INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                archived_at TEXT NOT NULL,
+                PRIMARY KEY (invoice_no, encoding)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_records_segment ON records (segment);
+        """)
+        # A compaction claims its segment under its own pid; hand back segments whose compactor died
+        for segment, writer_pid in conn.execute("SELECT id, writer_pid FROM segments WHERE state = 'compacting'").fetchall():
+            if not process_alive(writer_pid):
+                conn.execute("UPDATE segments SET state = 'sealed' WHERE id = ? AND state = 'compacting' AND writer_pid = ?",
+                             (segment, writer_pid))
+        return conn
     
-    clinic_location_index = list(CLINIC_ADDRESSES.keys()).index(st.session_state.form_data['clinic_location'])
-    clinic_location = st.selectbox(
-        "Select Clinic Location",
-        options=list(CLINIC_ADDRESSES.keys()),
-        index=clinic_location_index,
-        format_func=lambda x: CLINIC_ADDRESSES[x]['display_name'],
-        help="Choose the clinic location for this invoice"
-    )
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.open_db()
+        return conn
     
-    selected_address = CLINIC_ADDRESSES[clinic_location]
-    st.info(f"📍 **Selected Address:** {selected_address['short_address']}")
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "segments", f"{segment:08d}.pack")
     
-    st.markdown("""
-    <div class="form-section">
-        <div class="section-title">Patient Details</div>
-    </div>
-    """, unsafe_allow_html=True)
+    def asset_url(self, image_b64):
+        """Store a branding image once and return the link archived invoices use for it"""
+        entry = self._assets.get(id(image_b64))
+        if entry is None:
+            image = base64.b64decode(image_b64)
+            name = hashlib.sha256(image).hexdigest()[:20]
+            path = os.path.join(self.directory, "assets", f"{name}.png")
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(image)
+                os.replace(path + ".tmp", path)
+            entry = self._assets[id(image_b64)] = (image_b64, f"../assets/{name}.png")
+        return entry[1]
     
-    col1, col2 = st.columns(2)
-    with col1:
-        patient_name = st.text_input("Patient Name", value=st.session_state.form_data['patient_name'], placeholder="Enter patient's full name")
-        patient_sex_index = ["Male", "Female", "Others"].index(st.session_state.form_data['patient_sex'])
-        patient_sex = st.selectbox("Patient Sex", options=["Male", "Female", "Others"], index=patient_sex_index)
-    with col2:
-        patient_age = st.text_input("Patient Age", value=st.session_state.form_data['patient_age'], placeholder="Enter patient's age")
-        patient_phone = st.text_input("Patient Phone No", value=st.session_state.form_data['patient_phone'])
+    def render(self, record):
+        """Render one invoice record for the archive.
+        
+        Returns ({encoding: compressed HTML}, bytes the same invoice takes as a
+        standalone HTML download with its images inlined).
+        """
+        data = build_invoice_data(record['form_data'])
+        branding = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))
+        asset_urls = {}
+        inline_growth = {}
+        for name in ('logo', 'watermark', 'signature'):
+            image_b64 = branding[f'{name}_b64']
+            if image_b64:
+                asset_urls[name] = self.asset_url(image_b64)
+                inline_growth[asset_urls[name].encode()] = len("data:image/png;base64,") + len(image_b64) - len(asset_urls[name])
+        total_amount = sum(session['qty'] * session['per_session_cost'] for session in record['sessions'])
+        artifacts = render_invoice_artifacts(data, record['sessions'], total_amount, self.encodings, asset_urls)
+        html = artifacts[HTML_SUFFIXES['identity']]
+        html_bytes = len(html) + sum(html.count(link) * growth for link, growth in inline_growth.items())
+        return {encoding: artifacts[HTML_SUFFIXES[encoding]] for encoding in self.encodings}, html_bytes
     
-    col1, col2 = st.columns(2)
-    with col1:
-        problem_desc = st.text_area("Problem Description", value=st.session_state.form_data['problem_desc'], placeholder="Problem Description...", height=100)
-        mode_of_treatment_index = ["Clinic visit", "Home Visit", "Online Treatment"].index(st.session_state.form_data['mode_of_treatment'])
-        mode_of_treatment = st.selectbox("Mode of Treatment", options=["Clinic visit", "Home Visit", "Online Treatment"], index=mode_of_treatment_index)
-    with col2:
-        treatment_notes = st.text_area("Treatment Notes", value=st.session_state.form_data['treatment_notes'], placeholder="Treatment provided...", height=100)
+    def add_many(self, records):
+        """Render and archive invoice records with one append and one index transaction.
+        
+        Returns (bytes stored, bytes the invoices take as standalone HTML downloads).
+        """
+        entries = []
+        html_bytes = 0
+        for record in records:
+            payloads, html = self.render(record)
+            entries.extend((record['form_data']['invoice_no'], encoding, payload) for encoding, payload in payloads.items())
+            html_bytes += html
+        self.append(entries)
+        return sum(len(payload) for _, _, payload in entries), html_bytes
     
-    st.markdown("""
-    <div class="form-section">
-        <div class="section-title">Session Details</div>
-    </div>
-    """, unsafe_allow_html=True)
+    def add(self, record):
+        """Render and archive one invoice record"""
+        return self.add_many([record])
     
-    col1, col2 = st.columns(2)
-    with col1:
-        session_start_date = st.date_input("Session Start Date", value=st.session_state.form_data['session_start_date'])
-    with col2:
-        session_end_date = st.date_input("Session End Date", value=st.session_state.form_data['session_end_date'])
+    def append(self, entries, moved_from=None):
+        """Append (invoice_no, encoding, payload) records and point the index at them.
+        
+        With moved_from, a list of (segment, position) per entry, an entry only
+        replaces the index row still pointing there, so compaction never
+        overwrites a newer version archived in the meantime.
+        """
+        if moved_from is None:
+            # A batch may archive the same invoice twice; only the last version is kept
+            entries = list({(invoice_no, encoding): (invoice_no, encoding, payload)
+                            for invoice_no, encoding, payload in entries}.values())
+        if not entries:
+            return
+        conn = self._db()
+        with self._write_lock:
+            segment, segment_file = self._active_segment(conn)
+            position = start = segment_file.tell()
+            chunks = []
+            rows = []
+            for invoice_no, encoding, payload in entries:
+                key = invoice_no.encode('utf-8')
+                chunks += [self.RECORD_HEADER.pack(self.RECORD_MAGIC, self.ENCODING_CODES[encoding], len(key),
+                                                   len(payload), zlib.crc32(payload, zlib.crc32(key))), key, payload]
+                rows.append((invoice_no, encoding, segment, position, len(payload)))
+                position += self.RECORD_HEADER.size + len(key) + len(payload)
+            segment_file.write(b''.join(chunks))
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+            
+            archived_at = datetime.now().isoformat(timespec='seconds')
+            garbage = Counter()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row, source in zip(rows, moved_from or itertools.repeat(None)):
+                    invoice_no, encoding = row[0], row[1]
+                    record_bytes = self.RECORD_HEADER.size + len(invoice_no.encode('utf-8'))
+                    if source is not None:
+                        updated = conn.execute(
+                            """UPDATE records SET segment = ?, position = ? WHERE invoice_no = ? AND encoding = ?
+                               AND segment = ? AND position = ?""",
+                            (segment, row[3], invoice_no, encoding, *source)
+                        ).rowcount
+                        garbage[source[0] if updated else segment] += record_bytes + row[4]
+                        continue
+                    previous = conn.execute(
+                        "SELECT segment, length FROM records WHERE invoice_no = ? AND encoding = ?",
+                        (invoice_no, encoding)
+                    ).fetchone()
+                    if previous is not None:
+                        garbage[previous[0]] += record_bytes + previous[1]
+                    conn.execute(
+                        """INSERT OR REPLACE INTO records (invoice_no, encoding, segment, position, length, archived_at)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        (*row, archived_at)
+                    )
+                conn.execute(
+                    "UPDATE segments SET total_bytes = ?, live_bytes = live_bytes + ? WHERE id = ?",
+                    (position, position - start, segment)
+                )
+                conn.executemany("UPDATE segments SET live_bytes = live_bytes - ? WHERE id = ?",
+                                 [(size, garbage_segment) for garbage_segment, size in garbage.items()])
+                sealed = position >= ARCHIVE_SEGMENT_BYTES
+                if sealed:
+                    conn.execute("UPDATE segments SET state = 'sealed' WHERE id = ?", (segment,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if sealed:
+                segment_file.close()
+                self._segment = None
+        if sealed and moved_from is None:
+            self.start_compaction()
     
-    if st.button("+ Add Session"):
-        st.session_state.sessions.append({
-            'description': '60 Mins Physiotherapy Session',
-            'qty': 1,
-            'per_session_cost': 500
-        })
-        st.rerun()
+    def _active_segment(self, conn):
+        if self._segment is None:
+            segment = conn.execute("INSERT INTO segments (writer_pid) VALUES (?)", (os.getpid(),)).lastrowid
+            self._segment = (segment, open(self.segment_path(segment), 'ab'))
+        return self._segment
     
-    if st.session_state.sessions:
-        col1, col2, col3, col4 = st.columns([4, 2, 2, 1])
-        with col1:
-            st.markdown("**Description of Services**")
-        with col2:
-            st.markdown("**QTY**")
-        with col3:
-            st.markdown("**Per Session Cost**")
-        with col4:
-            st.markdown("**Action**")
+    def _map(self, segment, end):
+        with self._maps_lock:
+            segment_map = self._maps.get(segment)
+            if segment_map is None or len(segment_map) < end:
+                with open(self.segment_path(segment), 'rb') as f:
+                    segment_map = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(segment_map)
+    
+    def _record(self, invoice_no, segment, position, length):
+        """Return a zero-copy view of one record's payload after checking its header and CRC"""
+        key = invoice_no.encode('utf-8')
+        key_start = position + self.RECORD_HEADER.size
+        view = self._map(segment, key_start + len(key) + length)
+        magic, _, key_length, payload_length, crc = self.RECORD_HEADER.unpack_from(view, position)
+        payload = view[key_start + key_length:key_start + key_length + payload_length]
+        if (magic != self.RECORD_MAGIC or key_length != len(key) or payload_length != length
+                or view[key_start:key_start + key_length] != key or zlib.crc32(payload, zlib.crc32(key)) != crc):
+            raise ValueError(f"Archived copy of invoice {invoice_no} failed its integrity check")
+        return payload
     
-    for i, session in enumerate(st.session_state.sessions):
-        st.markdown(f"**Session {i+1}**")
-        col1, col2, col3, col4 = st.columns([4, 2, 2, 1])
+    def read(self, invoice_no, accept=('br', 'gzip')):
+        """Return (bytes-like, content encoding) of an archived invoice for serving.
         
-        with col1:
-            st.session_state.sessions[i]['description'] = st.text_input(
-                "Description of Services",
-                value=str(session['description']),
-                key=f"session_desc_{i}",
-                label_visibility="collapsed"
-            )
+        A stored encoding the client accepts is returned as a memoryview of the
+        segment map; otherwise the HTML is decompressed and, if the client
+        accepts gzip, re-compressed with fast gzip. Returns None if the invoice
+        is not archived.
+        """
+        for attempt in range(2):
+            rows = {row[0]: row[1:] for row in self._db().execute(
+                "SELECT encoding, segment, position, length FROM records WHERE invoice_no = ?", (invoice_no,)
+            )}
+            encoding = next((encoding for encoding in self.encodings if encoding in rows), None) or next(iter(rows), None)
+            if encoding is None:
+                return None
+            try:
+                payload = self._record(invoice_no, *rows[encoding])
+                break
+            except FileNotFoundError:
+                # Compacted away between the index lookup and the read
+                if attempt:
+                    raise
+        if encoding in accept or (encoding == 'gz' and 'gzip' in accept):
+            return payload, 'gzip' if encoding == 'gz' else encoding
+        html = decompress_html(bytes(payload), encoding)
+        return (compress_html(html, 'gzip'), 'gzip') if 'gzip' in accept else (html, 'identity')
+    
+    def standalone_html(self, invoice_no):
+        """Return an archived invoice as a self-contained HTML document, or None if it is not archived"""
+        stored = self.read(invoice_no, accept=())
+        if stored is None:
+            return None
         
-        with col2:
-            st.session_state.sessions[i]['qty'] = st.number_input(
-                "QTY",
-                min_value=1,
-                value=safe_int(session['qty'], 1),
-                key=f"session_qty_{i}",
-                label_visibility="collapsed"
-            )
+        def inline(match):
+            with open(os.path.join(self.directory, "assets", f"{match.group(1).decode()}.png"), 'rb') as f:
+                return b"data:image/png;base64," + base64.b64encode(f.read())
         
-        with col3:
-            session_cost = safe_int(session['per_session_cost'], 500)
-            st.session_state.sessions[i]['per_session_cost'] = st.number_input(
-                "Per Session Cost (₹)",
-                min_value=0,
-                value=session_cost,
-                step=1,
-                key=f"session_cost_{i}",
-                label_visibility="collapsed"
-            )
+        return self.ASSET_LINK.sub(inline, stored[0])
+    
+    def start_compaction(self):
+        """Compact sealed segments in a background thread unless one is already running"""
+        with self._thread_lock:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self._compact_in_background, name="archive-compactor", daemon=True)
+                self._compactor.start()
+    
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Invoice archive compaction failed: {e}", file=sys.stderr)
+    
+    def compact(self):
+        """Move the live records out of mostly superseded sealed segments and delete them.
         
-        with col4:
-            if len(st.session_state.sessions) > 1:
-                if st.button("🗑️", key=f"remove_session_{i}"):
-                    st.session_state.sessions.pop(i)
-                    st.rerun()
+        Returns the number of segments removed. Segments are claimed in the
+        index under this process's pid first, so concurrent compactions in other
+        processes skip them; a segment whose compaction fails or dies is
+        returned to 'sealed' to be tried again.
+        """
+        conn = self._db()
+        for segment, writer_pid in conn.execute("SELECT id, writer_pid FROM segments WHERE state = 'active'").fetchall():
+            if writer_pid != os.getpid() and not process_alive(writer_pid):
+                conn.execute("UPDATE segments SET state = 'sealed' WHERE id = ? AND state = 'active'", (segment,))
+        removed = 0
+        for (segment,) in conn.execute(
+            "SELECT id FROM segments WHERE state = 'sealed' AND live_bytes < total_bytes * ?", (ARCHIVE_COMPACT_LIVE_RATIO,)
+        ).fetchall():
+            if not conn.execute("UPDATE segments SET state = 'compacting', writer_pid = ? WHERE id = ? AND state = 'sealed'",
+                                (os.getpid(), segment)).rowcount:
+                continue
+            try:
+                rows = conn.execute(
+                    "SELECT invoice_no, encoding, position, length FROM records WHERE segment = ? ORDER BY position", (segment,)
+                ).fetchall()
+                for start in range(0, len(rows), ARCHIVE_BATCH_SIZE):
+                    batch = rows[start:start + ARCHIVE_BATCH_SIZE]
+                    self.append([(invoice_no, encoding, bytes(self._record(invoice_no, segment, position, length)))
+                                 for invoice_no, encoding, position, length in batch],
+                                moved_from=[(segment, position) for _, _, position, _ in batch])
+            except Exception:
+                conn.execute("UPDATE segments SET state = 'sealed' WHERE id = ?", (segment,))
+                raise
+            conn.execute("DELETE FROM segments WHERE id = ?", (segment,))
+            with self._maps_lock:
+                self._maps.pop(segment, None)
+            os.remove(self.segment_path(segment))
+            removed += 1
+        return removed
     
-    st.markdown("<br>", unsafe_allow_html=True)
-    col1, col2, col3 = st.columns([2, 2, 2])
-    with col2:
-        button_text = "Update Invoice Preview" if st.session_state.edit_mode else "Generate Invoice Preview"
-        if st.button(button_text, use_container_width=True):
-            if not patient_name.strip():
-                st.error("Please enter patient name")
-                return
-            if not patient_age.strip():
-                st.error("Please enter patient age")
-                return
-            
-            st.session_state.form_data.update({
-                'invoice_no': invoice_no,
-                'invoice_date': invoice_date,
-                'clinic_location': clinic_location,
-                'patient_name': patient_name,
-                'patient_sex': patient_sex,
-                'patient_age': patient_age,
-                'patient_phone': patient_phone,
-                'problem_desc': problem_desc,
-                'treatment_notes': treatment_notes,
-                'mode_of_treatment': mode_of_treatment,
-                'session_start_date': session_start_date,
-                'session_end_date': session_end_date
-            })
-            
-            st.session_state.invoice_data = {
-                'invoice_no': invoice_no,
-                'invoice_date': invoice_date,
-                'patient_name': patient_name,
-                'patient_age': patient_age,
-                'patient_sex': patient_sex,
-                'patient_phone': patient_phone,
-                'problem_desc': problem_desc if problem_desc else "General consultation",
-                'treatment_notes': treatment_notes if treatment_notes else "As per treatment plan",
-                'mode_of_treatment': mode_of_treatment,
-                'session_start_date': session_start_date,
-                'session_end_date': session_end_date,
-                'clinic_location': clinic_location,
-                'clinic_address': selected_address
-            }
-            st.session_state.page = 'preview'
-            st.rerun()
+    def storage_report(self):
+        """Return record, segment and asset counts with their sizes in bytes"""
+        segments, segment_bytes, live_bytes = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_bytes), 0), COALESCE(SUM(live_bytes), 0) FROM segments"
+        ).fetchone()
+        try:
+            asset_sizes = [entry.stat().st_size for entry in os.scandir(os.path.join(self.directory, "assets"))
+                           if not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            asset_sizes = []
+        return {
+            'records': self._db().execute("SELECT COUNT(*) FROM records").fetchone()[0],
+            'segments': segments,
+            'segment_bytes': segment_bytes,
+            'live_bytes': live_bytes,
+            'assets': len(asset_sizes),
+            'asset_bytes': sum(asset_sizes)
+        }
 
-def save_form_data():
-    """Save current form data to session state for preservation"""
-    pass
+@st.cache_resource
+def get_invoice_archive():
+    """Return the process-wide invoice archive"""
+    return InvoiceArchive(ARCHIVE_DIR)
 
-def generate_invoice_html(data, sessions, total_amount):
-    """Generate complete HTML for the professional invoice with refund policy"""
-    logo_b64 = load_logo_as_base64()
-    watermark_b64 = load_watermark_as_base64()
-    signature_b64 = load_signature_as_base64()
+def open_jobs_db():
+    """Open a connection to the background job queue, creating it if needed"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            submitted_by TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            checkpoint TEXT NOT NULL DEFAULT '{}',
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker_pid INTEGER,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat_at REAL,
+            run_seconds REAL NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+    conn.execute("CREATE TABLE IF NOT EXISTS job_workers (pid INTEGER PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+    return conn
+
+def row_to_job(row):
+    """Convert a jobs table row to a dict with decoded JSON fields"""
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['checkpoint'] = json.loads(job['checkpoint'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+def submit_job(kind, params, submitted_by):
+    """Queue a background job and make sure workers are running to pick it up"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    conn = open_jobs_db()
+    try:
+        job_id = conn.execute(
+            "INSERT INTO jobs (kind, params, submitted_by, created_at) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(params), submitted_by or "staff", time.time())
+        ).lastrowid
+    finally:
+        conn.close()
+    ensure_job_workers()
+    return job_id
+
+def list_jobs(limit=10):
+    """Return the most recent jobs, newest first"""
+    conn = open_jobs_db()
+    try:
+        return [row_to_job(row) for row in conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
+    finally:
+        conn.close()
+
+def claim_next_job(conn, worker_pid):
+    """Lease the next queued job, favouring staff with the fewest jobs already running.
     
-    if logo_b64:
-        logo_html = f'<img src="data:image/png;base64,{logo_b64}" alt="Clinic Logo">'
+    Jobs whose worker stopped heartbeating are put back in the queue first,
+    so work interrupted by a crash resumes from its last checkpoint.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', worker_pid = NULL WHERE status = 'running' AND heartbeat_at < ?",
+            (now - JOB_LEASE_SECONDS,)
+        )
+        row = conn.execute("""
+            SELECT * FROM jobs AS queued
+            WHERE status = 'queued'
+            ORDER BY (SELECT COUNT(*) FROM jobs AS running
+                      WHERE running.status = 'running' AND running.submitted_by = queued.submitted_by),
+                     created_at
+            LIMIT 1
+        """).fetchone()
+        if row is not None:
+            conn.execute(
+                """UPDATE jobs SET status = 'running', worker_pid = ?, attempts = attempts + 1,
+                   started_at = COALESCE(started_at, ?), heartbeat_at = ? WHERE id = ?""",
+                (worker_pid, now, now, row['id'])
+            )
+            # Return the leased row, whose worker and attempt identify this lease
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row_to_job(row) if row is not None else None
+
+class JobLeaseLost(Exception):
+    """Raised in a worker whose job lease expired and was handed to another worker"""
+
+def run_job(conn, job):
+    """Run one leased job, recording progress, checkpoints and timing.
+    
+    A heartbeat thread renews the lease every JOB_HEARTBEAT_SECONDS while the
+    handler runs, however long it goes between reports. Every write is made
+    only while this worker still holds the lease (the same worker and
+    attempt); if the job was requeued meanwhile, the handler is stopped at its
+    next report and its result is discarded rather than overwriting the new
+    attempt's.
+    """
+    attempt_started = time.monotonic()
+    previous_seconds = job['run_seconds']
+    leased = "id = ? AND status = 'running' AND worker_pid = ? AND attempts = ?"
+    lease = (job['id'], job['worker_pid'], job['attempts'])
+    stopped = threading.Event()
+    
+    def heartbeat():
+        heartbeat_conn = open_jobs_db()
+        try:
+            while not stopped.wait(JOB_HEARTBEAT_SECONDS):
+                now = time.time()
+                try:
+                    if not heartbeat_conn.execute(f"UPDATE jobs SET heartbeat_at = ? WHERE {leased}", (now,) + lease).rowcount:
+                        return
+                    heartbeat_conn.execute("UPDATE job_workers SET heartbeat_at = ? WHERE pid = ?", (now, job['worker_pid']))
+                except sqlite3.Error as e:
+                    print(f"Job {job['id']} heartbeat failed: {e}", file=sys.stderr)
+        finally:
+            heartbeat_conn.close()
+    
+    def report(progress, total, checkpoint):
+        now = time.time()
+        updated = conn.execute(
+            f"""UPDATE jobs SET progress = ?, total = ?, checkpoint = ?, heartbeat_at = ?, run_seconds = ?
+                WHERE {leased}""",
+            (progress, total, json.dumps(checkpoint), now,
+             previous_seconds + time.monotonic() - attempt_started) + lease
+        ).rowcount
+        if not updated:
+            raise JobLeaseLost(f"Job {job['id']} was requeued after its lease expired")
+        conn.execute("UPDATE job_workers SET heartbeat_at = ? WHERE pid = ?", (now, job['worker_pid']))
+    
+    heartbeat_thread = threading.Thread(target=heartbeat, name=f"job-{job['id']}-heartbeat", daemon=True)
+    heartbeat_thread.start()
+    try:
+        try:
+            result = JOB_HANDLERS[job['kind']](job, report)
+            status, error = 'done', None
+        except JobLeaseLost as e:
+            print(str(e), file=sys.stderr)
+            return
+        except Exception as e:
+            result, status, error = None, 'failed', str(e)
+        finished = conn.execute(
+            f"UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, run_seconds = ? WHERE {leased}",
+            (status, json.dumps(result) if result is not None else None, error, time.time(),
+             previous_seconds + time.monotonic() - attempt_started) + lease
+        ).rowcount
+        if not finished:
+            print(f"Job {job['id']} was requeued after its lease expired; result discarded", file=sys.stderr)
+    finally:
+        stopped.set()
+        heartbeat_thread.join()
+
+def run_job_worker():
+    """Worker process loop: claim and run jobs until idle for JOB_WORKER_IDLE_SECONDS"""
+    if hasattr(os, 'nice'):
+        os.nice(JOB_WORKER_NICENESS)
+    conn = open_jobs_db()
+    worker_pid = os.getpid()
+    # Subset the print fonts while waiting for the first job
+    threading.Thread(target=get_invoice_rasterizer().prewarm_fonts, name="font-prewarm", daemon=True).start()
+    idle_since = time.monotonic()
+    try:
+        while time.monotonic() - idle_since < JOB_WORKER_IDLE_SECONDS:
+            conn.execute("INSERT OR REPLACE INTO job_workers (pid, heartbeat_at) VALUES (?, ?)", (worker_pid, time.time()))
+            job = claim_next_job(conn, worker_pid)
+            if job is None:
+                time.sleep(JOB_POLL_SECONDS)
+                continue
+            run_job(conn, job)
+            idle_since = time.monotonic()
+    finally:
+        conn.execute("DELETE FROM job_workers WHERE pid = ?", (worker_pid,))
+        conn.close()
+
+def ensure_job_workers():
+    """Start worker processes until JOB_WORKER_COUNT are alive"""
+    conn = open_jobs_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM job_workers WHERE heartbeat_at < ?", (time.time() - JOB_LEASE_SECONDS,))
+        alive = conn.execute("SELECT COUNT(*) FROM job_workers").fetchone()[0]
+        log_file = open(os.path.join(DATA_DIR, "job_worker.log"), "ab")
+        try:
+            for _ in range(JOB_WORKER_COUNT - alive):
+                worker = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), "--job-worker"],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=log_file, stderr=log_file, start_new_session=True
+                )
+                conn.execute("INSERT OR REPLACE INTO job_workers (pid, heartbeat_at) VALUES (?, ?)", (worker.pid, time.time()))
+        finally:
+            log_file.close()
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def job_output_path(job, extension):
+    """Return the output file path for a job's result"""
+    output_dir = os.path.join(DATA_DIR, "exports")
+    os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, f"job_{job['id']}_{job['kind']}.{extension}")
+
+def run_render_job(job, report):
+    """Render stored invoices for a period into a zip, in resumable chunks"""
+    params = job['params']
+    parts_dir = job_output_path(job, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    
+    # Fix the invoice list on the first attempt so a resumed job renders the same chunks
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            invoice_nos = json.load(manifest_file)
+    else:
+        invoice_nos = [record['form_data']['invoice_no'] for record in
+                       query_invoice_records(params['date_from'], params['date_to'], params.get('clinic_location'))]
+        with open(manifest_path + ".tmp", 'w', encoding='utf-8') as manifest_file:
+            json.dump(invoice_nos, manifest_file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    chunks = [invoice_nos[i:i + JOB_CHUNK_SIZE] for i in range(0, len(invoice_nos), JOB_CHUNK_SIZE)]
+    
+    for chunk_index in range(job['checkpoint'].get('next_chunk', 0), len(chunks)):
+        part_path = os.path.join(parts_dir, f"part_{chunk_index:05d}.zip")
+        write_invoice_zip(get_invoice_records(chunks[chunk_index]), part_path + ".tmp")
+        os.replace(part_path + ".tmp", part_path)
+        report(min((chunk_index + 1) * JOB_CHUNK_SIZE, len(invoice_nos)), len(invoice_nos), {'next_chunk': chunk_index + 1})
+    
+    output_path = job_output_path(job, "zip")
+    with zipfile.ZipFile(output_path + ".tmp", 'w', compression=zipfile.ZIP_DEFLATED) as merged:
+        written = set()
+        for chunk_index in range(len(chunks)):
+            with zipfile.ZipFile(os.path.join(parts_dir, f"part_{chunk_index:05d}.zip")) as part:
+                for info in part.infolist():
+                    if info.filename not in written:
+                        merged.writestr(info, part.read(info.filename))
+                        written.add(info.filename)
+    os.replace(output_path + ".tmp", output_path)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return {'output_path': output_path, 'invoices': len(invoice_nos)}
+
+def run_export_job(job, report):
+    """Export stored invoices for a period as CSV"""
+    params = job['params']
+    output_path = job_output_path(job, "csv")
+    count = 0
+    with open(output_path + ".tmp", 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['invoice_no', 'invoice_date', 'clinic_location', 'patient_name', 'patient_phone',
+                         'problem_desc', 'mode_of_treatment', 'sessions', 'total_amount'])
+        records = query_invoice_records(params['date_from'], params['date_to'], params.get('clinic_location'))
+        while chunk := list(itertools.islice(records, JOB_CHUNK_SIZE)):
+            lines = SessionLineColumns.from_records(chunk)
+            for record, sessions, total_amount in zip(chunk, lines.group_sessions().tolist(), lines.group_totals().tolist()):
+                form_data = record['form_data']
+                writer.writerow([
+                    form_data['invoice_no'], form_data['invoice_date'].isoformat(), form_data['clinic_location'],
+                    form_data['patient_name'], form_data['patient_phone'], form_data.get('problem_desc', ''),
+                    form_data.get('mode_of_treatment', ''), sessions, total_amount
+                ])
+            count += len(chunk)
+            report(count, 0, {})
+    os.replace(output_path + ".tmp", output_path)
+    return {'output_path': output_path, 'invoices': count}
+
+def run_import_job(job, report):
+    """Import invoice PDFs from a zip archive or folder into the store, resuming by file index"""
+    source_path = job['params']['source_path']
+    if zipfile.is_zipfile(source_path):
+        archive = zipfile.ZipFile(source_path)
+        names = sorted(name for name in archive.namelist() if name.lower().endswith('.pdf'))
+        open_pdf = archive.open
     else:
-        logo_html = f'<img src="{get_fallback_logo()}" alt="Clinic Logo">'
+        archive = None
+        names = sorted(name for name in os.listdir(source_path) if name.lower().endswith('.pdf'))
+        open_pdf = lambda name: open(os.path.join(source_path, name), 'rb')
+    
+    checkpoint = dict(job['checkpoint'])
+    imported = checkpoint.get('imported', 0)
+    skipped = checkpoint.get('skipped', [])
+    pending = []
+    try:
+        for index in range(checkpoint.get('next_index', 0), len(names)):
+            with open_pdf(names[index]) as pdf_file:
+                _, parsed = parse_invoice_pdf(pdf_file)
+            if parsed and parsed['form_data']['invoice_no']:
+                pending.append((names[index], parsed))
+            else:
+                skipped.append(names[index])
+            
+            if len(pending) >= JOB_CHUNK_SIZE or index == len(names) - 1:
+                # Invoices already in the store are kept as they are rather than overwritten by the PDF
+                saved = save_invoice_records([parsed for _, parsed in pending], source='import', skip_existing=True)
+                saved_ids = {id(record) for record in saved}
+                skipped.extend(name for name, parsed in pending if id(parsed) not in saved_ids)
+                imported += len(saved)
+                pending = []
+                report(index + 1, len(names), {'next_index': index + 1, 'imported': imported, 'skipped': skipped})
+    finally:
+        if archive is not None:
+            archive.close()
+    return {'imported': imported, 'skipped': skipped}
 
-    if watermark_b64:
-        watermark_html = f'<img src="data:image/png;base64,{watermark_b64}" style="width: 400px; height: 400px; opacity: 0.05;">'
-    elif logo_b64:
-        watermark_html = f'<img src="data:image/png;base64,{logo_b64}" style="width: 400px; height: 400px; opacity: 0.05;">'
+def run_archive_job(job, report):
+    """Store compressed copies of the invoices for a period, or of just saved invoices, in the invoice archive"""
+    params = job['params']
+    archive = get_invoice_archive()
+    count = stored_bytes = html_bytes = 0
+    if 'invoice_nos' in params:
+        # Queued by save_invoice_records; archives each invoice as it is stored now
+        invoice_nos = params['invoice_nos']
+        records = (record for start in range(0, len(invoice_nos), JOB_CHUNK_SIZE)
+                   for record in get_invoice_records(invoice_nos[start:start + JOB_CHUNK_SIZE]))
     else:
-        watermark_html = f'<img src="{get_fallback_logo()}" style="width: 400px; height: 400px; opacity: 0.05;">'
+        records = query_invoice_records(params['date_from'], params['date_to'], params.get('clinic_location'))
+    while chunk := list(itertools.islice(records, JOB_CHUNK_SIZE)):
+        stored, html = archive.add_many(chunk)
+        stored_bytes += stored
+        html_bytes += html
+        count += len(chunk)
+        report(count, 0, {})
+    archive.compact()
+    return {'archived': count, 'stored_bytes': stored_bytes, 'html_bytes': html_bytes,
+            'archive': archive.storage_report()}
+
+def run_print_job(job, report):
+    """Merge the invoices for a period into one print-ready PDF"""
+    params = job['params']
+    records = list(query_invoice_records(params['date_from'], params['date_to'], params.get('clinic_location')))
+    if not records:
+        # The period emptied after the job was queued
+        return {'output_path': None, 'invoices': 0, 'pages': 0, 'bytes': 0}
+    output_path = job_output_path(job, "pdf")
+    pages = get_invoice_rasterizer().write_pdf(records, output_path + ".tmp", duplex=params.get('duplex', False),
+                                               cover=params.get('cover', True),
+                                               report=lambda done, total: report(done, total, {}))
+    os.replace(output_path + ".tmp", output_path)
+    return {'output_path': output_path, 'invoices': len(records), 'pages': pages,
+            'bytes': os.path.getsize(output_path)}
+
+def run_calendar_job(job, report):
+    """Create draft invoices from the completed appointments in .ics calendar exports.
     
-    if signature_b64:
-        signature_html = f'<img src="data:image/png;base64,{signature_b64}" style="max-width: 150px; max-height: 60px; object-fit: contain;">'
+    The files are streamed through a generator pipeline, so memory holds the
+    visits inside the billing period rather than the whole calendar. A rerun
+    replaces the drafts of the first attempt, so the job needs no checkpoint.
+    """
+    params = job['params']
+    source_path = params['source_path']
+    if os.path.isdir(source_path):
+        paths = sorted(os.path.join(source_path, name) for name in os.listdir(source_path) if name.lower().endswith('.ics'))
     else:
-        signature_html = '<div style="font-family: cursive; font-size: 24px; color: #333; margin-bottom: 5px;">Dr. Bhuvana</div>'
+        paths = [source_path]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    stats = Counter()
+    lines = read_ics_lines(paths, progress=lambda done: report(done, total_bytes, {}))
+    visits = calendar_visits(parse_ics_events(lines), datetime.fromisoformat(params['date_from']).date(),
+                             datetime.fromisoformat(params['date_to']).date(), params.get('clinic_location'), stats)
+    draft_store = get_draft_store()
+    drafts = 0
+    for draft_id, draft in build_calendar_drafts(group_calendar_visits(visits), datetime.now().date()):
+        draft_store.save(draft_id, draft)
+        drafts += 1
+    draft_store.flush()
+    return {'drafts': drafts, 'calendar': dict(stats)}
+
+JOB_HANDLERS = {
+    'render': run_render_job,
+    'export': run_export_job,
+    'import': run_import_job,
+    'archive': run_archive_job,
+    'print': run_print_job,
+    'calendar': run_calendar_job
+}
+
+def apply_registered_patient(patient):
+    """Prefill the form with a returning patient's details and last sessions"""
+    st.session_state.form_data.update({field: patient[field] for field in PatientRegistry.PATIENT_FIELDS})
+    st.session_state.sessions = [dict(session) for session in patient['sessions']]
+    st.session_state.patient_lookup = ""
+
+def save_form_data(form_values, preserve=False):
+    """Autosave the form's current values as a draft, keeping them in session state if preserve is set.
     
-    clinic_info = data['clinic_address']
+    The form's widgets take their initial values from form_data, so it is only
+    updated when leaving the form; the draft write itself happens in the background.
+    """
+    if preserve:
+        st.session_state.form_data.update(form_values)
+    if not any(str(form_values.get(field, "")).strip() for field in DRAFT_TEXT_FIELDS):
+        return
+    if 'draft_id' not in st.session_state:
+        st.session_state.draft_id = uuid.uuid4().hex
+    get_draft_store().save(st.session_state.draft_id, {
+        'form_data': dict(st.session_state.form_data, **form_values),
+        'sessions': [dict(session) for session in st.session_state.sessions],
+        'edit_mode': st.session_state.edit_mode,
+        'edit_original': st.session_state.edit_original if st.session_state.edit_mode else None,
+        'replaces_invoice_no': st.session_state.replaces_invoice_no,
+        'suggested_invoice_no': st.session_state.suggested_invoice_no
+    })
+
+def restore_draft(draft_id):
+    """Reopen an autosaved draft in the invoice form"""
+    draft = get_draft_store().load(draft_id)
+    if draft is None:
+        return
+    original = draft['edit_original']
+    st.session_state.form_data.update(deserialize_form_data(draft['form_data']))
+    st.session_state.sessions = intern_descriptions([dict(session) for session in draft['sessions']])
+    st.session_state.edit_mode = draft['edit_mode']
+    st.session_state.replaces_invoice_no = draft.get('replaces_invoice_no')
+    st.session_state.suggested_invoice_no = draft.get('suggested_invoice_no')
+    st.session_state.edit_original = original and {
+        'form_data': deserialize_form_data(original['form_data']),
+        'sessions': original['sessions']
+    }
+    st.session_state.uploaded_invoice_data = None
+    st.session_state.draft_id = draft_id
+    st.session_state.page = 'form'
+
+def estimate_text_lines(text, width, font_size):
+    """Estimate how many lines `text` wraps to in a box `width` pixels wide"""
+    chars_per_line = max(1, int(width / (font_size * INVOICE_CHAR_WIDTH_EM)))
+    lines = 0
+    for paragraph in str(text).split('\n'):
+        lines += 1
+        used = 0
+        for word in paragraph.split():
+            if used and used + 1 + len(word) <= chars_per_line:
+                used += 1 + len(word)
+                continue
+            if used:
+                lines += 1
+            lines += (len(word) - 1) // chars_per_line
+            used = (len(word) - 1) % chars_per_line + 1
+    return lines
+
+def paginate_invoice_sessions(data, sessions, clinic_info):
+    """Split session lines into A4 pages, returning a list of row index lists.
     
-    sessions_rows = ""
-    for i, session in enumerate(sessions):
-        row_bg = '#ffffff' if i % 2 == 0 else '#f8f9fa'
-        session_total = session['qty'] * session['per_session_cost']
-        sessions_rows += f"""
-        <tr style="background: {row_bg};">
-            <td style="padding: 10px 8px; border: 1px solid #ddd; color: #333; font-size: 14px;">{i+1}</td>
-            <td style="padding: 10px 8px; border: 1px solid #ddd; color: #333; font-size: 14px;">{session['description']}</td>
-            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: center; color: #333; font-size: 14px;">{session['qty']}</td>
-            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: right; color: #333; font-size: 14px;">₹{session['per_session_cost']:,.2f}</td>
-            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: right; color: #333; font-weight: 600; font-size: 14px;">₹{session_total:,.2f}</td>
-        </tr>
-        """
+    Block heights are estimated from the invoice stylesheet so the split is
+    the same for every renderer. Every page but the last reserves room for a
+    carried-forward row, and the last page must also fit the totals and
+    signature; the terms always go on a page of their own.
+    """
+    content_width = INVOICE_PAGE_WIDTH - 2 * INVOICE_PAGE_PADDING
+    content_height = INVOICE_PAGE_HEIGHT - 2 * INVOICE_PAGE_PADDING
+    table_row = 42
     
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>PAL Physiotherapy Invoice</title>
-        <style>
+    # Paragraphs have 3px vertical margins, which collapse between neighbours
+    def paragraph_height(text, width, font_size=14, line_height=1.3, margin=3):
+        return estimate_text_lines(text, width, font_size) * font_size * line_height + margin
+    
+    column_width = content_width / 2 - 20
+    clinic_lines = [clinic_info['display_name'], f"Location: {clinic_info['display_name']}",
+                    f"Address: {' '.join(clinic_info['full_address'].split())}", "Phone:", "Doctor:", "Registration:"]
+    patient_lines = [f"Name: {data['patient_name']}", "Age:", "Sex:", "Phone:"]
+    details_height = 3 + max(sum(paragraph_height(text, column_width) for text in lines)
+                             for lines in (clinic_lines, patient_lines))
+    medical_width = content_width - 27
+    medical_height = 24 + 26 + 3 + sum(
+        paragraph_height(f"\n{text}", medical_width) for text in (data['problem_desc'], data['treatment_notes'])
+    ) + paragraph_height("", medical_width)
+    
+    # Vertical margins between blocks collapse to the larger of the two
+    header_height = INVOICE_LOGO_HEIGHT + 18 + 20
+    first_page = (content_height - header_height - (31 + details_height) - 15 - medical_height
+                  - (15 + 34 + 36 + 8 + table_row))
+    other_pages = content_height - 50 - (8 + table_row) - table_row
+    closing_height = 15 + 100 + 25 + 125
+    description_width = content_width - 380 - 16
+    
+    pages = [[]]
+    budget, used = first_page, 0
+    for index, session in enumerate(sessions):
+        row_height = estimate_text_lines(session['description'], description_width, 14) * 14 * 1.4 + 21
+        if pages[-1] and used + row_height > budget - table_row:
+            pages.append([])
+            budget, used = other_pages, 0
+        pages[-1].append(index)
+        used += row_height
+    
+    if used + closing_height > budget:
+        # Take the last row along so the totals never sit on a page by themselves
+        pages.append([pages[-1].pop()] if len(pages[-1]) > 1 else [])
+    return pages
+
+def invoice_stylesheet(primary_color, accent_color):
+    """Return the invoice stylesheet in a clinic's brand colours"""
+    return f"""
             @page {{
                 size: A4;
                 margin: 0.5in;
@@ -940,16 +5202,46 @@ def generate_invoice_html(data, sessions, total_amount):
                 line-height: 1.4;
                 font-size: 14px;
             }}
-            .invoice-container {{
-                width: 100%;
+            .page {{
+                width: {INVOICE_PAGE_WIDTH}px;
+                height: {INVOICE_PAGE_HEIGHT}px;
                 margin: 0 auto;
                 background: white;
                 position: relative;
-                padding: 30px;
-                min-height: 100vh;
+                padding: {INVOICE_PAGE_PADDING}px;
+                page-break-after: always;
+                break-after: page;
+            }}
+            .page:last-child {{
+                page-break-after: auto;
+                break-after: auto;
+            }}
+            .page-number {{
+                position: absolute;
+                bottom: 4px;
+                right: {INVOICE_PAGE_PADDING}px;
+                font-size: 10px;
+                color: #999;
+            }}
+            .continuation-header {{
+                display: flex;
+                justify-content: space-between;
+                font-size: 16px;
+                font-weight: 600;
+                color: {primary_color};
+                padding-bottom: 8px;
+                margin-bottom: 15px;
+                border-bottom: 3px solid {accent_color};
+            }}
+            .carry-row td {{
+                background: #eef6f3;
+                font-weight: 600;
+                font-style: italic;
+                color: {primary_color};
+                padding: 10px 8px;
             }}
             .watermark {{
-                position: fixed;
+                position: absolute;
                 top: 50%;
                 left: 50%;
                 transform: translate(-50%, -50%);
@@ -966,11 +5258,12 @@ def generate_invoice_html(data, sessions, total_amount):
                 align-items: flex-start;
                 margin-bottom: 20px;
                 padding-bottom: 15px;
-                border-bottom: 3px solid #30b392;
+                border-bottom: 3px solid {accent_color};
             }}
             .logo-section img {{
                 width: 300px;
                 height: auto;
+                max-height: {INVOICE_LOGO_HEIGHT}px;
                 object-fit: contain;
             }}
             .invoice-header {{
@@ -979,7 +5272,7 @@ def generate_invoice_html(data, sessions, total_amount):
             .invoice-title {{
                 font-size: 28px;
                 font-weight: 700;
-                color: #0a2a43;
+                color: {primary_color};
                 margin-bottom: 8px;
             }}
             .invoice-meta {{
@@ -1007,10 +5300,10 @@ def generate_invoice_html(data, sessions, total_amount):
             .section-title {{
                 font-size: 14px;
                 font-weight: 600;
-                color: #0a2a43;
+                color: {primary_color};
                 margin-bottom: 8px;
                 padding-bottom: 5px;
-                border-bottom: 2px solid #30b392;
+                border-bottom: 2px solid {accent_color};
             }}
             .section-content p {{
                 margin: 3px 0;
@@ -1023,7 +5316,7 @@ def generate_invoice_html(data, sessions, total_amount):
             }}
             .medical-details {{
                 background: #f8f9fa;
-                border-left: 3px solid #30b392;
+                border-left: 3px solid {accent_color};
                 padding: 12px;
                 margin: 15px 0;
                 border-radius: 0 4px 4px 0;
@@ -1031,7 +5324,7 @@ def generate_invoice_html(data, sessions, total_amount):
             .medical-details h4 {{
                 font-size: 14px;
                 font-weight: 600;
-                color: #0a2a43;
+                color: {primary_color};
                 margin-bottom: 6px;
             }}
             .medical-details p {{
@@ -1046,9 +5339,9 @@ def generate_invoice_html(data, sessions, total_amount):
             .sessions-title {{
                 font-size: 14px;
                 font-weight: 600;
-                color: #0a2a43;
+                color: {primary_color};
                 margin-bottom: 8px;
-                border-bottom: 1px solid #30b392;
+                border-bottom: 1px solid {accent_color};
                 padding-bottom: 5px;
             }}
             .session-dates {{
@@ -1062,7 +5355,7 @@ def generate_invoice_html(data, sessions, total_amount):
                 margin-top: 8px;
             }}
             th {{
-                background: #0a2a43;
+                background: {primary_color};
                 color: white;
                 padding: 10px 8px;
                 text-align: left;
@@ -1118,7 +5411,7 @@ def generate_invoice_html(data, sessions, total_amount):
                 text-align: center;
             }}
             .signature-line {{
-                border-bottom: 1px solid #0a2a43;
+                border-bottom: 1px solid {primary_color};
                 width: 200px;
                 margin: 8px auto 4px;
             }}
@@ -1128,18 +5421,16 @@ def generate_invoice_html(data, sessions, total_amount):
                 font-weight: 500;
             }}
             .terms-section {{
-                margin-top: 40px;
                 padding: 12px;
                 background: #f8f9fa;
                 border-radius: 4px;
                 border: 1px solid #e0e0e0;
-                page-break-before: always;
                 page-break-inside: avoid;
             }}
             .terms-title {{
                 font-size: 12px;
                 font-weight: 600;
-                color: #0a2a43;
+                color: {primary_color};
                 margin-bottom: 6px;
             }}
             .terms-content {{
@@ -1164,28 +5455,148 @@ def generate_invoice_html(data, sessions, total_amount):
                 font-size: 11px;
                 font-weight: 700;
             }}
+            @media screen {{
+                body {{
+                    background: #eef0f2;
+                    padding: 20px 0;
+                }}
+                .page {{
+                    margin-bottom: 20px;
+                    box-shadow: 0 2px 8px rgba(0, 0, 0, 0.15);
+                }}
+            }}
             @media print {{
                 body {{ 
                     margin: 0; 
                     -webkit-print-color-adjust: exact;
                     print-color-adjust: exact;
                 }}
-                .invoice-container {{ 
-                    padding: 20px;
-                    min-height: auto;
-                }}
-                .watermark {{
-                    position: fixed !important;
-                }}
             }}
-        </style>
-    </head>
-    <body>
-        <div class="invoice-container">
+        """
+
+def invoice_html_cache_entry(data, sessions, total_amount, asset_urls=None):
+    """Return (cache key, placeholder URLs, images) for an invoice's HTML in the shared cache.
+    
+    The HTML is cached with a placeholder for each branding image, so it stays
+    small and one entry serves previews and batch outputs alike; `images` maps
+    each placeholder to the caller's URL, or to the image's data URI.
+    """
+    catalog = get_catalog()
+    branding = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))
+    asset_urls = asset_urls or {}
+    placeholder_urls = {}
+    images = {}
+    for name in ('logo', 'watermark', 'signature'):
+        if asset_urls.get(name) or branding[f'{name}_b64']:
+            placeholder_urls[name] = SHARED_CACHE_IMAGE_PLACEHOLDER.format(name)
+            images[placeholder_urls[name]] = asset_urls.get(name) or f"data:image/png;base64,{branding[f'{name}_b64']}"
+    key = shared_cache_key(RENDER_CACHE_VERSION, data, sessions, total_amount, sorted(placeholder_urls),
+                           branding['spec'], catalog['contact'], catalog['policy'])
+    return key, placeholder_urls, images
+
+def generate_invoice_html(data, sessions, total_amount, asset_urls=None):
+    """Generate complete HTML for the professional invoice with refund policy.
+    
+    `asset_urls` optionally maps 'logo', 'watermark' and 'signature' to image
+    URLs so batch outputs can reference one shared copy of each image. The
+    HTML comes from the shared cache when any process has rendered it before.
+    """
+    key, placeholder_urls, images = invoice_html_cache_entry(data, sessions, total_amount, asset_urls)
+    cache = get_shared_cache()
+    cached = cache.get('html', key)
+    if cached is None:
+        html_content = render_invoice_html(data, sessions, total_amount, placeholder_urls)
+        cache.put('html', key, html_content.encode('utf-8'))
+    else:
+        html_content = cached.decode('utf-8')
+    if not images:
+        return html_content
+    return SHARED_CACHE_IMAGE_PATTERN.sub(lambda match: images.get(match.group(0), match.group(0)), html_content)
+
+def render_invoice_html(data, sessions, total_amount, asset_urls=None):
+    """Render the invoice HTML without consulting the shared cache"""
+    asset_urls = asset_urls or {}
+    catalog = get_catalog()
+    contact = catalog['contact']
+    policy = catalog['policy']
+    branding = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))
+    primary_color = branding['primary_color']
+    accent_color = branding['accent_color']
+    logo_b64 = branding['logo_b64']
+    watermark_b64 = branding['watermark_b64']
+    signature_b64 = branding['signature_b64']
+    
+    logo_src = asset_urls.get('logo') or (f"data:image/png;base64,{logo_b64}" if logo_b64 else get_fallback_logo())
+    watermark_src = asset_urls.get('watermark') or (f"data:image/png;base64,{watermark_b64}" if watermark_b64 else logo_src)
+    signature_src = asset_urls.get('signature') or (f"data:image/png;base64,{signature_b64}" if signature_b64 else None)
+    
+    logo_html = f'<img src="{logo_src}" alt="Clinic Logo">'
+    watermark_html = f'<img src="{watermark_src}" style="width: 400px; height: 400px; opacity: 0.05;">'
+    
+    if signature_src:
+        signature_html = f'<img src="{signature_src}" style="max-width: 150px; max-height: 60px; object-fit: contain;">'
+    else:
+        signature_html = f'<div style="font-family: cursive; font-size: 24px; color: #333; margin-bottom: 5px;">{branding["practitioner"]}</div>'
+    
+    clinic_info = data['clinic_address']
+    terms_items = "".join(f"<li>{term}</li>" for term in policy.get('terms', []))
+    
+    row_pages = paginate_invoice_sessions(data, sessions, clinic_info)
+    page_count = len(row_pages) + 1
+    
+    def session_row(i, session):
+        row_bg = '#ffffff' if i % 2 == 0 else '#f8f9fa'
+        session_total = session['qty'] * session['per_session_cost']
+        return f"""
+        <tr style="background: {row_bg};">
+            <td style="padding: 10px 8px; border: 1px solid #ddd; color: #333; font-size: 14px;">{i+1}</td>
+            <td style="padding: 10px 8px; border: 1px solid #ddd; color: #333; font-size: 14px;">{session['description']}</td>
+            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: center; color: #333; font-size: 14px;">{session['qty']}</td>
+            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: right; color: #333; font-size: 14px;">₹{session['per_session_cost']:,.2f}</td>
+            <td style="padding: 10px 8px; border: 1px solid #ddd; text-align: right; color: #333; font-weight: 600; font-size: 14px;">₹{session_total:,.2f}</td>
+        </tr>
+        """
+    
+    def carry_row(label, amount):
+        return f"""
+        <tr class="carry-row">
+            <td colspan="4">{label}</td>
+            <td style="text-align: right;">₹{amount:,.2f}</td>
+        </tr>
+        """
+    
+    def page_html(number, content):
+        return f"""
+        <div class="page">
             <div class="watermark">
                 {watermark_html}
             </div>
             <div class="invoice-content">
+                {content}
+            </div>
+            <div class="page-number">Page {number} of {page_count}</div>
+        </div>
+        """
+    
+    table_head = """
+                    <table>
+                        <thead>
+                            <tr>
+                                <th style="width: 60px;">S.No</th>
+                                <th>Description of Services</th>
+                                <th style="width: 80px;">QTY</th>
+                                <th style="width: 120px;">Per Session Cost</th>
+                                <th style="width: 120px;">Total</th>
+                            </tr>
+                        </thead>
+                        <tbody>"""
+    
+    pages_html = []
+    running_total = 0
+    for page_index, rows in enumerate(row_pages):
+        is_last = page_index == len(row_pages) - 1
+        if page_index == 0:
+            content = f"""
                 <div class="header">
                     <div class="logo-section">
                         {logo_html}
@@ -1212,12 +5623,12 @@ def generate_invoice_html(data, sessions, total_amount):
                     <div class="clinic-section">
                         <div class="section-title">Clinic Details:</div>
                         <div class="section-content">
-                            <p><strong>PAL Physiotherapy & Sports Rehab</strong></p>
+                            <p><strong>{contact.get('clinic_name', 'PAL Physiotherapy & Sports Rehab')}</strong></p>
                             <p><strong>Location:</strong> {clinic_info['display_name']}</p>
                             <p><strong>Address:</strong> {clinic_info['full_address']}</p>
-                            <p><strong>Phone:</strong> +91 8639398229</p>
-                            <p><strong>Doctor:</strong> Dr. Bhuvana</p>
-                            <p><strong>Registration:</strong> UDYAM-TS-09-0137821</p>
+                            <p><strong>Phone:</strong> {contact.get('phone', '')}</p>
+                            <p><strong>Doctor:</strong> {branding['practitioner']}</p>
+                            <p><strong>Registration:</strong> {branding['registration']}</p>
                         </div>
                     </div>
                 </div>
@@ -1234,23 +5645,32 @@ def generate_invoice_html(data, sessions, total_amount):
                     <div class="session-dates">
                         <strong>Session Start Date:</strong> {data['session_start_date'].strftime('%d/%m/%Y')} | 
                         <strong>Session End Date:</strong> {data['session_end_date'].strftime('%d/%m/%Y')}
-                    </div>
-                    <table>
-                        <thead>
-                            <tr>
-                                <th style="width: 60px;">S.No</th>
-                                <th>Description of Services</th>
-                                <th style="width: 80px;">QTY</th>
-                                <th style="width: 120px;">Per Session Cost</th>
-                                <th style="width: 120px;">Total</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {sessions_rows}
-                        </tbody>
-                    </table>
+                    </div>"""
+        else:
+            content = f"""
+                <div class="continuation-header">
+                    <span>INVOICE <span class="invoice-number">{data['invoice_no']}</span> (continued)</span>
+                    <span>{data['patient_name']}</span>
                 </div>
-                
+                <div class="sessions-section">"""
+        
+        if rows or page_index == 0:
+            content += table_head
+            if page_index > 0:
+                content += carry_row("Brought forward", running_total)
+            for i in rows:
+                content += session_row(i, sessions[i])
+                running_total += sessions[i]['qty'] * sessions[i]['per_session_cost']
+            if not is_last:
+                content += carry_row("Carried forward", running_total)
+            content += """
+                        </tbody>
+                    </table>"""
+        content += """
+                </div>"""
+        
+        if is_last:
+            content += f"""
                 <div class="totals-section">
                     <div>
                         <div class="subtotal-box">
@@ -1276,21 +5696,206 @@ def generate_invoice_html(data, sessions, total_amount):
                         <div class="signature-line"></div>
                         <div class="signature-label">Authorized Signature</div>
                     </div>
-                </div>
-                
+                </div>"""
+        pages_html.append(page_html(page_index + 1, content))
+    
+    pages_html.append(page_html(page_count, f"""
                 <div class="terms-section">
                     <div class="terms-title">Terms & Conditions</div>
                     <div class="terms-content">
                         <ol>
-                            <li>The clinic is not responsible for severe reactions during prescribed medical treatment unless due to office personnel without proper supervision.</li>
-                            <li>Clients are required to disclose any pre-existing medical conditions, injuries, or medications before starting therapy.</li>
-                            <li>The clinic shall not be held liable for complications arising from undisclosed medical conditions.</li>
-                            <li>All pending sessions should agree to the treatment plan and appointment fee associated procedures.</li>
-                            <li>In case of disputes, efforts will be made to resolve them amicably. Jurisdiction for any legal matters will be Hyderabad, Telangana.</li>
+                            {terms_items}
                         </ol>
                     </div>
                     <div class="refund-policy">
-                        <strong>Kindly note - The amount which you pay in package is not refundable.</strong>
+                        <strong>{policy.get('refund_notice', '')}</strong>
+                    </div>
+                </div>"""))
+    
+    html_content = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>PAL Physiotherapy Invoice</title>
+        <style>{invoice_stylesheet(primary_color, accent_color)}</style>
+    </head>
+    <body>
+        {"".join(pages_html)}
+    </body>
+    </html>
+    """
+    return html_content
+
+def generate_statement_html(statement):
+    """Generate the HTML statement of a patient's invoices and services in the invoice branding.
+
+    The statement is one flowing page, so long invoice lists break across
+    printed A4 sheets with their table headers repeated.
+    """
+    catalog = get_catalog()
+    contact = catalog['contact']
+    data = statement['form_data']
+    clinic_info = clinic_details(data['clinic_location'])
+    branding = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))
+    primary_color = branding['primary_color']
+    accent_color = branding['accent_color']
+    logo_src = f"data:image/png;base64,{branding['logo_b64']}" if branding['logo_b64'] else get_fallback_logo()
+    watermark_src = f"data:image/png;base64,{branding['watermark_b64']}" if branding['watermark_b64'] else logo_src
+    
+    if branding['signature_b64']:
+        signature_html = f'<img src="data:image/png;base64,{branding["signature_b64"]}" style="max-width: 150px; max-height: 60px; object-fit: contain;">'
+    else:
+        signature_html = f'<div style="font-family: cursive; font-size: 24px; color: #333; margin-bottom: 5px;">{branding["practitioner"]}</div>'
+    
+    balance_due = statement['brought_forward'] + statement['billed'] - statement['paid']
+    service_rows = "".join(f"""
+                            <tr>
+                                <td>{i + 1}</td>
+                                <td>{service['description']}</td>
+                                <td style="text-align: center;">{service['sessions']}</td>
+                                <td style="text-align: right;">₹{service['amount']:,.2f}</td>
+                            </tr>""" for i, service in enumerate(statement['services']))
+    invoice_rows = "".join(f"""
+                            <tr>
+                                <td>{invoice['invoice_no']}</td>
+                                <td>{invoice['invoice_date'].strftime('%d/%m/%Y')}</td>
+                                <td>{catalog['clinics'].get(invoice['clinic_location'], {}).get('display_name', invoice['clinic_location'])}</td>
+                                <td style="text-align: right;">₹{invoice['billed']:,.2f}</td>
+                                <td style="text-align: right;">₹{invoice['paid']:,.2f}</td>
+                                <td style="text-align: right;">₹{invoice['billed'] - invoice['paid']:,.2f}</td>
+                            </tr>""" for invoice in statement['invoices'])
+    
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>PAL Physiotherapy Statement</title>
+        <style>{invoice_stylesheet(primary_color, accent_color)}
+            .statement-page {{
+                height: auto;
+                min-height: {INVOICE_PAGE_HEIGHT}px;
+            }}
+            .statement-page .watermark {{
+                top: {INVOICE_PAGE_HEIGHT // 2}px;
+            }}
+            thead {{
+                display: table-header-group;
+            }}
+            tr {{
+                page-break-inside: avoid;
+                break-inside: avoid;
+            }}
+            tbody tr:nth-child(even) {{
+                background: #f8f9fa;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="page statement-page">
+            <div class="watermark">
+                <img src="{watermark_src}" style="width: 400px; height: 400px; opacity: 0.05;">
+            </div>
+            <div class="invoice-content">
+                <div class="header">
+                    <div class="logo-section">
+                        <img src="{logo_src}" alt="Clinic Logo">
+                    </div>
+                    <div class="invoice-header">
+                        <div class="invoice-title">STATEMENT</div>
+                        <div class="invoice-meta">
+                            Period: <strong>{statement['date_from'].strftime('%d/%m/%Y')} – {statement['date_to'].strftime('%d/%m/%Y')}</strong><br>
+                            Date: <strong>{datetime.now().strftime('%d/%m/%Y')}</strong>
+                        </div>
+                    </div>
+                </div>
+                
+                <div class="patient-clinic-row">
+                    <div class="patient-section">
+                        <div class="section-title">Patient Details:</div>
+                        <div class="section-content">
+                            <p><strong>Name:</strong> {data['patient_name']}</p>
+                            <p><strong>Age:</strong> {data['patient_age']}</p>
+                            <p><strong>Sex:</strong> {data['patient_sex']}</p>
+                            <p><strong>Phone:</strong> {data['patient_phone']}</p>
+                        </div>
+                    </div>
+                    <div class="clinic-section">
+                        <div class="section-title">Clinic Details:</div>
+                        <div class="section-content">
+                            <p><strong>{contact.get('clinic_name', 'PAL Physiotherapy & Sports Rehab')}</strong></p>
+                            <p><strong>Location:</strong> {clinic_info['display_name']}</p>
+                            <p><strong>Address:</strong> {clinic_info['full_address']}</p>
+                            <p><strong>Phone:</strong> {contact.get('phone', '')}</p>
+                            <p><strong>Doctor:</strong> {branding['practitioner']}</p>
+                            <p><strong>Registration:</strong> {branding['registration']}</p>
+                        </div>
+                    </div>
+                </div>
+                
+                <div class="sessions-section">
+                    <div class="sessions-title">Services</div>
+                    <table>
+                        <thead>
+                            <tr>
+                                <th style="width: 60px;">S.No</th>
+                                <th>Description of Services</th>
+                                <th style="width: 100px;">Sessions</th>
+                                <th style="width: 140px;">Total</th>
+                            </tr>
+                        </thead>
+                        <tbody>{service_rows}
+                        </tbody>
+                    </table>
+                </div>
+                
+                <div class="sessions-section">
+                    <div class="sessions-title">Invoices</div>
+                    <table>
+                        <thead>
+                            <tr>
+                                <th style="width: 150px;">Invoice No</th>
+                                <th style="width: 100px;">Date</th>
+                                <th>Clinic</th>
+                                <th style="width: 110px;">Amount</th>
+                                <th style="width: 110px;">Paid</th>
+                                <th style="width: 110px;">Balance</th>
+                            </tr>
+                        </thead>
+                        <tbody>{invoice_rows}
+                        </tbody>
+                    </table>
+                </div>
+                
+                <div class="totals-section">
+                    <div>
+                        <div class="subtotal-box">
+                            <div class="subtotal-row">
+                                <span>Previous balance</span>
+                                <span>₹{statement['brought_forward']:,.2f}</span>
+                            </div>
+                            <div class="subtotal-row">
+                                <span>Billed</span>
+                                <span>₹{statement['billed']:,.2f}</span>
+                            </div>
+                            <div class="subtotal-row">
+                                <span>Paid</span>
+                                <span>₹{statement['paid']:,.2f}</span>
+                            </div>
+                        </div>
+                        <div class="total-box">
+                            <span>Balance Due</span>
+                            <span>₹{balance_due:,.2f}</span>
+                        </div>
+                    </div>
+                </div>
+                
+                <div class="signature-section">
+                    <div class="signature-wrapper">
+                        {signature_html}
+                        <div class="signature-line"></div>
+                        <div class="signature-label">Authorized Signature</div>
                     </div>
                 </div>
             </div>
@@ -1298,7 +5903,723 @@ def generate_invoice_html(data, sessions, total_amount):
     </body>
     </html>
     """
-    return html_content
+
+def statement_filename(statement):
+    """Build the download file name for a patient statement"""
+    patient_name = statement['form_data']['patient_name'].strip().replace(' ', '_')
+    clean_filename = ''.join(c for c in patient_name if c.isalnum() or c == '_').lower()
+    return (f"PAL_Statement_{clean_filename}_{statement['date_from'].strftime('%Y%m%d')}"
+            f"_{statement['date_to'].strftime('%Y%m%d')}.html")
+
+def hex_to_rgb(color):
+    """Convert a #rrggbb color to the 0-1 RGB tuple PyMuPDF draws with"""
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    try:
+        return tuple(int(color[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    except ValueError:
+        return (0.0, 0.0, 0.0)
+
+class FontSubsetter:
+    """Keyed LRU cache of font programs cut down to a glyph set.
+    
+    Glyph ids are kept, so a subset can replace the program MuPDF embedded
+    for the full font without rewriting any page content.
+    """
+    
+    def __init__(self, max_entries=FONT_SUBSET_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._subsets = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def subset(self, name, program, glyph_ids):
+        """Return `program` cut down to the frozenset `glyph_ids`, or None when fontTools is not installed"""
+        key = (name, glyph_ids)
+        with self._lock:
+            if key in self._subsets:
+                self._subsets.move_to_end(key)
+                self.hits += 1
+                return self._subsets[key]
+            self.misses += 1
+        try:
+            subset_program = self._subset_program(program, glyph_ids)
+        except ImportError:
+            return None
+        with self._lock:
+            self._subsets[key] = subset_program
+            while len(self._subsets) > self.max_entries:
+                self._subsets.popitem(last=False)
+        return subset_program
+    
+    def _subset_program(self, program, glyph_ids):
+        from fontTools import subset
+        from fontTools.ttLib import TTFont, newTable
+        
+        # MuPDF's built-in Helvetica is a bare CFF program rather than an OpenType file
+        bare_cff = program[:4] not in (b'OTTO', b'\x00\x01\x00\x00', b'true')
+        if bare_cff:
+            font = TTFont()
+            font.sfntVersion = 'OTTO'
+            font['CFF '] = newTable('CFF ')
+            font['CFF '].decompile(program, font)
+        else:
+            font = TTFont(io.BytesIO(program))
+        options = subset.Options(retain_gids=True, notdef_outline=True, hinting=False, desubroutinize=True,
+                                 name_IDs=['*'])
+        options.drop_tables += ['GSUB', 'GPOS', 'GDEF', 'BASE', 'JSTF', 'MATH']
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(gids=sorted(glyph_ids))
+        subsetter.subset(font)
+        if bare_cff:
+            return font['CFF '].compile(font)
+        output = io.BytesIO()
+        font.save(output)
+        return output.getvalue()
+
+@st.cache_resource
+def get_font_subsetter():
+    """Share one font subset cache across all sessions in the process"""
+    return FontSubsetter()
+
+class RasterCanvas:
+    """Text, line and box drawing on one PyMuPDF page, in CSS pixels"""
+    
+    def __init__(self, fitz, page, fonts, widths=None, image_xrefs=None, used_chars=None):
+        self.fitz = fitz
+        self.page = page
+        self.fonts = fonts
+        self.shape = page.new_shape()
+        self._writers = {}
+        self._widths = widths if widths is not None else {}
+        self._image_xrefs = image_xrefs
+        self._used_chars = used_chars
+    
+    def text_width(self, text, size, bold=False):
+        key = (text, size, bold)
+        if key not in self._widths:
+            font = self.fonts['bold' if bold else 'regular']
+            self._widths[key] = (font.text_length(text.replace('₹', ''), fontsize=size)
+                                 + text.count('₹') * self.fonts['symbol'].text_length('₹', fontsize=size))
+        return self._widths[key]
+    
+    def text(self, x, baseline, text, size=14, bold=False, color=(0.2, 0.2, 0.2), align='left'):
+        """Draw one line of text; `x` is the left, right or centre edge depending on `align`"""
+        if align == 'right':
+            x -= self.text_width(text, size, bold)
+        elif align == 'center':
+            x -= self.text_width(text, size, bold) / 2
+        if color not in self._writers:
+            self._writers[color] = self.fitz.TextWriter(self.page.rect, color=color)
+        writer = self._writers[color]
+        font = self.fonts['bold' if bold else 'regular']
+        if self._used_chars is not None:
+            self._used_chars['bold' if bold else 'regular'].update(text)
+            if '₹' in text:
+                self._used_chars['symbol'].add('₹')
+        for index, part in enumerate(text.split('₹')):
+            if index:
+                _, point = writer.append((x, baseline), '₹', font=self.fonts['symbol'], fontsize=size)
+                x = point.x
+            if part:
+                _, point = writer.append((x, baseline), part, font=font, fontsize=size)
+                x = point.x
+        return x
+    
+    def wrap(self, runs, width, size):
+        """Greedily wrap (text, bold) runs into lines of (word, bold, word width)"""
+        space = self.text_width(' ', size)
+        lines, line, used = [], [], 0
+        for text, bold in runs:
+            for index, paragraph in enumerate(str(text).split('\n')):
+                if index:
+                    lines.append(line)
+                    line, used = [], 0
+                for word in paragraph.split():
+                    word_width = self.text_width(word, size, bold)
+                    if line and used + space + word_width > width:
+                        lines.append(line)
+                        line, used = [], 0
+                    used += (space if line else 0) + word_width
+                    line.append((word, bold, word_width))
+        lines.append(line)
+        return lines
+    
+    def paragraph(self, runs, x, top, width, size=14, line_height=1.3, color=(0.2, 0.2, 0.2), lines=None):
+        """Draw wrapped runs from `top` and return the y just below the last line"""
+        lines = lines if lines is not None else self.wrap(runs, width, size)
+        space = self.text_width(' ', size)
+        for line in lines:
+            baseline = top + size * (line_height + 0.7) / 2
+            word_x = x
+            for bold, words in itertools.groupby(line, key=lambda word: word[1]):
+                words = list(words)
+                self.text(word_x, baseline, ' '.join(word for word, _, _ in words), size, bold, color)
+                word_x += sum(word_width for _, _, word_width in words) + space * len(words)
+            top += size * line_height
+        return top
+    
+    def rect(self, x0, y0, x1, y1, fill=None, color=None, width=1):
+        self.shape.draw_rect(self.fitz.Rect(x0, y0, x1, y1))
+        self.shape.finish(color=color, fill=fill, width=width)
+    
+    def line(self, x0, y0, x1, y1, color, width=1):
+        self.shape.draw_line((x0, y0), (x1, y1))
+        self.shape.finish(color=color, width=width)
+    
+    def image(self, x0, y0, x1, y1, image_bytes):
+        """Draw an image; with an image_xrefs dict, each distinct image is embedded in the document once"""
+        rect = self.fitz.Rect(x0, y0, x1, y1)
+        if self._image_xrefs is None:
+            self.page.insert_image(rect, stream=image_bytes)
+        elif image_bytes in self._image_xrefs:
+            self.page.insert_image(rect, xref=self._image_xrefs[image_bytes])
+        else:
+            self._image_xrefs[image_bytes] = self.page.insert_image(rect, stream=image_bytes)
+    
+    def finish(self):
+        self.shape.commit()
+        for writer in self._writers.values():
+            writer.write_text(self.page)
+
+class InvoiceRasterizer:
+    """Draws invoice pages with PyMuPDF and caches them as images by content hash"""
+    
+    TEXT = (0.2, 0.2, 0.2)
+    MUTED = (0.4, 0.4, 0.4)
+    BORDER = (0.867, 0.867, 0.867)
+    PANEL = (0.973, 0.976, 0.98)
+    
+    def __init__(self, cache_dir=RASTER_CACHE_DIR, max_bytes=RASTER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._fonts = None
+        # Text widths by (text, size, bold), shared by every page drawn
+        self._widths = {}
+        # Branding images shrunk to their drawn size, keyed by (id(base64), box);
+        # the base64 string is kept alongside so its id stays unique
+        self._images = {}
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+    
+    def page_count(self, data, sessions):
+        """Number of pages the invoice renders to, including the terms page"""
+        return len(paginate_invoice_sessions(data, sessions, data['clinic_address'])) + 1
+    
+    def cache_key(self, data, sessions, page_index, width):
+        """Hash everything that affects how an invoice page looks"""
+        catalog = get_catalog()
+        spec = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))['spec']
+        content = json.dumps([RASTER_LAYOUT_VERSION, width, page_index, data, sessions, spec,
+                              catalog['contact'], catalog['policy']], sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+    
+    def image(self, data, sessions, page_index=0, width=THUMBNAIL_WIDTH):
+        """Return one invoice page as image bytes, drawing it on a cache miss.
+        
+        Returns None when PyMuPDF is not installed.
+        """
+        path = os.path.join(self.cache_dir, f"{self.cache_key(data, sessions, page_index, width)}.png")
+        try:
+            with open(path, 'rb') as image_file:
+                self.hits += 1
+                return image_file.read()
+        except FileNotFoundError:
+            pass
+        try:
+            import fitz
+        except ImportError:
+            return None
+        
+        started = time.perf_counter()
+        with self._lock:
+            document = fitz.open()
+            try:
+                self._draw_page(fitz, document, data, sessions, page_index)
+                scale = width / INVOICE_PAGE_WIDTH
+                pixmap = document[0].get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            finally:
+                document.close()
+        image_bytes = self._encode(pixmap)
+        self.misses += 1
+        self.render_seconds += time.perf_counter() - started
+        
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as image_file:
+            image_file.write(image_bytes)
+        os.replace(tmp_path, path)
+        self._writes += 1
+        if self._writes % 200 == 0:
+            self.prune()
+        return image_bytes
+    
+    def prune(self):
+        """Delete the least recently written images until the cache is under 80% of max_bytes"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".png")]
+        except FileNotFoundError:
+            return
+        stats = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+        total = sum(size for _, size, _ in stats)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in stats:
+            if total <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+    
+    def stats(self):
+        """Report cache hits, misses and average draw time"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'avg_render_ms': self.render_seconds / self.misses * 1000 if self.misses else 0.0}
+    
+    def write_pdf(self, records, path, duplex=False, cover=True, report=None, subset_fonts=True):
+        """Draw invoice records into one print-ready A4 PDF at `path` and return its page count"""
+        try:
+            import fitz
+        except ImportError:
+            raise ValueError("Print batches need PyMuPDF")
+        
+        invoices = []
+        for record in records:
+            data = build_invoice_data(record['form_data'])
+            total_amount = sum(session['qty'] * session['per_session_cost'] for session in record['sessions'])
+            invoices.append((data, record['sessions'], total_amount, self.page_count(data, record['sessions'])))
+        cover_pages = self._cover_pages(invoices) if cover else []
+        if not invoices and not cover_pages:
+            raise ValueError("No invoices to print")
+        
+        first_pages = []
+        page_number = len(cover_pages) + (len(cover_pages) % 2 if duplex else 0) + 1
+        for *_, page_count in invoices:
+            first_pages.append(page_number)
+            page_number += page_count + (page_count % 2 if duplex else 0)
+        
+        part_path = path + ".part"
+        image_xrefs = {}
+        fonts = {}
+        used_chars = {key: set() for key in FONT_COMMON_CHARS}
+        document = fitz.open()
+        try:
+            with self._lock:
+                for rows in cover_pages:
+                    self._draw_cover(fitz, document, invoices, first_pages, rows, len(cover_pages), used_chars)
+                    self._fit_to_a4(fitz, document, document[-1])
+                if duplex and len(cover_pages) % 2:
+                    document.new_page(width=PRINT_PAGE_WIDTH, height=PRINT_PAGE_HEIGHT)
+            for start in range(0, len(invoices), PRINT_CHUNK_SIZE):
+                with self._lock:
+                    first_new_page = document.page_count
+                    for data, sessions, _, page_count in invoices[start:start + PRINT_CHUNK_SIZE]:
+                        for page_index in range(page_count):
+                            self._draw_page(fitz, document, data, sessions, page_index, image_xrefs, used_chars)
+                            self._fit_to_a4(fitz, document, document[-1])
+                        if duplex and page_count % 2:
+                            document.new_page(width=PRINT_PAGE_WIDTH, height=PRINT_PAGE_HEIGHT)
+                    self._share_fonts(document, range(first_new_page, document.page_count), fonts)
+                    if start == 0:
+                        document.save(part_path)
+                    else:
+                        document.save(part_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                    document.close()
+                    document = fitz.open(part_path)
+                if report:
+                    report(min(start + PRINT_CHUNK_SIZE, len(invoices)), len(invoices))
+            with self._lock:
+                page_count = document.page_count
+                if subset_fonts:
+                    self._subset_fonts(fitz, document, fonts, used_chars)
+                # Drops the font copies _share_fonts left unreferenced
+                document.save(path, garbage=1, deflate=True)
+        finally:
+            document.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return page_count
+    
+    def _fit_to_a4(self, fitz, document, page):
+        """Scale a page drawn in CSS pixels onto A4 inside the print margins"""
+        scale = (PRINT_PAGE_WIDTH - 2 * PRINT_MARGIN) / INVOICE_PAGE_WIDTH
+        bottom = PRINT_PAGE_HEIGHT - PRINT_MARGIN - INVOICE_PAGE_HEIGHT * scale
+        contents = page.get_contents()
+        document.update_stream(contents[0], f"q {scale:g} 0 0 {scale:g} {PRINT_MARGIN} {bottom:g} cm\n".encode()
+                               + document.xref_stream(contents[0]))
+        document.update_stream(contents[-1], document.xref_stream(contents[-1]) + b"\nQ")
+        page.set_mediabox(fitz.Rect(0, 0, PRINT_PAGE_WIDTH, PRINT_PAGE_HEIGHT))
+    
+    def _share_fonts(self, document, page_numbers, fonts):
+        """Point the pages' font resources at the first embedded copy of each font.
+        
+        Reopening the document between chunks empties MuPDF's font cache, so
+        each chunk embeds its fonts again; `fonts` maps a font's name and
+        program digest to the copy every later chunk should use.
+        """
+        canonical = {}
+        for page_number in page_numbers:
+            kind, resources = document.xref_get_key(document[page_number].xref, "Resources")
+            if kind != 'xref':
+                continue
+            resources_xref = int(resources.split()[0])
+            kind, font_dict = document.xref_get_key(resources_xref, "Font")
+            if kind != 'dict':
+                continue
+            for xref in map(int, re.findall(r'(\d+) 0 R', font_dict)):
+                if xref not in canonical:
+                    name, _, _, program = document.extract_font(xref)
+                    canonical[xref] = fonts.setdefault((name, hashlib.sha1(program).hexdigest()), xref)
+            shared = re.sub(r'(\d+) 0 R', lambda match: f"{canonical[int(match.group(1))]} 0 R", font_dict)
+            if shared != font_dict:
+                document.xref_set_key(resources_xref, "Font", shared)
+    
+    def _subset_fonts(self, fitz, document, fonts, used_chars):
+        """Replace each shared font's program with a subset of the glyphs in `used_chars`.
+        
+        Fonts MuPDF fell back to on its own are left whole.
+        """
+        drawn = {font.name: key for key, font in self._get_fonts(fitz).items()}
+        for (name, _), xref in fonts.items():
+            if name not in drawn:
+                continue
+            font = self._get_fonts(fitz)[drawn[name]]
+            glyph_ids = self._glyph_set(font, used_chars[drawn[name]] | set(FONT_COMMON_CHARS[drawn[name]]))
+            program = get_font_subsetter().subset(name, font.buffer, glyph_ids)
+            if program is None:
+                return
+            # PDF names a subset font with a six-letter tag unique to its glyph set
+            tag = ''.join(chr(ord('A') + byte % 26) for byte in hashlib.sha1(program).digest()[:6])
+            cid_xref = int(document.xref_get_key(xref, "DescendantFonts")[1].strip('[] ').split()[0])
+            descriptor_xref = int(document.xref_get_key(cid_xref, "FontDescriptor")[1].split()[0])
+            for font_xref, key in ((xref, "BaseFont"), (cid_xref, "BaseFont"), (descriptor_xref, "FontName")):
+                kind, value = document.xref_get_key(font_xref, key)
+                if kind == 'name':
+                    document.xref_set_key(font_xref, key, f"/{tag}+{value[1:]}".replace(" ", "#20"))
+            for key in ("FontFile", "FontFile2", "FontFile3"):
+                kind, value = document.xref_get_key(descriptor_xref, key)
+                if kind == 'xref':
+                    file_xref = int(value.split()[0])
+                    document.update_stream(file_xref, program)
+                    if document.xref_get_key(file_xref, "Length1")[0] != 'null':
+                        document.xref_set_key(file_xref, "Length1", str(len(program)))
+    
+    def _glyph_set(self, font, chars):
+        return frozenset({0} | {font.has_glyph(ord(char)) for char in chars})
+    
+    def prewarm_fonts(self):
+        """Subset each font to its common characters ahead of the first PDF"""
+        try:
+            import fitz
+        except ImportError:
+            return
+        with self._lock:
+            fonts = [(font.name, font.buffer, self._glyph_set(font, FONT_COMMON_CHARS[key]))
+                     for key, font in self._get_fonts(fitz).items()]
+        for name, program, glyph_ids in fonts:
+            get_font_subsetter().subset(name, program, glyph_ids)
+    
+    def _cover_pages(self, invoices):
+        """Split the cover's invoice list into pages; the first page also holds the summary"""
+        clinics = len({data['clinic_location'] for data, *_ in invoices})
+        first_rows = max(0, PRINT_COVER_ROWS - clinics - 8)
+        pages = [range(0, min(first_rows, len(invoices)))]
+        for start in range(first_rows, len(invoices), PRINT_COVER_ROWS):
+            pages.append(range(start, min(start + PRINT_COVER_ROWS, len(invoices))))
+        return pages
+    
+    def _draw_cover(self, fitz, document, invoices, first_pages, rows, cover_page_count, used_chars=None):
+        contact = get_catalog()['contact']
+        primary = hex_to_rgb(DEFAULT_PRIMARY_COLOR)
+        page = document.new_page(width=INVOICE_PAGE_WIDTH, height=INVOICE_PAGE_HEIGHT)
+        canvas = RasterCanvas(fitz, page, self._get_fonts(fitz), self._widths, used_chars=used_chars)
+        left, right = INVOICE_PAGE_PADDING, INVOICE_PAGE_WIDTH - INVOICE_PAGE_PADDING
+        y = INVOICE_PAGE_PADDING
+        cover_index = document.page_count - 1
+        canvas.text(right, INVOICE_PAGE_HEIGHT - 8, f"Cover {cover_index + 1} of {cover_page_count}", 10,
+                    color=(0.6, 0.6, 0.6), align='right')
+        
+        if cover_index == 0:
+            canvas.text(left, y + 28, contact.get('clinic_name', 'PAL Physiotherapy & Sports Rehab'), 22, True, primary)
+            canvas.text(left, y + 56, "Invoice Print Batch", 18, True, self.TEXT)
+            page_total = sum(page_count for *_, page_count in invoices)
+            canvas.text(left, y + 80, f"{len(invoices)} invoices · {page_total} invoice pages · printed "
+                        f"{datetime.now().strftime('%d/%m/%Y %H:%M')}", 12, color=self.MUTED)
+            y += 96
+            canvas.line(left, y, right, y, primary, 2)
+            y += 8
+            clinic_totals = {}
+            for data, _, total_amount, _ in invoices:
+                count, amount = clinic_totals.get(data['clinic_address']['display_name'], (0, 0))
+                clinic_totals[data['clinic_address']['display_name']] = (count + 1, amount + total_amount)
+            for name, (count, amount) in sorted(clinic_totals.items()) + [("Total", (len(invoices), sum(
+                    total_amount for _, _, total_amount, _ in invoices)))]:
+                bold = name == "Total"
+                canvas.text(left, y + 16, name, 12, bold, self.TEXT)
+                canvas.text(right - 160, y + 16, f"{count} invoices", 12, bold, self.TEXT, align='right')
+                canvas.text(right, y + 16, f"₹{amount:,.2f}", 12, bold, self.TEXT, align='right')
+                y += 20
+            y += 12
+        
+        if rows:
+            edges = [left, left + 150, left + 240, right - 180, right - 120, right]
+            canvas.rect(left, y, right, y + 22, fill=primary)
+            for index, label in enumerate(("Invoice No", "Date", "Patient", "Page", "Amount")):
+                x, align = (edges[index + 1] - 6, 'right') if index >= 3 else (edges[index] + 6, 'left')
+                canvas.text(x, y + 15, label, 11, True, (1, 1, 1), align=align)
+            y += 22
+            for row in rows:
+                data, _, total_amount, _ = invoices[row]
+                patient_name = data['patient_name']
+                while len(patient_name) > 3 and canvas.text_width(patient_name, 11) > edges[3] - edges[2] - 12:
+                    patient_name = patient_name[:-4] + "…"
+                if row % 2:
+                    canvas.rect(left, y, right, y + 20, fill=self.PANEL)
+                canvas.text(edges[0] + 6, y + 14, data['invoice_no'], 11, color=self.TEXT)
+                canvas.text(edges[1] + 6, y + 14, data['invoice_date'].strftime('%d/%m/%Y'), 11, color=self.TEXT)
+                canvas.text(edges[2] + 6, y + 14, patient_name, 11, color=self.TEXT)
+                canvas.text(edges[4] - 6, y + 14, str(first_pages[row]), 11, color=self.TEXT, align='right')
+                canvas.text(edges[5] - 6, y + 14, f"₹{total_amount:,.2f}", 11, color=self.TEXT, align='right')
+                y += 20
+        canvas.finish()
+    
+    def _encode(self, pixmap):
+        """Encode a page as a palette PNG, about a fifth of the size of a true-color one"""
+        try:
+            from PIL import Image
+        except ImportError:
+            return pixmap.tobytes("png")
+        image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+        output = io.BytesIO()
+        image.quantize(colors=RASTER_PALETTE_COLORS, method=Image.Quantize.FASTOCTREE).save(output, format="PNG")
+        return output.getvalue()
+    
+    def _get_fonts(self, fitz):
+        if self._fonts is None:
+            self._fonts = {'regular': fitz.Font("helv"), 'bold': fitz.Font("hebo"), 'symbol': fitz.Font(script=0)}
+        return self._fonts
+    
+    def _get_image(self, fitz, image_b64, max_width, max_height):
+        """Decode a branding image shrunk to fit the box at preview resolution.
+        
+        Returns (png bytes, drawn width, drawn height) or None for a missing image.
+        """
+        if not image_b64:
+            return None
+        key = (id(image_b64), max_width, max_height)
+        if key not in self._images:
+            try:
+                pixmap = fitz.Pixmap(base64.b64decode(image_b64))
+            except Exception:
+                self._images[key] = (image_b64, None)
+                return None
+            scale = min(max_width / pixmap.width, max_height / pixmap.height, 1.0)
+            width, height = pixmap.width * scale, pixmap.height * scale
+            density = 2 * PREVIEW_IMAGE_WIDTH / INVOICE_PAGE_WIDTH
+            if pixmap.width > width * density:
+                pixmap = fitz.Pixmap(pixmap, int(width * density), int(height * density), None)
+            self._images[key] = (image_b64, (pixmap.tobytes("png"), width, height))
+            if len(self._images) > 4 * BRANDING_CACHE_SIZE:
+                self._images.pop(next(iter(self._images)))
+        return self._images[key][1]
+    
+    def _draw_page(self, fitz, document, data, sessions, page_index, image_xrefs=None, used_chars=None):
+        catalog = get_catalog()
+        contact = catalog['contact']
+        policy = catalog['policy']
+        branding = get_branding_cache().get(data['clinic_location'], data.get('practitioner'))
+        primary = hex_to_rgb(branding['primary_color'])
+        accent = hex_to_rgb(branding['accent_color'])
+        clinic_info = data['clinic_address']
+        row_pages = paginate_invoice_sessions(data, sessions, clinic_info)
+        page_count = len(row_pages) + 1
+        
+        page = document.new_page(width=INVOICE_PAGE_WIDTH, height=INVOICE_PAGE_HEIGHT)
+        if len(self._widths) > RASTER_WIDTH_CACHE_SIZE:
+            self._widths.clear()
+        canvas = RasterCanvas(fitz, page, self._get_fonts(fitz), self._widths, image_xrefs, used_chars)
+        left, right = INVOICE_PAGE_PADDING, INVOICE_PAGE_WIDTH - INVOICE_PAGE_PADDING
+        y = INVOICE_PAGE_PADDING
+        canvas.text(right, INVOICE_PAGE_HEIGHT - 8, f"Page {page_index + 1} of {page_count}", 10, color=(0.6, 0.6, 0.6), align='right')
+        
+        if page_index == len(row_pages):
+            terms = [canvas.wrap([(f"{number}. {term}", False)], right - left - 24, 10)
+                     for number, term in enumerate(policy.get('terms', []), 1)]
+            notice = canvas.wrap([(policy.get('refund_notice', ''), True)], right - left - 40, 11)
+            notice_height = len(notice) * 14.3 + 18
+            height = 12 + 22 + sum(len(lines) * 13 + 6 for lines in terms) + 8 + notice_height + 12
+            canvas.rect(left, y, right, y + height, fill=self.PANEL, color=(0.878, 0.878, 0.878))
+            canvas.text(left + 12, y + 24, "Terms & Conditions", 12, True, primary)
+            y += 34
+            for lines in terms:
+                y = canvas.paragraph(None, left + 12, y + 3, right - left - 24, 10, 1.3, self.MUTED, lines) + 3
+            y += 8
+            canvas.rect(left + 12, y, right - 12, y + notice_height, fill=(1.0, 0.953, 0.804), color=(1.0, 0.918, 0.655))
+            top = y + 9
+            for line in notice:
+                line_text = " ".join(word for word, _, _ in line)
+                canvas.text((left + right) / 2, top + 11, line_text, 11, True, (0.522, 0.392, 0.016), align='center')
+                top += 14.3
+            canvas.finish()
+            return
+        
+        rows = row_pages[page_index]
+        is_last = page_index == len(row_pages) - 1
+        if page_index == 0:
+            logo = self._get_image(fitz, branding['logo_b64'], 300, INVOICE_LOGO_HEIGHT)
+            if logo:
+                image_bytes, width, height = logo
+                canvas.image(left, y, left + width, y + height, image_bytes)
+            else:
+                canvas.text(left, y + 30, contact.get('clinic_name', 'PAL Physiotherapy & Sports Rehab'), 20, True, primary)
+            canvas.text(right, y + 26, "INVOICE", 28, True, primary, align='right')
+            canvas.text(right, y + 56, data['invoice_no'], 16, True, (0.953, 0.612, 0.071), align='right')
+            canvas.text(right - canvas.text_width(data['invoice_no'], 16, True), y + 56, "Invoice number: ", 14,
+                        color=self.MUTED, align='right')
+            date_text = data['invoice_date'].strftime('%d/%m/%Y')
+            canvas.text(right, y + 76, date_text, 14, True, self.TEXT, align='right')
+            canvas.text(right - canvas.text_width(date_text, 14, True), y + 76, "Date: ", 14, color=self.MUTED, align='right')
+            y += INVOICE_LOGO_HEIGHT + 15
+            canvas.line(left, y + 1.5, right, y + 1.5, accent, 3)
+            y += 3 + 20
+            
+            column_width = (right - left) / 2 - 20
+            sections = [
+                (left, "Patient Details:", [
+                    [("Name: ", True), (data['patient_name'], False)],
+                    [("Age: ", True), (data['patient_age'], False)],
+                    [("Sex: ", True), (data['patient_sex'], False)],
+                    [("Phone: ", True), (data['patient_phone'], False)]
+                ]),
+                (right - column_width, "Clinic Details:", [
+                    [(contact.get('clinic_name', 'PAL Physiotherapy & Sports Rehab'), True)],
+                    [("Location: ", True), (clinic_info['display_name'], False)],
+                    [("Address: ", True), (' '.join(clinic_info['full_address'].split()), False)],
+                    [("Phone: ", True), (contact.get('phone', ''), False)],
+                    [("Doctor: ", True), (branding['practitioner'], False)],
+                    [("Registration: ", True), (branding['registration'], False)]
+                ])
+            ]
+            bottom = y
+            for x, title, paragraphs in sections:
+                canvas.text(x, y + 14, title, 14, True, primary)
+                canvas.line(x, y + 22, x + column_width, y + 22, accent, 2)
+                top = y + 31 + 3
+                for runs in paragraphs:
+                    top = canvas.paragraph(runs, x, top, column_width) + 3
+                bottom = max(bottom, top)
+            y = bottom + 15
+            
+            medical = [
+                [("Problem Description:", True), (f"\n{data['problem_desc']}", False)],
+                [("Treatment Notes:", True), (f"\n{data['treatment_notes']}", False)],
+                [("Mode of Treatment: ", True), (data['mode_of_treatment'], False)]
+            ]
+            medical_lines = [canvas.wrap(runs, right - left - 27, 14) for runs in medical]
+            height = 12 + 22 + sum(len(lines) * 18.2 + 6 for lines in medical_lines) + 12
+            canvas.rect(left, y, right, y + height, fill=self.PANEL)
+            canvas.rect(left, y, left + 3, y + height, fill=accent)
+            canvas.text(left + 15, y + 24, "Medical Details:", 14, True, primary)
+            top = y + 34
+            for lines in medical_lines:
+                top = canvas.paragraph(None, left + 15, top + 3, right - left - 27, lines=lines) + 3
+            y += height + 15
+            
+            canvas.text(left, y + 14, "Session Details", 14, True, primary)
+            canvas.line(left, y + 22, right, y + 22, accent, 1)
+            y += 31
+            canvas.paragraph([("Session Start Date:", True), (f" {data['session_start_date'].strftime('%d/%m/%Y')} | ", False),
+                              ("Session End Date:", True), (f" {data['session_end_date'].strftime('%d/%m/%Y')}", False)],
+                             left, y + 8, right - left, line_height=1.4)
+            y += 8 + 19.6 + 8
+        else:
+            canvas.text(left, y + 16, f"INVOICE {data['invoice_no']} (continued)", 16, True, primary)
+            canvas.text(right, y + 16, data['patient_name'], 16, True, primary, align='right')
+            y += 26
+            canvas.line(left, y + 1.5, right, y + 1.5, accent, 3)
+            y += 3 + 15
+        
+        # Session table: S.No, description, qty, per session cost, total
+        edges = [left, left + 60, right - 320, right - 240, right - 120, right]
+        y += 8
+        canvas.rect(left, y, right, y + 42, fill=primary, color=self.BORDER)
+        for index, label in enumerate(("S.No", "Description of Services", "QTY", "Per Session Cost", "Total")):
+            if index == 4:
+                canvas.text(edges[5] - 8, y + 25, label, 12, True, (1, 1, 1), align='right')
+            else:
+                canvas.text(edges[index] + 8, y + 25, label, 12, True, (1, 1, 1))
+        y += 42
+        
+        running_total = sum(sessions[i]['qty'] * sessions[i]['per_session_cost'] for page_rows in row_pages[:page_index] for i in page_rows)
+        
+        def carry_row(top, label, amount):
+            canvas.rect(left, top, right, top + 42, fill=(0.933, 0.965, 0.953), color=self.BORDER)
+            canvas.line(edges[4], top, edges[4], top + 42, self.BORDER)
+            canvas.text(left + 8, top + 25, label, 14, True, primary)
+            canvas.text(right - 8, top + 25, f"₹{amount:,.2f}", 14, True, primary, align='right')
+            return top + 42
+        
+        if page_index > 0:
+            y = carry_row(y, "Brought forward", running_total)
+        for i in rows:
+            session = sessions[i]
+            session_total = session['qty'] * session['per_session_cost']
+            running_total += session_total
+            lines = canvas.wrap([(session['description'], False)], edges[2] - edges[1] - 16, 14)
+            height = len(lines) * 19.6 + 21
+            for x0, x1 in zip(edges, edges[1:]):
+                canvas.rect(x0, y, x1, y + height, color=self.BORDER)
+            baseline = y + height / 2 + 5
+            canvas.text(edges[0] + 8, baseline, str(i + 1), 14, color=self.TEXT)
+            canvas.paragraph(None, edges[1] + 8, y + 10.5, edges[2] - edges[1] - 16, 14, 1.4, self.TEXT, lines)
+            canvas.text((edges[2] + edges[3]) / 2, baseline, str(session['qty']), 14, color=self.TEXT, align='center')
+            canvas.text(edges[4] - 8, baseline, f"₹{session['per_session_cost']:,.2f}", 14, color=self.TEXT, align='right')
+            canvas.text(edges[5] - 8, baseline, f"₹{session_total:,.2f}", 14, True, self.TEXT, align='right')
+            y += height
+        
+        if not is_last:
+            carry_row(y, "Carried forward", running_total)
+            canvas.finish()
+            return
+        
+        total_amount = running_total
+        y += 15
+        canvas.rect(right - 200, y, right, y + 35.6, fill=self.PANEL)
+        canvas.text(right - 192, y + 23, "Subtotal", 14, color=self.TEXT)
+        canvas.text(right - 8, y + 23, f"₹{total_amount:,.2f}", 14, color=self.TEXT, align='right')
+        y += 35.6 + 6
+        canvas.rect(right - 200, y, right, y + 42.4, fill=(0.153, 0.682, 0.376))
+        canvas.text(right - 190, y + 27, "Total", 16, True, (1, 1, 1))
+        canvas.text(right - 10, y + 27, f"₹{total_amount:,.2f}", 16, True, (1, 1, 1), align='right')
+        y += 42.4 + 8
+        canvas.text(right, y + 13, "Nil", 12, True, self.MUTED, align='right')
+        canvas.text(right - canvas.text_width("Nil", 12, True), y + 13, "Sales Tax: ", 12, color=self.MUTED, align='right')
+        y += 17 + 8 + 20
+        
+        signature_center = right - 100
+        signature = self._get_image(fitz, branding['signature_b64'], 150, 60)
+        if signature:
+            image_bytes, width, height = signature
+            canvas.image(signature_center - width / 2, y, signature_center + width / 2, y + height, image_bytes)
+            y += height
+        else:
+            canvas.text(signature_center, y + 26, branding['practitioner'], 22, color=self.TEXT, align='center')
+            y += 36
+        canvas.line(right - 200, y + 8, right, y + 8, primary, 1)
+        canvas.text(signature_center, y + 24, "Authorized Signature", 12, color=self.MUTED, align='center')
+        canvas.finish()
+
+@st.cache_resource
+def get_invoice_rasterizer():
+    """Share one raster preview cache across all sessions in the server process"""
+    return InvoiceRasterizer()
 
 def show_preview():
     """Invoice preview and download page"""
@@ -1327,17 +6648,27 @@ def show_preview():
     data = st.session_state.invoice_data
     total_amount = sum(session['qty'] * session['per_session_cost'] for session in st.session_state.sessions)
     
-    patient_name = data['patient_name'].strip().replace(' ', '_')
-    clinic_name = data['clinic_location'].replace(' ', '_').replace(',', '')
-    clean_filename = ''.join(c for c in patient_name if c.isalnum() or c == '_').lower()
-    
-    edit_suffix = "_EDITED" if st.session_state.edit_mode else ""
-    html_filename = f"PAL_Invoice_{clean_filename}_{clinic_name}_{data['invoice_date'].strftime('%Y%m%d')}{edit_suffix}.html"
+    html_filename = invoice_filename(data, st.session_state.edit_mode)
     
     html_content = generate_invoice_html(data, st.session_state.sessions, total_amount)
     
     st.markdown("---")
-    st.components.v1.html(html_content, height=1400, scrolling=True)
+    rasterizer = get_invoice_rasterizer()
+    show_document = st.toggle("📄 Show full document", value=False,
+                              help="Load the complete HTML invoice instead of a page image")
+    page_image = None
+    if not show_document:
+        page_count = rasterizer.page_count(data, st.session_state.sessions)
+        page_number = 1
+        if page_count > 1:
+            page_number = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+        page_image = rasterizer.image(data, st.session_state.sessions, page_number - 1, PREVIEW_IMAGE_WIDTH)
+    if page_image is not None:
+        col1, col2, col3 = st.columns([1, 6, 1])
+        with col2:
+            st.image(page_image, width=PREVIEW_IMAGE_WIDTH, caption=f"Page {page_number} of {page_count}")
+    else:
+        st.components.v1.html(html_content, height=1400, scrolling=True)
     
     st.markdown("---")
     st.markdown("<h3 style='text-align: center; color: #0a2a43; margin: 20px 0;'>Download Invoice</h3>", unsafe_allow_html=True)
@@ -1390,6 +6721,16 @@ def show_preview():
     if st.session_state.edit_mode:
         st.info("📝 **This is an edited invoice** - Updated from previously uploaded PDF")
     
+    history = get_audit_log().history(data['invoice_no'])
+    if history:
+        with st.expander(f"🕘 Change History ({len(history)})"):
+            for entry in history:
+                recorded_at = datetime.fromisoformat(entry['recorded_at']).strftime('%d/%m/%Y %H:%M')
+                st.markdown(f"**{entry['action'].title()}** · {recorded_at} · {entry['source'].replace('_', ' ')}")
+                if entry['action'] == 'edit':
+                    for path, old, new in entry['changes']:
+                        st.caption(f"{path}: {old!r} → {new!r}")
+    
     col1, col2, col3 = st.columns(3)
     with col1:
         st.markdown(f"""
@@ -1412,18 +6753,67 @@ def show_preview():
         </div>
         """, unsafe_allow_html=True)
     
+    stored_total, payments = get_invoice_payments(data['invoice_no'])
+    paid = sum(payment['amount'] for payment in payments)
     with col3:
+        if stored_total is None:
+            payment_line = "Payment: Invoice not saved"
+        else:
+            balance = total_amount - paid
+            balance_text = f"Due: ₹{balance:,.2f}" if balance >= 0 else f"Credit: ₹{-balance:,.2f}"
+            payment_line = f"Payment: {payment_status(total_amount, paid)} | {balance_text}"
         st.markdown(f"""
         <div style="background: #0a2a43; padding: 20px; border-radius: 8px; color: white;">
             <h4 style="color: white; margin: 0 0 10px 0;">💰 Total Amount</h4>
             <p style="font-size: 24px; font-weight: bold; margin: 5px 0;">₹{total_amount:,.2f}</p>
-            <p style="margin: 5px 0; font-size: 12px; opacity: 0.9;">Tax: Nil | Refund: Not Available</p>
+            <p style="margin: 5px 0; font-size: 12px; opacity: 0.9;">{payment_line}</p>
+            <p style="margin: 5px 0; font-size: 12px; opacity: 0.9;">Tax: Nil | Refund: {get_catalog()['policy'].get('refund_summary', 'Not Available')}</p>
         </div>
         """, unsafe_allow_html=True)
+    
+    if stored_total is not None:
+        show_payment_panel(data, total_amount, paid, payments)
+
+def show_payment_panel(data, total_amount, paid, payments):
+    """List an invoice's payments, the patient's running balance and a form to record a payment"""
+    billed, patient_paid = get_patient_balance(data)
+    with st.expander(f"💳 Payments ({len(payments)})", expanded=paid < total_amount):
+        st.caption(f"Patient balance across all invoices: ₹{billed - patient_paid:,.2f} "
+                   f"(billed ₹{billed:,.2f}, paid ₹{patient_paid:,.2f})")
+        for payment in payments:
+            paid_on = datetime.strptime(payment['paid_on'], '%Y-%m-%d').strftime('%d/%m/%Y')
+            reference = f" · {payment['reference']}" if payment['reference'] else ""
+            st.markdown(f"**₹{payment['amount']:,.2f}** · {paid_on} · {payment['method']}{reference}")
+        
+        with st.form("record_payment", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                amount = st.number_input("Amount (₹)", min_value=0.0, value=float(max(total_amount - paid, 0)), step=100.0)
+                method = st.selectbox("Method", PAYMENT_METHODS)
+            with col2:
+                paid_on = st.date_input("Paid On", value=datetime.now().date())
+                reference = st.text_input("Reference", placeholder="UPI / card / cheque reference")
+            if st.form_submit_button("Record Payment", use_container_width=True):
+                try:
+                    record_payment(data['invoice_no'], amount, paid_on, method, reference)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    if paid + amount > total_amount:
+                        st.session_state.payment_notice = f"Recorded ₹{amount:,.2f}; the invoice is now overpaid by ₹{paid + amount - total_amount:,.2f}."
+                    else:
+                        st.session_state.payment_notice = f"Recorded ₹{amount:,.2f} by {method}."
+                    st.rerun()
+        notice = st.session_state.pop('payment_notice', None)
+        if notice:
+            st.success(notice)
 
 def main():
     """Main application function"""
+    cpu_started, wall_started = time.thread_time(), time.perf_counter()
     initialize_session_state()
+    if st.session_state.pop('session_expired', False):
+        st.info(f"⏰ This session was idle for over {SESSION_IDLE_SECONDS // 60} minutes and has been reset.")
     
     with st.sidebar:
         st.markdown("""
@@ -1436,12 +6826,40 @@ def main():
         st.markdown("---")
         
         st.markdown("### 🏢 Clinic Locations:")
-        for location_key, location_data in CLINIC_ADDRESSES.items():
+        catalog_store = get_catalog_store()
+        if catalog_store.last_error:
+            st.warning(f"⚠️ Clinic catalog has errors, using the version loaded at {catalog_store.loaded_at.strftime('%H:%M:%S')}: {catalog_store.last_error}")
+        catalog = catalog_store.catalog
+        for location_key, location_data in catalog['clinics'].items():
             st.markdown(f"📍 **{location_data['display_name']}**")
             st.markdown(f"<small>{location_data['short_address']}</small>", unsafe_allow_html=True)
             st.markdown("---")
         
-        st.markdown("""
+        branding_stats = get_branding_cache().stats()
+        if branding_stats['bundles']:
+            with st.expander(f"🎨 Branding Cache ({branding_stats['total_bytes'] / 1024:,.0f} KB)"):
+                for bundle in branding_stats['bundles']:
+                    st.caption(f"{bundle['clinic_location']} · {bundle['practitioner']}: {bundle['bytes'] / 1024:,.0f} KB")
+        
+        cache_stats = get_shared_cache().stats()
+        with st.expander(f"🗄️ Shared Cache ({cache_stats['shared_bytes'] / 1024:,.0f} KB)"):
+            for namespace, counters in sorted(cache_stats['namespaces'].items()):
+                lookups = counters['memory'] + counters['shared'] + counters['misses']
+                hit_rate = (counters['memory'] + counters['shared']) / lookups if lookups else 0
+                st.caption(f"{namespace}: {counters['memory']} memory hits · {counters['shared']} shared hits · "
+                           f"{counters['misses']} misses ({hit_rate:.0%} hit rate)")
+            st.caption(f"Entries: {cache_stats['memory_entries']} in memory, {cache_stats['shared_entries']} shared")
+            st.caption(f"Warmed at startup: {cache_stats['warmed']['loaded']} loaded, "
+                       f"{cache_stats['warmed']['rendered']} rendered")
+        
+        session_stats = get_session_monitor().stats()
+        if session_stats['sessions']:
+            with st.expander(f"👥 Active Sessions ({session_stats['sessions']})"):
+                st.caption(f"Session state: {session_stats['state_bytes'] / 1024:,.0f} KB in total")
+                st.caption(f"CPU per rerun: {session_stats['cpu_ms_per_rerun']:.1f} ms")
+                st.caption(f"Idle sessions reset: {session_stats['sessions_reset']}")
+        
+        st.markdown(f"""
         **Features v2.3:**
         - ✅ Edit existing invoices
         - ✅ Multiple clinic locations
@@ -1449,21 +6867,36 @@ def main():
         - ✅ Refund policy included
         
         **Contact:**
-        📞 +91 8639398229
-        📍 Multiple Locations in Hyderabad
+        📞 {catalog['contact'].get('phone', '')}
+        📍 {catalog['contact'].get('area', '')}
         
         ---
         © 2026 PAL Physiotherapy
         """)
     
-    if st.session_state.page == 'dashboard':
-        show_dashboard()
-    elif st.session_state.page == 'upload':
-        show_upload_page()
-    elif st.session_state.page == 'form':
-        show_form()
-    elif st.session_state.page == 'preview':
-        show_preview()
+    try:
+        if st.session_state.page == 'dashboard':
+            show_dashboard()
+        elif st.session_state.page == 'upload':
+            show_upload_page()
+        elif st.session_state.page == 'form':
+            show_form()
+        elif st.session_state.page == 'preview':
+            show_preview()
+        elif st.session_state.page == 'plans':
+            show_plan_billing_page()
+        elif st.session_state.page == 'search':
+            show_search_page()
+        elif st.session_state.page == 'receivables':
+            show_receivables_page()
+        elif st.session_state.page == 'statements':
+            show_statement_page()
+    finally:
+        # Also runs when a page calls st.rerun()
+        record_session_usage(cpu_started, wall_started)
 
 if __name__ == "__main__":
-    main()
+    if "--job-worker" in sys.argv:
+        run_job_worker()
+    else:
+        main()
@@ -0,0 +1,502 @@
+"""Headless load test for the PAL invoice app.
+
+Starts `streamlit run app.py` on a free local port and connects N simulated
+front-desk users to it over Streamlit's websocket protocol, the same way
+browser tabs do, so every user is a separate session on one server process.
+Each user walks the main page flows:
+
+    create:  dashboard -> new invoice form -> preview -> dashboard
+    edit:    dashboard -> upload PDF -> parsed invoice form -> preview -> dashboard
+
+and the harness reports rerun latency percentiles (button press to the end
+of the script run, including any st.rerun() the page makes), and the server
+process's CPU time and memory growth per session. After each preview the
+user downloads the invoice and checks it carries its own patient and invoice
+number, so state leaking between sessions fails the run.
+
+    python load_test.py --users 8 --iterations 5
+    python load_test.py --users 4 --iterations 1 --idle-seconds 20
+
+With --session-lines a single user instead opens uploaded invoices of each
+given length in the form and times a plain rerun, an edit to the first
+session line and adding a line, to show whether the form stays flat as the
+number of lines grows:
+
+    python load_test.py --session-lines 10 50 200
+
+Invoices are written to a temporary PAL_DATA_DIR so the real store is not
+touched. AppTest is not used because it cannot run two sessions at once.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+SERVER_START_TIMEOUT = 60
+RERUN_TIMEOUT = 120
+PERCENTILES = (50, 90, 99)
+EDIT_FIRST_NUMBER = 900
+SESSION_LINES_REPEATS = 5
+
+SAMPLE_INVOICE_TEXT = """INVOICE
+Invoice number: PAL-PT-2026-{number:03d}
+Date: 05/01/2026
+Patient Details:
+Name: {name}
+Age: 45
+Sex: Female
+Phone: +91 98480{user:05d}
+Clinic Details:
+Doctor: Dr. Bhuvana
+Medical Details:
+Problem Description:
+Lower back pain
+Treatment Notes:
+Core strengthening
+Mode of Treatment: Clinic visit
+Session Details
+Session Start Date: 01/01/2026 | Session End Date: 31/01/2026
+S.No Description of Services QTY Per Session Cost Total
+1 60 Mins Physiotherapy Session 1 ₹500.00 ₹500.00
+2 60 Mins Physiotherapy Session 1 ₹500.00 ₹500.00
+3 45 Mins Manual Therapy Session 1 ₹700.00 ₹700.00
+"""
+SAMPLE_SESSION_LINE = "{index} 60 Mins Physiotherapy Session 1 ₹500.00 ₹500.00"
+
+def patient_name(user):
+    """Letters only, as the invoice parser expects in names"""
+    return f"Load Test Patient {string.ascii_uppercase[user % 26]}"
+
+def sample_invoice_pdf(user, number, session_lines=0):
+    """An invoice PDF whose text the upload page can parse, with its three lines or `session_lines` lines"""
+    import fitz
+
+    lines = SAMPLE_INVOICE_TEXT.format(number=number, name=patient_name(user), user=user).splitlines()
+    font_size, line_height = 10, 14
+    if session_lines:
+        # Small print keeps 200 lines within the pages the upload parser reads
+        lines = lines[:-3] + [SAMPLE_SESSION_LINE.format(index=index) for index in range(1, session_lines + 1)]
+        font_size, line_height = 5, 7
+    doc = fitz.open()
+    # Noto Serif has the rupee sign, which the base 14 fonts lack
+    font = fitz.Font(script=0).buffer
+    # new_page() pages are A4
+    lines_per_page = int((fitz.paper_size("a4")[1] - 80) // line_height)
+    for start in range(0, len(lines), lines_per_page):
+        page = doc.new_page()
+        page.insert_font(fontname="noto", fontbuffer=font)
+        for line_index, line in enumerate(lines[start:start + lines_per_page]):
+            page.insert_text((40, 50 + line_index * line_height), line, fontname="noto", fontsize=font_size)
+    return doc.tobytes()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def process_usage(pid):
+    """(CPU seconds, resident bytes) of a process, or zeros where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmRSS:"))
+        return cpu_seconds, rss
+    except (OSError, StopIteration):
+        return 0.0, 0
+
+def start_server(port, env):
+    """Launch the app headless and wait until its health endpoint answers"""
+    from tornado.httpclient import HTTPClient, HTTPClientError
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP_PATH,
+         "--server.headless", "true",
+         "--server.port", str(port),
+         "--server.fileWatcherType", "none",
+         # Lets the harness PUT uploads without a browser's XSRF cookie
+         "--server.enableXsrfProtection", "false",
+         "--browser.gatherUsageStats", "false"],
+        cwd=os.path.dirname(APP_PATH), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = HTTPClient()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    try:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"streamlit exited with code {server.returncode}")
+            try:
+                client.fetch(f"http://localhost:{port}/_stcore/health")
+                return server
+            except (OSError, HTTPClientError):
+                time.sleep(0.2)
+    finally:
+        client.close()
+    server.kill()
+    raise RuntimeError(f"streamlit did not start within {SERVER_START_TIMEOUT}s")
+
+class SimulatedUser:
+    """One browser session: sends reruns with widget values and reads the elements back"""
+
+    def __init__(self, port, user):
+        self.port = port
+        self.user = user
+        self.timings = []
+        self.session_id = None
+        self.widgets = {}
+        self.texts = []
+        self.download_url = None
+        self.connection = None
+
+    async def connect(self):
+        from tornado.websocket import websocket_connect
+
+        self.connection = await websocket_connect(
+            f"ws://localhost:{self.port}/_stcore/stream", subprotocols=["streamlit"])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    async def send(self, back_msg):
+        await self.connection.write_message(back_msg.SerializeToString(), binary=True)
+
+    async def receive(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        payload = await asyncio.wait_for(self.connection.read_message(), RERUN_TIMEOUT)
+        if payload is None:
+            raise RuntimeError("server closed the websocket")
+        msg = ForwardMsg()
+        msg.ParseFromString(payload)
+        return msg
+
+    async def rerun(self, step, widget_states=()):
+        """Rerun the script with the given widget states, timing it until the page settles"""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        back_msg = BackMsg()
+        back_msg.rerun_script.widget_states.widgets.extend(widget_states)
+        started = time.perf_counter()
+        await self.send(back_msg)
+        while True:
+            msg = await self.receive()
+            kind = msg.WhichOneof("type")
+            if kind == "new_session":
+                self.session_id = msg.new_session.initialize.session_id
+                self.widgets = {}
+                self.texts = []
+                self.download_url = None
+            elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                self.record_element(msg.delta.new_element)
+            elif kind == "script_finished":
+                if msg.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise RuntimeError(f"{step}: app failed to compile")
+                if msg.script_finished == ForwardMsg.FINISHED_SUCCESSFULLY:
+                    break
+        self.timings.append((step, time.perf_counter() - started))
+        errors = [text for text in self.texts if text.startswith("exception:")]
+        if errors:
+            raise RuntimeError(f"{step}: {errors[0]}")
+
+    def record_element(self, element):
+        kind = element.WhichOneof("type")
+        if kind in ("button", "text_input", "number_input", "file_uploader"):
+            widget = getattr(element, kind)
+            self.widgets.setdefault((kind, widget.label), widget.id)
+        elif kind == "arrow_data_frame" and element.arrow_data_frame.id:
+            # Only data editors have an id
+            self.widgets.setdefault((kind, ""), element.arrow_data_frame.id)
+        elif kind == "download_button":
+            self.download_url = element.download_button.url
+        elif kind == "markdown":
+            self.texts.append(element.markdown.body)
+        elif kind == "alert":
+            self.texts.append(element.alert.body)
+        elif kind == "exception":
+            self.texts.append(f"exception: {element.exception.type}: {element.exception.message}")
+
+    def widget_id(self, kind, label):
+        """Id of the first widget of `kind` whose label contains `label`"""
+        for (widget_kind, widget_label), widget_id in self.widgets.items():
+            if widget_kind == kind and label in widget_label:
+                return widget_id
+        raise RuntimeError(f"no {kind} labelled {label!r} on the page")
+
+    async def click(self, label, step, values=None):
+        """Press a button, optionally typing into text inputs in the same rerun"""
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        states = []
+        for input_label, value in (values or {}).items():
+            states.append(WidgetState(id=self.widget_id("text_input", input_label), string_value=value))
+        states.append(WidgetState(id=self.widget_id("button", label), trigger_value=True))
+        await self.rerun(step, states)
+
+    async def type_text(self, label, value, step):
+        """Change a text input, which reruns the page like leaving the field does"""
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        await self.rerun(step, [WidgetState(id=self.widget_id("text_input", label), string_value=value)])
+
+    async def edit_first_line(self, qty, step):
+        """Set the first session line's quantity in the session grid.
+
+        Forms from before the grid are edited through the first line's QTY
+        input, so the same run can be compared across versions.
+        """
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        if ("arrow_data_frame", "") in self.widgets:
+            edits = {"edited_rows": {"0": {"qty": qty}}, "added_rows": [], "deleted_rows": []}
+            state = WidgetState(id=self.widgets[("arrow_data_frame", "")], string_value=json.dumps(edits))
+        else:
+            state = WidgetState(id=self.widget_id("number_input", "QTY"), int_value=qty)
+        await self.rerun(step, [state])
+
+    async def upload(self, file_name, data, step):
+        """Upload a file as the browser does: request an URL, PUT the file, then rerun"""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.Common_pb2 import FileUploaderState, UploadedFileInfo
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+        from tornado.httpclient import AsyncHTTPClient
+
+        uploader_id = self.widget_id("file_uploader", "invoice PDF")
+        request_id = uuid.uuid4().hex
+        back_msg = BackMsg()
+        back_msg.file_urls_request.request_id = request_id
+        back_msg.file_urls_request.file_names.append(file_name)
+        back_msg.file_urls_request.session_id = self.session_id
+        started = time.perf_counter()
+        await self.send(back_msg)
+        while True:
+            msg = await self.receive()
+            if msg.WhichOneof("type") == "file_urls_response" and msg.file_urls_response.response_id == request_id:
+                break
+        file_urls = msg.file_urls_response.file_urls[0]
+
+        boundary = uuid.uuid4().hex
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{file_name}\"\r\n"
+                f"Content-Type: application/pdf\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        await AsyncHTTPClient().fetch(
+            f"http://localhost:{self.port}{file_urls.upload_url}", method="PUT", body=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        self.timings.append((f"{step} (transfer)", time.perf_counter() - started))
+
+        state = FileUploaderState(max_file_id=0, uploaded_file_info=[UploadedFileInfo(
+            name=file_name, size=len(data), file_id=file_urls.file_id, file_urls=file_urls)])
+        await self.rerun(step, [WidgetState(id=uploader_id, file_uploader_state_value=state)])
+
+    async def check_invoice(self, *expected):
+        """Fetch the invoice offered for download and check it is this user's own"""
+        from tornado.httpclient import AsyncHTTPClient
+
+        if not self.download_url:
+            raise RuntimeError("no invoice to download on the preview page")
+        response = await AsyncHTTPClient().fetch(f"http://localhost:{self.port}{self.download_url}")
+        html = response.body.decode("utf-8")
+        missing = [text for text in expected if text not in html]
+        if missing:
+            raise RuntimeError(f"session isolation: invoice is missing {missing}")
+
+async def run_create_flow(user, iteration):
+    """Dashboard -> new invoice form -> preview -> dashboard"""
+    await user.click("Create New", "open form")
+    # The suggested invoice number is kept, so concurrent users exercise number allocation
+    await user.click("Invoice Preview", "generate", values={
+        "Patient Name": patient_name(user.user),
+        "Patient Age": "45",
+        "Patient Phone No": f"+91 98480{user.user:05d}",
+    })
+    await user.check_invoice(patient_name(user.user))
+    await user.click("Back", "back to form")
+    await user.click("Back", "dashboard")
+
+async def run_edit_flow(user, iteration, number, pdf):
+    """Dashboard -> upload -> parsed invoice form -> preview -> dashboard"""
+    await user.click("Upload", "open upload")
+    await user.upload(f"invoice_{user.user}_{iteration}.pdf", pdf, "parse upload")
+    await user.click("Edit This Invoice", "open parsed invoice")
+    await user.click("Invoice Preview", "generate")
+    await user.check_invoice(f"PAL-PT-2026-{number:03d}", patient_name(user.user))
+    await user.click("Back", "back to form")
+    await user.click("Back", "dashboard")
+
+async def run_user(user, iterations, start):
+    """One simulated user alternating the create and edit flows"""
+    # Uploaded invoices are numbered from EDIT_FIRST_NUMBER so they never clash with created ones
+    numbers = [EDIT_FIRST_NUMBER + (user.user * 31 + iteration) % (1000 - EDIT_FIRST_NUMBER) for iteration in range(iterations)]
+    pdfs = [sample_invoice_pdf(user.user, number) for number in numbers]
+    await user.connect()
+    await start.wait()
+    await user.rerun("first load")
+    for iteration in range(iterations):
+        await run_create_flow(user, iteration)
+        await run_edit_flow(user, iteration, numbers[iteration], pdfs[iteration])
+
+async def run_users(port, count, iterations):
+    """Run all users at once; returns {user: error} for the ones that failed"""
+    users = [SimulatedUser(port, user) for user in range(count)]
+    start = asyncio.Event()
+    tasks = [asyncio.create_task(run_user(user, iterations, start)) for user in users]
+    # Let every user connect before any of them starts clicking
+    await asyncio.sleep(0.5)
+    start.set()
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = {user.user: outcome for user, outcome in zip(users, outcomes) if isinstance(outcome, BaseException)}
+    return users, errors
+
+async def check_idle_reset(port, users, idle_seconds):
+    """Wait out the idle timeout, load one new session and count the users it reset"""
+    await asyncio.sleep(idle_seconds + 1)
+    newcomer = SimulatedUser(port, len(users))
+    await newcomer.connect()
+    await newcomer.rerun("first load")
+    newcomer.close()
+    reset = 0
+    for user in users:
+        await user.rerun("after idle")
+        reset += any("session was idle" in text for text in user.texts)
+    print(f"Idle reset: {reset} of {len(users)} sessions cleared after {idle_seconds}s idle")
+
+def check_created_invoices(data_dir, expected):
+    """Check every created invoice was stored under a number of its own; returns whether it was"""
+    conn = sqlite3.connect(os.path.join(data_dir, "invoices.db"))
+    try:
+        created = conn.execute("SELECT COUNT(*) FROM invoices WHERE CAST(substr(invoice_no, 13) AS INTEGER) < ?",
+                               (EDIT_FIRST_NUMBER,)).fetchone()[0]
+    finally:
+        conn.close()
+    print(f"Invoice store: {created} of {expected} created invoices stored under their own numbers")
+    return created == expected
+
+def format_percentiles(seconds):
+    values = np.percentile(np.array(seconds) * 1000, PERCENTILES)
+    return " ".join(f"p{p}={value:7.1f}ms" for p, value in zip(PERCENTILES, values))
+
+def report_app_stats(user):
+    """Echo the app's own session monitor from the sidebar of a user's last page"""
+    for text in user.texts:
+        if text.startswith(("Session state:", "CPU per rerun:", "Idle sessions reset:")):
+            print(f"  app monitor:    {text}")
+
+async def run_session_lines(args, port):
+    """Time the form at each invoice length; the page should cost about the same at every length"""
+    steps = ("open form", "form rerun", "edit line", "add line")
+    rows = []
+    for lines in [0] + args.session_lines:
+        # The first pass only warms up imports and caches
+        user = SimulatedUser(port, lines)
+        pdf = sample_invoice_pdf(0, EDIT_FIRST_NUMBER, session_lines=lines or 3)
+        await user.connect()
+        try:
+            await user.rerun("first load")
+            await user.click("Upload", "open upload")
+            await user.upload(f"invoice_{lines}_lines.pdf", pdf, "parse upload")
+            await user.click("Edit This Invoice", "open form")
+            shown = next((text.split()[0] for text in user.texts if re.match(r"\d+ lines? ·", text)), None)
+            if lines and shown is not None and int(shown) != lines:
+                raise RuntimeError(f"the form shows {shown} of {lines} session lines")
+            for repeat in range(args.repeats):
+                await user.type_text("Patient Age", str(40 + repeat), "form rerun")
+                await user.edit_first_line(2 + repeat, "edit line")
+                await user.click("Add Session", "add line")
+        finally:
+            user.close()
+        if lines:
+            rows.append((lines, [np.median([seconds for step, seconds in user.timings if step == name]) * 1000
+                                 for name in steps]))
+
+    print(f"Median rerun of the invoice form ({args.repeats} runs per step)")
+    print(f"  {'lines':>5}" + "".join(f"{name:>12}" for name in steps))
+    for lines, medians in rows:
+        print(f"  {lines:>5}" + "".join(f"{median:>10.1f}ms" for median in medians))
+    return 0
+
+async def run_load_test(args, port, server, data_dir):
+    # A single warm-up session pays for imports and caches so they are not billed to the users
+    warm_up = SimulatedUser(port, args.users)
+    await warm_up.connect()
+    await warm_up.rerun("warm up")
+    warm_up.close()
+    await asyncio.sleep(0.5)
+
+    cpu_before, rss_before = process_usage(server.pid)
+    started = time.perf_counter()
+    users, errors = await run_users(port, args.users, args.iterations)
+    elapsed = time.perf_counter() - started
+    cpu_after, rss_after = process_usage(server.pid)
+
+    timings = [timing for user in users for timing in user.timings]
+    print(f"{args.users} users x {args.iterations} iterations: {len(timings)} reruns in {elapsed:.1f}s "
+          f"({len(timings) / elapsed:.1f} reruns/s)")
+    for user, error in sorted(errors.items()):
+        print(f"  user {user} failed: {error!r}")
+    if not timings:
+        return 1
+
+    print("\nRerun latency")
+    for step in dict.fromkeys(step for step, _ in timings):
+        seconds = [duration for name, duration in timings if name == step]
+        print(f"  {step:<26} n={len(seconds):<5} {format_percentiles(seconds)}")
+    print(f"  {'all':<26} n={len(timings):<5} {format_percentiles([duration for _, duration in timings])}")
+
+    cpu_seconds = cpu_after - cpu_before
+    print("\nPer session (server process)")
+    print(f"  CPU:            {cpu_seconds / args.users * 1000:,.0f} ms "
+          f"({cpu_seconds:.1f}s total, {cpu_seconds / elapsed * 100:.0f}% of one core)")
+    if rss_after:
+        print(f"  memory:         {(rss_after - rss_before) / args.users / 1024 / 1024:,.1f} MB growth "
+              f"({rss_after / 1024 / 1024:,.0f} MB resident)")
+    report_app_stats(users[0])
+    print()
+    stored_ok = not errors and check_created_invoices(data_dir, args.users * args.iterations)
+
+    if args.idle_seconds and not errors:
+        print()
+        await check_idle_reset(port, users, args.idle_seconds)
+    for user in users:
+        user.close()
+    return 1 if errors or not stored_ok else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the invoice app with simulated concurrent users")
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=3, help="create + edit flows per user")
+    parser.add_argument("--idle-seconds", type=int, default=0,
+                        help="if set, use this session idle timeout and check idle sessions are reset")
+    parser.add_argument("--session-lines", type=int, nargs="+", default=[],
+                        help="instead of the load test, time the form with invoices of these many session lines")
+    parser.add_argument("--repeats", type=int, default=SESSION_LINES_REPEATS,
+                        help="runs of each step per invoice length with --session-lines")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PAL_DATA_DIR=tempfile.mkdtemp(prefix="pal_load_test_"))
+    if args.idle_seconds:
+        env["PAL_SESSION_IDLE_SECONDS"] = str(args.idle_seconds)
+    port = free_port()
+    server = start_server(port, env)
+    try:
+        if args.session_lines:
+            return asyncio.run(run_session_lines(args, port))
+        return asyncio.run(run_load_test(args, port, server, env["PAL_DATA_DIR"]))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    sys.exit(main())
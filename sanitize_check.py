@@ -0,0 +1,148 @@
+"""Equivalence check and benchmark for the batch sanitization helpers.
+
+safe_int_series, safe_float_series and clean_text_series must return exactly
+what mapping safe_int, safe_float and clean_text_field over the same values
+returns. The check generates mixed batches with Hypothesis: numeric strings
+with currency signs, separators and stray minus signs or dots, non-ASCII
+digits, long digit runs, strings with NULs, ints beyond int64, NaN, infinity
+and None. The benchmark then times both ways over bulk import-shaped columns.
+
+    python sanitize_check.py
+    python sanitize_check.py --examples 2000 --rows 1000000
+    python sanitize_check.py --skip-check --rows 200000
+
+Needs hypothesis for the check (pip install hypothesis).
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app
+
+NUMBER_ALPHABET = "0123456789.-,₹ \t\x00e+abc٣५"
+BENCHMARK_REPEATS = 3
+
+def same_float(a, b):
+    return (math.isnan(a) and math.isnan(b)) or (a == b and math.copysign(1, a) == math.copysign(1, b))
+
+def value_strategy():
+    """Values as they arrive from CSV cells, parsed PDFs and form state"""
+    from hypothesis import strategies as st
+
+    numeric_text = st.one_of(
+        st.text(alphabet=NUMBER_ALPHABET, max_size=12),
+        st.builds(lambda sign, number, suffix: f"{sign}{number}{suffix}",
+                  st.sampled_from(["", "-", "₹", "₹ ", "Rs. "]),
+                  st.one_of(st.integers(-10 ** 20, 10 ** 20), st.floats(allow_nan=False, allow_infinity=False)),
+                  st.sampled_from(["", ".00", "/-", " only"])),
+        st.from_regex(r"\d{14,20}(\.\d{1,6})?", fullmatch=True),
+    )
+    return st.one_of(
+        numeric_text,
+        st.text(max_size=40),
+        st.integers(-2 ** 70, 2 ** 70),
+        st.floats(),
+        st.booleans(),
+        st.none(),
+    )
+
+def check_equivalence(examples):
+    """Run the property checks; Hypothesis raises with a minimal failing batch if one differs"""
+    from hypothesis import given, settings, HealthCheck
+    from hypothesis import strategies as st
+
+    batches = st.lists(value_strategy(), max_size=300)
+    check_settings = settings(max_examples=examples, deadline=None, suppress_health_check=[HealthCheck.too_slow])
+
+    @check_settings
+    @given(batches, st.sampled_from([0.0, -1.0, math.nan]))
+    def float_matches(values, default):
+        batch = app.safe_float_series(values, default).tolist()
+        assert len(batch) == len(values)
+        for value, got in zip(values, batch):
+            expected = app.safe_float(value, default)
+            assert same_float(got, expected), (value, got, expected)
+
+    @check_settings
+    @given(batches, st.sampled_from([0, -1, None]))
+    def int_matches(values, default):
+        batch = app.safe_int_series(values, default).tolist()
+        assert len(batch) == len(values)
+        for value, got in zip(values, batch):
+            expected = app.safe_int(value, default)
+            assert got == expected and type(got) is type(expected), (value, got, expected)
+
+    @check_settings
+    @given(st.lists(st.one_of(st.text(max_size=150), st.text(alphabet=" \t\n\x00ab", max_size=150),
+                              st.none(), st.just(math.nan)), max_size=300),
+           st.sampled_from([1, 10, 100]))
+    def text_matches(texts, max_length):
+        batch = app.clean_text_series(texts, max_length).tolist()
+        expected = [app.clean_text_field(text, max_length) if isinstance(text, str) else "" for text in texts]
+        assert batch == expected
+
+    for check in (float_matches, int_matches, text_matches):
+        started = time.perf_counter()
+        check()
+        print(f"{check.__name__}: {examples} batches equivalent ({time.perf_counter() - started:.1f}s)")
+
+def benchmark_columns(rows):
+    """Columns shaped like an invoice CSV import: repeated values with some free text"""
+    rng = np.random.default_rng(34)
+    quantities = rng.integers(1, 13, rows).astype(str).astype(object)
+    costs = np.array([f"₹{cost:,}.00" for cost in rng.integers(300, 2500, 2000)], dtype=object)[rng.integers(0, 2000, rows)]
+    ages = np.array([f"{age} yrs" for age in range(1, 100)] + ["", "N/A"], dtype=object)[rng.integers(0, 101, rows)]
+    descriptions = np.array([f"  {service}   Session  {minutes}  mins " for service in
+                             ("Physiotherapy", "Manual Therapy", "Speech Therapy", "Occupational Therapy")
+                             for minutes in (30, 45, 60)] + [None], dtype=object)[rng.integers(0, 13, rows)]
+    return quantities, costs, ages, descriptions
+
+def best_time(function):
+    times = []
+    for _ in range(BENCHMARK_REPEATS):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def benchmark(rows):
+    """Time the scalar helpers mapped over each column against the batch helpers"""
+    quantities, costs, ages, descriptions = benchmark_columns(rows)
+    cases = [
+        ("safe_int (quantities)", lambda: [app.safe_int(value) for value in quantities],
+         lambda: app.safe_int_series(quantities)),
+        ("safe_float (costs)", lambda: [app.safe_float(value) for value in costs],
+         lambda: app.safe_float_series(costs)),
+        ("safe_int (ages)", lambda: [app.safe_int(value) for value in ages],
+         lambda: app.safe_int_series(ages)),
+        ("clean_text_field (services)", lambda: [app.clean_text_field(text) if isinstance(text, str) else "" for text in descriptions],
+         lambda: app.clean_text_series(descriptions)),
+    ]
+    print(f"\n{rows:,} values, best of {BENCHMARK_REPEATS}")
+    print(f"{'helper':<30}{'scalar':>10}{'batch':>10}{'speedup':>10}")
+    for name, scalar, batch in cases:
+        scalar_seconds = best_time(scalar)
+        batch_seconds = best_time(batch)
+        print(f"{name:<30}{scalar_seconds:>9.3f}s{batch_seconds:>9.3f}s{scalar_seconds / batch_seconds:>9.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the batch sanitization helpers against the scalar ones and time them")
+    parser.add_argument("--examples", type=int, default=500, help="generated batches per property")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="values per benchmark column")
+    parser.add_argument("--skip-check", action="store_true", help="only run the benchmark")
+    args = parser.parse_args()
+
+    if not args.skip_check:
+        check_equivalence(args.examples)
+    if args.rows:
+        benchmark(args.rows)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
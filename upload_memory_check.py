@@ -0,0 +1,116 @@
+"""Peak memory check for parsing uploaded invoice PDFs.
+
+Each case builds a PDF, wraps it as Streamlit wraps an upload and runs it
+through parse_invoice_pdf, the upload page's path, under tracemalloc in a
+fresh process. It checks the Python peak against a limit, and reports the
+growth of the process's resident high-water mark, which also covers
+MuPDF's own allocations:
+
+    invoice    a normal one-page invoice
+    page-bomb  a small file with far more than MAX_PDF_PAGES pages
+    oversized  a file over MAX_UPLOAD_BYTES
+    full-text  MAX_PDF_PAGES pages packed with words, the most an accepted upload reads
+
+    python upload_memory_check.py
+    python upload_memory_check.py --case page-bomb
+"""
+import argparse
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Python heap peaks allowed while parsing each upload. A rejected upload must not
+# be copied at all; full-text holds the words of every page, about 28 MB measured
+PEAK_LIMITS = {
+    'invoice': 4 * 1024 * 1024,
+    'page-bomb': 1024 * 1024,
+    'oversized': 256 * 1024,
+    'full-text': 32 * 1024 * 1024,
+}
+PAGE_BOMB_PAGES = 50_000
+FULL_TEXT_WORDS_PER_LINE = 40
+FULL_TEXT_LINES_PER_PAGE = 140
+
+def build_pdf(case):
+    """Return the bytes of the PDF for one case"""
+    import fitz
+    import app
+    from load_test import sample_invoice_pdf
+
+    if case == 'invoice':
+        return sample_invoice_pdf(0, 1)
+    document = fitz.open()
+    if case == 'page-bomb':
+        for _ in range(PAGE_BOMB_PAGES):
+            document.new_page()
+    elif case == 'oversized':
+        document = fitz.open(stream=sample_invoice_pdf(0, 1), filetype="pdf")
+        # Random bytes do not compress, so the file really is this large
+        document.embfile_add("padding.bin", os.urandom(app.MAX_UPLOAD_BYTES))
+    elif case == 'full-text':
+        line = " ".join(f"w{index}" for index in range(FULL_TEXT_WORDS_PER_LINE))
+        for _ in range(app.MAX_PDF_PAGES):
+            page = document.new_page()
+            page.insert_text((20, 24), "\n".join([line] * FULL_TEXT_LINES_PER_PAGE), fontsize=4)
+    return document.tobytes(garbage=1, deflate=True)
+
+def run_case(case):
+    """Parse one case's upload and print 'bytes peak rss_growth seconds outcome'"""
+    from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+    from streamlit.proto.Common_pb2 import FileURLs
+    import app
+
+    data = build_pdf(case)
+    uploaded_file = UploadedFile(UploadedFileRec("check", f"{case}.pdf", "application/pdf", data), FileURLs())
+    # Load the parser's lazy imports and caches before measuring
+    warm_up = UploadedFile(UploadedFileRec("warm", "warm.pdf", "application/pdf", build_pdf('invoice')), FileURLs())
+    app.parse_invoice_pdf(warm_up)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    tracemalloc.start()
+    started = time.perf_counter()
+    text, parsed = app.parse_invoice_pdf(uploaded_file)
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - rss_before
+    outcome = "parsed" if parsed else "rejected" if text is None else "unparsed"
+    print(len(data), peak, rss_growth, f"{seconds:.3f}", outcome)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check peak memory while parsing uploaded invoice PDFs")
+    parser.add_argument("--case", choices=list(PEAK_LIMITS), action="append", help="run only these cases")
+    parser.add_argument("--run-case", choices=list(PEAK_LIMITS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        run_case(args.run_case)
+        return 0
+
+    # Keeps the check's parse cache entries out of the real store
+    env = dict(os.environ, PAL_DATA_DIR=tempfile.mkdtemp(prefix="pal_upload_check_"))
+    failed = False
+    print(f"{'case':<10}{'file':>10}{'python peak':>14}{'limit':>10}{'rss growth':>13}{'time':>9}  outcome")
+    for case in args.case or list(PEAK_LIMITS):
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", case],
+                               env=env, capture_output=True, text=True)
+        if child.returncode:
+            print(f"{case:<10} failed:\n{child.stderr}")
+            failed = True
+            continue
+        size, peak, rss_growth, seconds, outcome = child.stdout.split()[-5:]
+        limit = PEAK_LIMITS[case]
+        over = int(peak) > limit
+        failed |= over
+        print(f"{case:<10}{int(size) / 1024 / 1024:>8.1f}MB{int(peak) / 1024 / 1024:>12.2f}MB{limit / 1024 / 1024:>8.1f}MB"
+              f"{int(rss_growth) / 1024 / 1024:>11.1f}MB{float(seconds):>8.2f}s  {outcome}{'  OVER LIMIT' if over else ''}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())